@@ -4,11 +4,17 @@ data_aug_scales2_resize = [400, 500, 600]
 data_aug_scales2_crop = [384, 600]
 data_aug_scale_overlap = None
 batch_size = 4
+aspect_ratio_grouping = False                 # train batches of images with similar resized shapes, less padding
+batch_max_pixels = 0                          # with aspect_ratio_grouping, pixel budget of a padded batch, up to batch_size images (0: off)
 modelname = 'groundingdino'
 backbone = 'swin_T_224_1k'
+backbone_skip_padding = False                 # swin only, compute windows of pure batch padding once per image, same outputs up to float rounding
+backbone_feature_cache = None                 # directory caching per image features of a frozen backbone (freeze_keywords 'backbone.0'), keyed on image_id and the recorded transforms, None: off. Only used while the backbone is deterministic, i.e. in eval mode for swin, which samples drop path in train mode; served features equal the computed ones
+backbone_feature_cache_max_bytes = 0          # stop adding features once the cache directory holds that many bytes on disk, shared by all ranks (0: no limit)
 position_embedding = 'sine'
 pe_temperatureH = 20
 pe_temperatureW = 20
+shape_cache_size = 32                         # sine position embeddings / encoder proposals cached per input shape, 0: off
 return_interm_indices = [1, 2, 3]
 enc_layers = 6
 dec_layers = 6
@@ -44,7 +50,18 @@ use_text_cross_attention = True
 text_dropout = 0.0
 fusion_dropout = 0.0
 fusion_droppath = 0.1
+fusion_attn_chunk_size = 0                    # image tokens per chunk in the fusion attention, 0: all at once
+attn_backend = "native"                       # "sdpa": fusion and text self-attention through F.scaled_dot_product_attention, needs torch >= 2.0, falls back to "native" with the torch < 2.0 of requirements.txt
+enc_token_keep_ratio = 1.0                    # fraction of image tokens updated by each encoder layer in training, 1.0: all
+enc_token_keep_ratio_eval = 1.0               # same at inference, ratios < 1 rank tokens by their two-stage text score
 sub_sentence_present = True
+text_cache_size = 0                           # eval only, cache the text features of up to N captions (0: off)
+text_cache_max_bytes = 0                      # byte budget of the text feature cache (0: no limit)
+frozen_text_cache_size = 0                    # text encoder frozen by freeze_keywords, cache its outputs for up to N sub-sentences (0: off)
+frozen_text_cache_max_bytes = 0               # byte budget of the frozen text encoder cache (0: no limit)
+positive_map_cache_size = 1024                # number of (caption, labels) positive maps cached by the criterion
+slim_eval_outputs = False                     # eval only, run the last decoder layer heads and return pred_logits/pred_boxes only
+pad_contrastive_logits = True                 # pad the text logits to max_text_len, False keeps one column per caption token
 max_labels = 50                               # pos + neg
 lr = 0.0001                                   # base learning rate
 backbone_freeze_keywords = None               # only for gdino backbone
@@ -104,8 +121,10 @@ focal_alpha = 0.25
 focal_gamma = 2.0
 decoder_sa_type = 'sa'
 matcher_type = 'HungarianMatcher'
+matcher_num_workers = 0                       # threads solving the assignment problems, 0: serial
 decoder_module_seq = ['sa', 'ca', 'ffn']
-nms_iou_threshold = -1
+nms_iou_threshold = -1                        # class aware NMS in PostProcess, -1: off
+postprocess_score_threshold = 0.0             # drop detections scoring below it in PostProcess, 0: off
 dec_pred_class_embed_share = True
 
 
@@ -114,5 +133,7 @@ use_ema = False
 ema_decay = 0.9997
 ema_epoch = 0
 use_detached_boxes_dec_out = False
+numerics_monitor = 'off'                      # nan/inf counts of encoder, fusion, decoder and losses in training: 'off', 'sampled', 'deferred'
+numerics_monitor_interval = 100               # steps between two checked steps in 'sampled' mode
 use_coco_eval = True
 dn_scalar = 100
\ No newline at end of file
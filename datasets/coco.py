@@ -366,6 +366,7 @@ class CocoDetection(torchvision.datasets.CocoDetection):
         image_id = self.ids[idx]
         target = {'image_id': image_id, 'annotations': target}
         img, target = self.prepare(img, target)
+        target["transform_params"] = (("load", self.coco.loadImgs(image_id)[0]["file_name"]),)
         
         if self._transforms is not None:
             img, target = self._transforms(img, target)
@@ -6,15 +6,18 @@ from PIL import Image
 import torch
 import random
 import os, sys
+import warnings
 sys.path.append(os.path.dirname(sys.path[0]))
 
 import datasets.transforms as T
+from datasets.odvg_store import ODVGStore
 
 class ODVGDataset(VisionDataset):
     """
     Args:
         root (string): Root directory where images are downloaded to.
-        anno (string): Path to json annotation file.
+        anno (string): Path to json annotation file, or to a store directory converted from it
+            by datasets/odvg_store.py.
         label_map_anno (string):  Path to json label mapping file. Only for Object Detection
         transform (callable, optional): A function/transform that  takes in an PIL image
             and returns a transformed version. E.g, ``transforms.PILToTensor``
@@ -49,29 +52,70 @@ class ODVGDataset(VisionDataset):
         self.label_index = set(self.label_map.keys())
 
     def _load_metas(self, anno):
+        if os.path.isdir(anno):
+            # memory-mapped, nothing is parsed per item
+            self.store = ODVGStore(anno)
+            self.metas = None
+            assert len(self.store) == 0 or self.store.mode == self.dataset_mode, \
+                f"{anno} holds {self.store.mode} annotations but the dataset is {self.dataset_mode}"
+            return
+        self.store = None
         with  open(anno, 'r')as f:
             self.metas = [json.loads(line) for line in f]
 
+    def get_annotations(self, index):
+        """File name, boxes and labels (OD) or phrases (VG) of the regions of an image."""
+        if self.store is not None:
+            if self.dataset_mode == "OD":
+                names = [str(label) for label in self.store.labels(index)]
+            else:
+                names = self.store.phrases(index)
+            return self.store.filename(index), self.store.boxes(index).tolist(), names
+        meta = self.metas[index]
+        if self.dataset_mode == "OD":
+            instances = meta["detection"]["instances"]
+            names = [str(obj["label"]) for obj in instances]
+        else:
+            instances = meta["grounding"]["regions"]
+            names = [obj["phrase"] for obj in instances]
+        return meta["filename"], [obj["bbox"] for obj in instances], names
+
+    def get_height_and_width(self, index):
+        if self.store is not None:
+            size = self.store.height_and_width(index)
+            if size is not None:
+                return size
+            filename = self.store.filename(index)
+        else:
+            meta = self.metas[index]
+            if "height" in meta and "width" in meta:
+                return meta["height"], meta["width"]
+            filename = meta["filename"]
+        if not getattr(self, "_warned_missing_sizes", False):
+            self._warned_missing_sizes = True
+            warnings.warn(
+                "image sizes missing from the annotations of {}, opening the images to read them, which is slow "
+                "on large datasets: add height and width to the jsonl".format(self.root)
+            )
+        w, h = Image.open(os.path.join(self.root, filename)).size
+        return h, w
+
     def get_dataset_info(self):
         print(f"  == total images: {len(self)}")
         if self.dataset_mode == "OD":
             print(f"  == total labels: {len(self.label_map)}")
 
     def __getitem__(self, index: int):
-        meta = self.metas[index]
-        rel_path = meta["filename"]
+        rel_path, boxes, names = self.get_annotations(index)
         abs_path = os.path.join(self.root, rel_path)
         if not os.path.exists(abs_path):
             raise FileNotFoundError(f"{abs_path} not found.")
         image = Image.open(abs_path).convert('RGB')
         w, h = image.size
         if self.dataset_mode == "OD":
-            anno = meta["detection"]
-            instances = [obj for obj in anno["instances"]]
-            boxes = [obj["bbox"] for obj in instances]
             # generate vg_labels
             # pos bbox labels
-            ori_classes = [str(obj["label"]) for obj in instances]
+            ori_classes = names
             pos_labels = set(ori_classes)
             # neg bbox labels
             neg_labels = list(self.label_index.difference(pos_labels))
@@ -90,14 +134,11 @@ class ODVGDataset(VisionDataset):
             caption_dict = {item:index for index, item in enumerate(caption_list)}
 
             caption = ' . '.join(caption_list) + ' .'
-            classes = [caption_dict[self.label_map[str(obj["label"])]] for obj in instances]
+            classes = [caption_dict[self.label_map[lb]] for lb in ori_classes]
             boxes = torch.as_tensor(boxes, dtype=torch.float32).reshape(-1, 4)
             classes = torch.tensor(classes, dtype=torch.int64)
         elif self.dataset_mode == "VG":
-            anno = meta["grounding"]
-            instances = [obj for obj in anno["regions"]]
-            boxes = [obj["bbox"] for obj in instances]
-            caption_list = [obj["phrase"] for obj in instances]
+            caption_list = names
             c = list(zip(boxes, caption_list))
             random.shuffle(c)
             boxes[:], caption_list[:] = zip(*c)
@@ -116,7 +157,9 @@ class ODVGDataset(VisionDataset):
         target["caption"] = caption
         target["boxes"] = boxes
         target["labels"] = classes
-        # size, cap_list, caption, bboxes, labels
+        target["image_id"] = torch.tensor([index])
+        target["transform_params"] = (("load", rel_path),)
+        # size, cap_list, caption, bboxes, labels, image_id, transform_params
 
         if self.transforms is not None:
             image, target = self.transforms(image, target)
@@ -125,6 +168,8 @@ class ODVGDataset(VisionDataset):
     
 
     def __len__(self) -> int:
+        if self.store is not None:
+            return len(self.store)
         return len(self.metas)
 
 
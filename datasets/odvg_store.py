@@ -0,0 +1,189 @@
+"""
+Compact columnar store of odvg annotations, memory-mapped by ODVGDataset.
+
+A store is a directory converted once from an odvg jsonl file:
+
+    python datasets/odvg_store.py -i anno_odvg.jsonl -o anno_odvg_store
+
+and used by pointing the "anno" of the dataset to the directory. Nothing is parsed per item and
+the annotations stay in the page cache, shared by the DataLoader workers, instead of a list of
+dicts slowly copied into every worker by reference counting.
+
+Every column is a raw array, its dtype and length are listed in meta.json:
+    - filenames, filename_offsets: utf-8 file names, image i is filenames[offsets[i]:offsets[i + 1]]
+    - heights, widths: image sizes, -1 when missing from the jsonl
+    - region_offsets: the regions of image i are region_offsets[i]:region_offsets[i + 1]
+    - boxes: 4 coordinates per region
+    - labels: label id per region, OD only
+    - phrases, phrase_offsets: utf-8 phrase per region, VG only
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+STORE_VERSION = 1
+
+COLUMNS = {
+    "filenames": "uint8",
+    "filename_offsets": "int64",
+    "heights": "int32",
+    "widths": "int32",
+    "region_offsets": "int64",
+    "boxes": "float32",
+    "labels": "int64",
+    "phrases": "uint8",
+    "phrase_offsets": "int64",
+}
+
+
+class _ColumnWriter:
+    def __init__(self, path, dtype, chunk_size):
+        self.file = open(path, "wb")
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.length = 0
+        self.buffer = []
+
+    def extend(self, values):
+        self.buffer.extend(values)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def extend_bytes(self, data):
+        self.flush()
+        self.file.write(data)
+        self.length += len(data)
+
+    def flush(self):
+        if self.buffer:
+            np.asarray(self.buffer, dtype=self.dtype).tofile(self.file)
+            self.length += len(self.buffer)
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def convert_odvg(anno, output, chunk_size=1 << 20):
+    """Convert the odvg jsonl file anno into a store in the directory output, line by line."""
+    os.makedirs(output, exist_ok=True)
+    writers = {
+        name: _ColumnWriter(os.path.join(output, name + ".bin"), dtype, chunk_size)
+        for name, dtype in COLUMNS.items()
+    }
+    writers["filename_offsets"].extend([0])
+    writers["region_offsets"].extend([0])
+    writers["phrase_offsets"].extend([0])
+
+    mode = None
+    num_images = num_regions = 0
+    with open(anno, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            meta = json.loads(line)
+            line_mode = "OD" if "detection" in meta else "VG"
+            if mode is None:
+                mode = line_mode
+            assert line_mode == mode, "mixed OD and VG annotations at line {}".format(num_images + 1)
+
+            writers["filenames"].extend_bytes(meta["filename"].encode("utf-8"))
+            writers["filename_offsets"].extend([writers["filenames"].length])
+            writers["heights"].extend([meta.get("height", -1)])
+            writers["widths"].extend([meta.get("width", -1)])
+
+            if mode == "OD":
+                regions = meta["detection"]["instances"]
+                writers["labels"].extend([obj["label"] for obj in regions])
+            else:
+                regions = meta["grounding"]["regions"]
+                for obj in regions:
+                    writers["phrases"].extend_bytes(obj["phrase"].encode("utf-8"))
+                    writers["phrase_offsets"].extend([writers["phrases"].length])
+            for obj in regions:
+                writers["boxes"].extend(obj["bbox"])
+            num_images += 1
+            num_regions += len(regions)
+            writers["region_offsets"].extend([num_regions])
+
+    for writer in writers.values():
+        writer.close()
+    with open(os.path.join(output, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "version": STORE_VERSION,
+                "mode": mode,
+                "num_images": num_images,
+                "num_regions": num_regions,
+                "columns": {name: [str(w.dtype), w.length] for name, w in writers.items()},
+            },
+            f,
+            indent=2,
+        )
+    return num_images, num_regions
+
+
+class ODVGStore:
+    """Read-only access to a store written by convert_odvg, through np.memmap."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        assert self.meta["version"] == STORE_VERSION, "store {} has version {}, expected {}".format(
+            path, self.meta["version"], STORE_VERSION
+        )
+        self.mode = self.meta["mode"]
+        self.columns = {}
+        for name, (dtype, length) in self.meta["columns"].items():
+            if length == 0:
+                # np.memmap cannot map empty files
+                self.columns[name] = np.zeros(0, dtype=dtype)
+            else:
+                self.columns[name] = np.memmap(
+                    os.path.join(path, name + ".bin"), dtype=dtype, mode="r", shape=(length,)
+                )
+
+    def __len__(self):
+        return self.meta["num_images"]
+
+    def _string(self, data, offsets, index):
+        start, end = self.columns[offsets][index : index + 2]
+        return self.columns[data][start:end].tobytes().decode("utf-8")
+
+    def _regions(self, index):
+        start, end = self.columns["region_offsets"][index : index + 2]
+        return int(start), int(end)
+
+    def filename(self, index):
+        return self._string("filenames", "filename_offsets", index)
+
+    def height_and_width(self, index):
+        """(height, width) of the image, None if the jsonl had no sizes."""
+        h, w = int(self.columns["heights"][index]), int(self.columns["widths"][index])
+        return (h, w) if h >= 0 and w >= 0 else None
+
+    def boxes(self, index):
+        start, end = self._regions(index)
+        return np.array(self.columns["boxes"][start * 4 : end * 4]).reshape(-1, 4)
+
+    def labels(self, index):
+        start, end = self._regions(index)
+        return self.columns["labels"][start:end].tolist()
+
+    def phrases(self, index):
+        start, end = self._regions(index)
+        return [self._string("phrases", "phrase_offsets", i) for i in range(start, end)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("odvg jsonl to memory-mapped store.", add_help=True)
+    parser.add_argument("--input", "-i", required=True, type=str, help="odvg jsonl file")
+    parser.add_argument("--output", "-o", required=True, type=str, help="store directory")
+    args = parser.parse_args()
+
+    num_images, num_regions = convert_odvg(args.input, args.output)
+    print("  == {} images, {} regions written to {}".format(num_images, num_regions, args.output))
@@ -0,0 +1,183 @@
+"""
+Batch samplers grouping images of similar shapes to reduce the padding of the batches.
+"""
+import math
+
+import torch
+import torch.distributed as dist
+import torchvision
+from torch.utils.data import ConcatDataset, Sampler, Subset
+
+
+def get_image_sizes(dataset):
+    """(height, width) of every image of a dataset, read from the annotations."""
+    if isinstance(dataset, ConcatDataset):
+        return [size for d in dataset.datasets for size in get_image_sizes(d)]
+    if isinstance(dataset, Subset):
+        sizes = get_image_sizes(dataset.dataset)
+        return [sizes[i] for i in dataset.indices]
+    if hasattr(dataset, "get_height_and_width"):
+        return [dataset.get_height_and_width(i) for i in range(len(dataset))]
+    if isinstance(dataset, torchvision.datasets.CocoDetection):
+        return [(dataset.coco.imgs[i]["height"], dataset.coco.imgs[i]["width"]) for i in dataset.ids]
+    raise ValueError("cannot read the image sizes of a {}".format(type(dataset).__name__))
+
+
+def resized_shape(height, width, size, max_size=None):
+    """Shape of an image after datasets.transforms.resize to a min side of size."""
+    if max_size is not None:
+        min_original_size = float(min((width, height)))
+        max_original_size = float(max((width, height)))
+        if max_original_size / min_original_size * size > max_size:
+            size = int(round(max_size * min_original_size / max_original_size))
+    if width < height:
+        return int(size * height / width), size
+    return size, int(size * width / height)
+
+
+class GroupedBatchSampler(Sampler):
+    """Batches of images bucketed by their resized shape, split between the distributed ranks.
+
+    Images are bucketed by their shape at a nominal resize, rounded up to size_divisibility, which
+    groups them by aspect ratio and size. A batch is emitted as soon as its bucket holds
+    batch_size images or, with max_pixels, when the next image would push the padded batch over
+    the pixel budget. The images left in the buckets are sorted by aspect ratio and batched last.
+
+    Like DistributedSampler, every rank builds the same batches from seed + epoch, so set_epoch
+    must be called before each epoch. The shuffled batches are then dealt in turn to the ranks,
+    after repeating (or dropping, with drop_last) a few of them so that every rank gets the same
+    number of batches.
+
+    Args:
+        image_sizes (list): (height, width) of every image of the dataset.
+        batch_size (int): maximal number of images per batch.
+        max_pixels (int): if > 0, maximal number of pixels of a batch at the nominal resize,
+            padding included. Batches of small images then hold more images than large ones,
+            up to batch_size. 0: every batch holds batch_size images.
+        resize (tuple): (size, max_size) of the nominal resize.
+        size_divisibility (int): resized shapes are rounded up to a multiple of it in the buckets.
+        num_replicas (int): number of ranks, default to the world size.
+        rank (int): rank of the process, default to the current rank.
+        shuffle (bool): shuffle the images and the batches at each epoch.
+        seed (int): random seed, must be the same on every rank.
+        drop_last (bool): drop the last incomplete batch, and the batches that cannot be split
+            evenly between the ranks instead of repeating some.
+    """
+
+    def __init__(
+        self,
+        image_sizes,
+        batch_size,
+        max_pixels=0,
+        resize=(800, 1333),
+        size_divisibility=64,
+        num_replicas=None,
+        rank=None,
+        shuffle=True,
+        seed=0,
+        drop_last=True,
+    ):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        assert 0 <= rank < num_replicas, "invalid rank {} for {} replicas".format(rank, num_replicas)
+        self.batch_size = batch_size
+        self.max_pixels = max_pixels
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        self.shapes = [resized_shape(h, w, *resize) for h, w in image_sizes]
+        self.aspect_ratios = [w / h for h, w in image_sizes]
+        self.bucket_keys = [
+            (math.ceil(h / size_divisibility), math.ceil(w / size_divisibility)) for h, w in self.shapes
+        ]
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = None
+
+    def _full(self, batch, index):
+        """Whether index cannot join batch."""
+        if len(batch) >= self.batch_size:
+            return True
+        if self.max_pixels <= 0 or not batch:
+            return False
+        h = max(self.shapes[i][0] for i in batch + [index])
+        w = max(self.shapes[i][1] for i in batch + [index])
+        return (len(batch) + 1) * h * w > self.max_pixels
+
+    def _add(self, batches, batch, index):
+        """Add index to batch, or to a new batch once batch is moved to batches. Returns the batch."""
+        if self._full(batch, index):
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+        return batch
+
+    def _build_batches(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            order = torch.randperm(len(self.shapes), generator=g).tolist()
+        else:
+            order = list(range(len(self.shapes)))
+
+        batches = []
+        buckets = {}
+        for index in order:
+            key = self.bucket_keys[index]
+            buckets[key] = self._add(batches, buckets.get(key, []), index)
+            if len(buckets[key]) == self.batch_size:
+                batches.append(buckets.pop(key))
+
+        leftovers = sorted(
+            (index for bucket in buckets.values() for index in bucket),
+            key=lambda index: self.aspect_ratios[index],
+        )
+        batch = []
+        for index in leftovers:
+            batch = self._add(batches, batch, index)
+        if batch and (len(batch) == self.batch_size or not self.drop_last):
+            batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=g).tolist()]
+        remainder = len(batches) % self.num_replicas
+        if remainder and self.drop_last:
+            batches = batches[: len(batches) - remainder]
+        elif remainder:
+            batches += batches[: self.num_replicas - remainder]
+        return batches[self.rank :: self.num_replicas]
+
+    @property
+    def batches(self):
+        if self._batches is None:
+            self._batches = self._build_batches()
+        return self._batches
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def stats(self):
+        """Padding of the batches of this rank for the current epoch, at the nominal resize."""
+        pixels = padded = images = 0
+        for batch in self.batches:
+            h = max(self.shapes[i][0] for i in batch)
+            w = max(self.shapes[i][1] for i in batch)
+            pixels += sum(self.shapes[i][0] * self.shapes[i][1] for i in batch)
+            padded += len(batch) * h * w
+            images += len(batch)
+        return {
+            "batches": len(self.batches),
+            "images": images,
+            "padding": 1 - pixels / padded if padded > 0 else 0.0,
+        }
@@ -9,6 +9,7 @@ import numpy as np
 import random
 
 from .random_crop import random_crop
+from .transforms import record_params
 from util.box_ops import box_cxcywh_to_xyxy, box_xyxy_to_cxcywh
 
 class AdjustContrast:
@@ -210,7 +211,11 @@ class RandomSelectMulti(object):
 
     def __call__(self, img, target):
         if self.p == -1:
-            return random.choice(self.transformslist)(img, target)
+            img, target = random.choice(self.transformslist)(img, target)
+            # the photometric transforms and the random crop of this module are not recorded
+            target = target.copy()
+            record_params(target, None)
+            return img, target
 
 
 class Albumentations:
@@ -13,11 +13,33 @@ from util.box_ops import box_xyxy_to_cxcywh
 from util.misc import interpolate
 
 
+def record_params(target, params):
+    """Append the parameters of a geometric transform to target["transform_params"].
+
+    Together with target["image_id"] they identify the transformed image, the backbone feature
+    cache keys on them. params None marks a transform that is not recorded, e.g. photometric
+    augmentation, after which the image is not identified any more.
+    """
+    recorded = target.get("transform_params", ())
+    if recorded is None or params is None:
+        target["transform_params"] = None
+    else:
+        target["transform_params"] = recorded + (params,)
+
+
+def image_key(target):
+    """Hashable identity of a transformed image, None when one of its transforms was not recorded."""
+    if "image_id" not in target or target.get("transform_params") is None:
+        return None
+    return (int(target["image_id"]), target["transform_params"])
+
+
 def crop(image, target, region):
     cropped_image = F.crop(image, *region)
 
     target = target.copy()
     i, j, h, w = region
+    record_params(target, ("crop", tuple(int(v) for v in region)))
 
     # should we do something wrt the original size?
     target["size"] = torch.tensor([h, w])
@@ -63,6 +85,7 @@ def hflip(image, target):
     w, h = image.size
 
     target = target.copy()
+    record_params(target, ("hflip",))
     if "boxes" in target:
         boxes = target["boxes"]
         boxes = boxes[:, [2, 1, 0, 3]] * torch.as_tensor([-1, 1, -1, 1]) + torch.as_tensor([w, 0, w, 0])
@@ -113,6 +136,7 @@ def resize(image, target, size, max_size=None):
     ratio_width, ratio_height = ratios
 
     target = target.copy()
+    record_params(target, ("resize", tuple(rescaled_image.size)))
     if "boxes" in target:
         boxes = target["boxes"]
         scaled_boxes = boxes * torch.as_tensor([ratio_width, ratio_height, ratio_width, ratio_height])
@@ -139,6 +163,7 @@ def pad(image, target, padding):
     if target is None:
         return padded_image, None
     target = target.copy()
+    record_params(target, ("pad", tuple(int(v) for v in padding)))
     # should we do something wrt the original size?
     target["size"] = torch.tensor(padded_image.size[::-1])
     if "masks" in target:
@@ -245,6 +270,9 @@ class RandomErasing(object):
         self.eraser = T.RandomErasing(*args, **kwargs)
 
     def __call__(self, img, target):
+        if target is not None:
+            target = target.copy()
+            record_params(target, None)
         return self.eraser(img), target
 
 
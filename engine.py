@@ -13,6 +13,7 @@ import torch
 
 import util.misc as utils
 from datasets.coco_eval import CocoEvaluator
+from datasets.transforms import image_key
 from datasets.cocogrounding_eval import CocoGroundingEvaluator
 
 from datasets.panoptic_eval import PanopticEvaluator
@@ -35,21 +36,36 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
     print_freq = 10
 
     _cnt = 0
+    # nan / inf counts of the encoder, fusion, decoder and losses, see groundingdino.util.numerics
+    numerics = getattr(getattr(model, "module", model), "numerics", None)
+    # padding of the batches, only logged with the grouped batch sampler that reduces it
+    log_padding = getattr(args, "aspect_ratio_grouping", False)
 
 
     for samples, targets in metric_logger.log_every(data_loader, print_freq, header, logger=logger):
+        if numerics is not None:
+            numerics.begin_step()
+
+        if log_padding:
+            # fraction of the batch pixels that are padding
+            num_pixels = sum(int(t["size"].prod()) for t in targets)
+            padding = 1 - num_pixels / samples.mask.numel()
 
         samples = samples.to(device)
         captions = [t["caption"] for t in targets]
         cap_list = [t["cap_list"] for t in targets]
+        image_keys = [image_key(t) for t in targets]
         targets = [{k: v.to(device) for k, v in t.items() if torch.is_tensor(v)} for t in targets]
         with torch.cuda.amp.autocast(enabled=args.amp):
-            outputs = model(samples, captions=captions)
+            outputs = model(samples, captions=captions, image_keys=image_keys)
             loss_dict = criterion(outputs, targets, cap_list, captions)
 
             weight_dict = criterion.weight_dict
 
             losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
+        if numerics is not None and numerics.active:
+            for k, v in loss_dict.items():
+                numerics.check("loss." + k, v)
         # reduce losses over all GPUs for logging purposes
         loss_dict_reduced = utils.reduce_dict(loss_dict)
         loss_dict_reduced_unscaled = {f'{k}_unscaled': v
@@ -63,6 +79,8 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
         if not math.isfinite(loss_value):
             print("Loss is {}, stopping training".format(loss_value))
             print(loss_dict_reduced)
+            if numerics is not None and numerics.active:
+                print(numerics.report())
             sys.exit(1)
 
         # amp backward function
@@ -90,6 +108,10 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
         if 'class_error' in loss_dict_reduced:
             metric_logger.update(class_error=loss_dict_reduced['class_error'])
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
+        if log_padding:
+            metric_logger.update(padding=padding)
+        if numerics is not None and numerics.active:
+            metric_logger.update(**numerics.report())
 
         _cnt += 1
         if args.debug:
@@ -161,13 +183,16 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
     for samples, targets in metric_logger.log_every(data_loader, 10, header, logger=logger):
         samples = samples.to(device)
 
-        targets = [{k: to_device(v, device) for k, v in t.items()} for t in targets]
+        image_keys = [image_key(t) for t in targets]
+        targets = [
+            {k: to_device(v, device) for k, v in t.items() if k != "transform_params"} for t in targets
+        ]
 
         bs = samples.tensors.shape[0]
         input_captions = [caption] * bs
         with torch.cuda.amp.autocast(enabled=args.amp):
 
-            outputs = model(samples, captions=input_captions)
+            outputs = model(samples, captions=input_captions, image_keys=image_keys)
 
         orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
 
@@ -1,4 +1,4 @@
-from typing import Tuple, List
+from typing import Tuple, List, Union
 
 import cv2
 import numpy as np
@@ -10,7 +10,7 @@ import bisect
 
 import groundingdino.datasets.transforms as T
 from groundingdino.models import build_model
-from groundingdino.util.misc import clean_state_dict
+from groundingdino.util.misc import clean_state_dict, nested_tensor_from_tensor_list
 from groundingdino.util.slconfig import SLConfig
 from groundingdino.util.utils import get_phrases_from_posmap
 
@@ -26,14 +26,16 @@ def preprocess_caption(caption: str) -> str:
     return result + "."
 
 
-def load_model(model_config_path: str, model_checkpoint_path: str, device: str = "cuda"):
+def load_model(model_config_path: str, model_checkpoint_path: str, device: str = "cuda", text_cache_size: int = 0):
     args = SLConfig.fromfile(model_config_path)
     args.device = device
+    if text_cache_size > 0:
+        args.text_cache_size = text_cache_size
     model = build_model(args)
     checkpoint = torch.load(model_checkpoint_path, map_location="cpu")
     model.load_state_dict(clean_state_dict(checkpoint["model"]), strict=False)
     model.eval()
-    return model
+    return model.to(device)
 
 
 def load_image(image_path: str) -> Tuple[np.array, torch.Tensor]:
@@ -59,13 +61,13 @@ def predict(
         device: str = "cuda",
         remove_combined: bool = False
 ) -> Tuple[torch.Tensor, torch.Tensor, List[str]]:
+    # the model is expected to already live on `device`, see load_model
     caption = preprocess_caption(caption=caption)
 
-    model = model.to(device)
     image = image.to(device)
 
     with torch.no_grad():
-        outputs = model(image[None], captions=[caption])
+        outputs = model(image[None], captions=[caption], slim_outputs=True)
 
     prediction_logits = outputs["pred_logits"].cpu().sigmoid()[0]  # prediction_logits.shape = (nq, 256)
     prediction_boxes = outputs["pred_boxes"].cpu()[0]  # prediction_boxes.shape = (nq, 4)
@@ -97,6 +99,90 @@ def predict(
     return boxes, logits.max(dim=1)[0], phrases
 
 
+def phrases_from_logits(
+        logits: torch.Tensor,
+        tokenized,
+        tokenizer,
+        text_threshold: float,
+        remove_combined: bool = False
+) -> List[str]:
+    """Vectorized version of the phrase extraction done in predict().
+
+    Builds the posmaps of all detections of one caption at once and decodes every distinct
+    posmap a single time.
+    """
+    if len(logits) == 0:
+        return []
+    positions = torch.arange(logits.shape[1], device=logits.device)
+    if remove_combined:
+        sep_idx = torch.as_tensor(
+            [i for i, t in enumerate(tokenized["input_ids"]) if t in [101, 102, 1012]],
+            device=logits.device)
+        insert_idx = torch.searchsorted(sep_idx, logits.argmax(dim=1)).clamp(max=len(sep_idx) - 1)
+        right_idx = sep_idx[insert_idx]
+        left_idx = sep_idx[insert_idx - 1]
+    else:
+        left_idx = torch.zeros(len(logits), dtype=torch.long, device=logits.device)
+        right_idx = torch.full((len(logits),), 255, dtype=torch.long, device=logits.device)
+
+    posmap = (logits > text_threshold) & (positions > left_idx[:, None]) & (positions < right_idx[:, None])
+    unique_posmaps, inverse = torch.unique(posmap.to(torch.uint8), dim=0, return_inverse=True)
+    input_ids = tokenized["input_ids"]
+    decoded = [
+        tokenizer.decode([input_ids[i] for i in row.nonzero(as_tuple=True)[0].tolist()]).replace('.', '')
+        for row in unique_posmaps
+    ]
+    return [decoded[i] for i in inverse.tolist()]
+
+
+def predict_batch(
+        model,
+        images: List[torch.Tensor],
+        captions: Union[str, List[str]],
+        box_threshold: float,
+        text_threshold: float,
+        device: str = "cuda",
+        remove_combined: bool = False
+) -> List[Tuple[torch.Tensor, torch.Tensor, List[str]]]:
+    """Batched version of predict().
+
+    The images may have different sizes, they are padded into a single NestedTensor and go
+    through one forward pass. The model is expected to already live on `device`.
+    Returns one (boxes, logits, phrases) tuple per image, with the same meaning as predict().
+    """
+    if isinstance(captions, str):
+        captions = [captions] * len(images)
+    assert len(captions) == len(images), "one caption per image is expected"
+    captions = [preprocess_caption(caption=caption) for caption in captions]
+
+    samples = nested_tensor_from_tensor_list([image.to(device) for image in images])
+
+    with torch.no_grad():
+        outputs = model(samples, captions=captions, slim_outputs=True)
+
+    prediction_logits = outputs["pred_logits"].sigmoid()  # prediction_logits.shape = (bs, nq, 256)
+    prediction_boxes = outputs["pred_boxes"]  # prediction_boxes.shape = (bs, nq, 4)
+    scores = prediction_logits.max(dim=2)[0]  # scores.shape = (bs, nq)
+    mask = scores > box_threshold
+
+    # thresholding is done on device, only the kept detections are copied to host
+    counts = mask.sum(dim=1).tolist()
+    logits = prediction_logits[mask].cpu().split(counts)
+    boxes = prediction_boxes[mask].cpu().split(counts)
+    scores = scores[mask].cpu().split(counts)
+
+    tokenizer = model.tokenizer
+    tokenized_cache = {}
+    results = []
+    for caption, image_boxes, image_logits, image_scores in zip(captions, boxes, logits, scores):
+        if caption not in tokenized_cache:
+            tokenized_cache[caption] = tokenizer(caption)
+        phrases = phrases_from_logits(
+            image_logits, tokenized_cache[caption], tokenizer, text_threshold, remove_combined)
+        results.append((image_boxes, image_scores, phrases))
+    return results
+
+
 def annotate(image_source: np.ndarray, boxes: torch.Tensor, logits: torch.Tensor, phrases: List[str]) -> np.ndarray:
     h, w, _ = image_source.shape
     boxes = boxes * torch.Tensor([w, h, w, h])
@@ -126,13 +212,15 @@ class Model:
         self,
         model_config_path: str,
         model_checkpoint_path: str,
-        device: str = "cuda"
+        device: str = "cuda",
+        text_cache_size: int = 0
     ):
         self.model = load_model(
             model_config_path=model_config_path,
             model_checkpoint_path=model_checkpoint_path,
-            device=device
-        ).to(device)
+            device=device,
+            text_cache_size=text_cache_size
+        )
         self.device = device
 
     def predict_with_caption(
@@ -221,6 +309,53 @@ class Model:
         detections.class_id = class_id
         return detections
 
+    def predict_many(
+        self,
+        images: List[np.ndarray],
+        classes: List[str],
+        box_threshold: float,
+        text_threshold: float,
+        batch_size: int = 8
+    ) -> List[sv.Detections]:
+        """
+        Batched version of predict_with_classes, returns one sv.Detections per image.
+
+        import cv2
+
+        images = [cv2.imread(path) for path in IMAGE_PATHS]
+
+        model = Model(model_config_path=CONFIG_PATH, model_checkpoint_path=WEIGHTS_PATH)
+        detections_list = model.predict_many(
+            images=images,
+            classes=CLASSES,
+            box_threshold=BOX_THRESHOLD,
+            text_threshold=TEXT_THRESHOLD,
+            batch_size=8
+        )
+        """
+        caption = ". ".join(classes)
+        detections_list = []
+        for start in range(0, len(images), batch_size):
+            batch = images[start:start + batch_size]
+            processed_images = [Model.preprocess_image(image_bgr=image) for image in batch]
+            results = predict_batch(
+                model=self.model,
+                images=processed_images,
+                captions=caption,
+                box_threshold=box_threshold,
+                text_threshold=text_threshold,
+                device=self.device)
+            for image, (boxes, logits, phrases) in zip(batch, results):
+                source_h, source_w, _ = image.shape
+                detections = Model.post_process_result(
+                    source_h=source_h,
+                    source_w=source_w,
+                    boxes=boxes,
+                    logits=logits)
+                detections.class_id = Model.phrases2classes(phrases=phrases, classes=classes)
+                detections_list.append(detections)
+        return detections_list
+
     @staticmethod
     def preprocess_image(image_bgr: np.ndarray) -> torch.Tensor:
         transform = T.Compose(
@@ -0,0 +1,373 @@
+"""
+Local micro-batching inference server around groundingdino.util.inference.Model.
+
+Requests are accepted over a minimal HTTP/1.1 interface (TCP or Unix socket), queued in asyncio
+and coalesced into micro-batches. A batch only holds requests sharing the same caption and
+thresholds, and the model is built with a text feature cache (--text_cache_size), which runs the
+text branch once per distinct caption of a batch and not at all for cached ones. A batch is
+flushed once it reaches
+`max_batch` requests or once its oldest request waited `max_wait` seconds. Batches run one at a
+time in a dedicated worker thread, the event loop keeps accepting requests meanwhile.
+
+    POST /predict   {"image": <base64 encoded jpg/png>, "caption": "car . pedestrian .",
+                     "box_threshold": 0.35, "text_threshold": 0.25, "timeout": 5.0}
+                    -> {"boxes": [[x0, y0, x1, y1], ...], "scores": [...], "phrases": [...]}
+                    400 for malformed requests and undecodable images, 500 for inference failures
+    GET  /metrics   -> queue depth, batch statistics and p50/p95/p99 latencies (ms)
+
+Usage:
+    python -m groundingdino.util.inference_server -c CONFIG -p CHECKPOINT --port 8000
+    python -m groundingdino.util.inference_server -c CONFIG -p CHECKPOINT --unix_socket /tmp/gdino.sock
+"""
+import argparse
+import asyncio
+import base64
+import json
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from groundingdino.util.inference import Model, predict_batch
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+
+
+class LatencyStats:
+    """Keeps the last `window` latencies and reports percentiles in milliseconds."""
+
+    def __init__(self, window=10000):
+        self.values = deque(maxlen=window)
+
+    def update(self, seconds):
+        self.values.append(seconds * 1000.0)
+
+    def percentile(self, q):
+        if not self.values:
+            return 0.0
+        data = sorted(self.values)
+        idx = min(int(round(q / 100.0 * (len(data) - 1))), len(data) - 1)
+        return data[idx]
+
+    def summary(self):
+        return {
+            "count": len(self.values),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+class _Request:
+    __slots__ = ("image", "key", "arrival", "deadline", "future")
+
+    def __init__(self, image, key, arrival, deadline, future):
+        self.image = image
+        self.key = key
+        self.arrival = arrival
+        self.deadline = deadline
+        self.future = future
+
+
+class MicroBatchingServer:
+    """
+    Args:
+        model (Model): loaded model, only ever used from the worker thread.
+        max_batch (int): maximal number of images per forward pass.
+        max_wait (float): maximal time in seconds a request waits for its batch to fill up.
+        max_queue (int): maximal number of queued requests, new requests are rejected with 503 beyond it.
+        default_timeout (float): deadline in seconds of requests that do not specify one.
+    """
+
+    def __init__(self, model, max_batch=8, max_wait=0.01, max_queue=256, default_timeout=30.0):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.default_timeout = default_timeout
+
+        self._pending = OrderedDict()  # (caption, box_threshold, text_threshold) -> [_Request]
+        self._num_pending = 0
+        self._wakeup = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gdino-worker")
+
+        self.latency = LatencyStats()
+        self.inference_latency = LatencyStats()
+        self.counters = {"served": 0, "rejected": 0, "expired": 0, "failed": 0, "batches": 0, "batched_images": 0}
+
+    # ------------------------------------------------------------------
+    # queueing
+    # ------------------------------------------------------------------
+    async def submit(self, image_bytes, caption, box_threshold, text_threshold, timeout=None):
+        loop = asyncio.get_running_loop()
+        if self._num_pending >= self.max_queue:
+            self.counters["rejected"] += 1
+            raise OverflowError("queue is full")
+
+        now = loop.time()
+        timeout = self.default_timeout if timeout is None else timeout
+        key = (caption, float(box_threshold), float(text_threshold))
+        request = _Request(image_bytes, key, now, now + timeout, loop.create_future())
+        self._pending.setdefault(key, []).append(request)
+        self._num_pending += 1
+        self._wakeup.set()
+
+        try:
+            result = await asyncio.wait_for(asyncio.shield(request.future), timeout)
+        except asyncio.TimeoutError:
+            self.counters["expired"] += 1
+            request.future.cancel()
+            raise
+        self.latency.update(loop.time() - now)
+        return result
+
+    def _drop_expired(self, now):
+        for key in list(self._pending):
+            group = self._pending[key]
+            alive = [r for r in group if not r.future.done() and r.deadline > now]
+            self._num_pending -= len(group) - len(alive)
+            if alive:
+                self._pending[key] = alive
+            else:
+                del self._pending[key]
+
+    def _pop_ready_batch(self, now):
+        """Return the ready group holding the oldest request, a group is ready when full or timed out."""
+        self._drop_expired(now)
+        ready_key = None
+        for key, group in self._pending.items():
+            if len(group) >= self.max_batch or now - group[0].arrival >= self.max_wait:
+                if ready_key is None or group[0].arrival < self._pending[ready_key][0].arrival:
+                    ready_key = key
+        if ready_key is None:
+            return None
+        group = self._pending[ready_key]
+        batch, rest = group[: self.max_batch], group[self.max_batch :]
+        if rest:
+            self._pending[ready_key] = rest
+        else:
+            del self._pending[ready_key]
+        self._num_pending -= len(batch)
+        return ready_key, batch
+
+    def _next_flush_delay(self, now):
+        if not self._pending:
+            return None
+        oldest = min(group[0].arrival for group in self._pending.values())
+        return max(oldest + self.max_wait - now, 0.0)
+
+    async def _batching_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            ready = self._pop_ready_batch(loop.time())
+            if ready is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self._next_flush_delay(loop.time()))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            key, batch = ready
+            start = loop.time()
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self._infer, key, [r.image for r in batch]
+                )
+            except Exception as e:
+                # a failure of the model (CUDA OOM, RuntimeError, ...), not of the requests, even when
+                # it raises a ValueError
+                self.counters["failed"] += len(batch)
+                error = RuntimeError("inference failed: {}: {}".format(type(e).__name__, e))
+                for r in batch:
+                    if not r.future.done():
+                        r.future.set_exception(error)
+                continue
+            self.inference_latency.update(loop.time() - start)
+            self.counters["batches"] += 1
+            self.counters["batched_images"] += len(batch)
+            for r, res in zip(batch, results):
+                if r.future.done():
+                    continue
+                if isinstance(res, Exception):
+                    self.counters["failed"] += 1
+                    r.future.set_exception(res)
+                else:
+                    self.counters["served"] += 1
+                    r.future.set_result(res)
+
+    # ------------------------------------------------------------------
+    # worker thread
+    # ------------------------------------------------------------------
+    def _infer(self, key, images):
+        caption, box_threshold, text_threshold = key
+        results = [None] * len(images)
+        decoded = []
+        for i, image_bytes in enumerate(images):
+            image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                results[i] = ValueError("cannot decode image")
+            else:
+                decoded.append((i, image))
+        if not decoded:
+            return results
+
+        processed = [Model.preprocess_image(image_bgr=image) for _, image in decoded]
+        predictions = predict_batch(
+            model=self.model.model,
+            images=processed,
+            captions=caption,
+            box_threshold=box_threshold,
+            text_threshold=text_threshold,
+            device=self.model.device,
+        )
+        for (i, image), (boxes, logits, phrases) in zip(decoded, predictions):
+            source_h, source_w, _ = image.shape
+            detections = Model.post_process_result(
+                source_h=source_h, source_w=source_w, boxes=boxes, logits=logits
+            )
+            results[i] = {
+                "boxes": detections.xyxy.tolist(),
+                "scores": detections.confidence.tolist(),
+                "phrases": phrases,
+            }
+        return results
+
+    # ------------------------------------------------------------------
+    # http
+    # ------------------------------------------------------------------
+    def metrics(self):
+        batches = self.counters["batches"]
+        return {
+            "queue_depth": self._num_pending,
+            "pending_groups": len(self._pending),
+            "mean_batch_size": self.counters["batched_images"] / batches if batches else 0.0,
+            "latency_ms": self.latency.summary(),
+            "inference_latency_ms": self.inference_latency.summary(),
+            **self.counters,
+        }
+
+    async def _route(self, method, path, body):
+        if method == "GET" and path == "/metrics":
+            return 200, self.metrics()
+        if method != "POST" or path != "/predict":
+            return 404, {"error": "unknown route {} {}".format(method, path)}
+
+        try:
+            payload = json.loads(body)
+            image_bytes = base64.b64decode(payload["image"])
+            caption = payload["caption"]
+        except Exception as e:
+            return 400, {"error": "invalid request: {}".format(e)}
+
+        try:
+            result = await self.submit(
+                image_bytes,
+                caption,
+                payload.get("box_threshold", 0.35),
+                payload.get("text_threshold", 0.25),
+                payload.get("timeout", None),
+            )
+        except OverflowError as e:
+            return 503, {"error": str(e)}
+        except asyncio.TimeoutError:
+            return 504, {"error": "deadline exceeded"}
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        except Exception as e:
+            return 500, {"error": str(e)}
+        return 200, result
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, value = line.decode("latin-1").split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            status, payload = await self._route(method, path, body)
+        except Exception as e:
+            status, payload = 400, {"error": str(e)}
+
+        data = json.dumps(payload).encode("utf-8")
+        head = (
+            "HTTP/1.1 {} {}\r\n"
+            "Content-Type: application/json\r\n"
+            "Content-Length: {}\r\n"
+            "Connection: close\r\n\r\n"
+        ).format(status, HTTP_REASONS.get(status, ""), len(data))
+        writer.write(head.encode("latin-1") + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000, unix_socket=None):
+        self._wakeup = asyncio.Event()
+        if unix_socket:
+            server = await asyncio.start_unix_server(self._handle_connection, path=unix_socket)
+            print("Serving on unix socket {}".format(unix_socket))
+        else:
+            server = await asyncio.start_server(self._handle_connection, host, port)
+            print("Serving on http://{}:{}".format(host, port))
+        batching_task = asyncio.ensure_future(self._batching_loop())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batching_task.cancel()
+            self._executor.shutdown(wait=False)
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Grounding DINO micro-batching inference server", add_help=True)
+    parser.add_argument("--config_file", "-c", type=str, required=True, help="path to config file")
+    parser.add_argument("--checkpoint_path", "-p", type=str, required=True, help="path to checkpoint file")
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix_socket", type=str, default=None, help="serve on a unix socket instead of tcp")
+    parser.add_argument("--max_batch", type=int, default=8)
+    parser.add_argument("--max_wait_ms", type=float, default=10.0)
+    parser.add_argument("--max_queue", type=int, default=256)
+    parser.add_argument("--timeout", type=float, default=30.0, help="default request deadline in seconds")
+    parser.add_argument(
+        "--text_cache_size", type=int, default=64, help="number of captions whose text features are cached"
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_args_parser().parse_args()
+    model = Model(
+        model_config_path=args.config_file,
+        model_checkpoint_path=args.checkpoint_path,
+        device=args.device,
+        text_cache_size=args.text_cache_size,
+    )
+    server = MicroBatchingServer(
+        model,
+        max_batch=args.max_batch,
+        max_wait=args.max_wait_ms / 1000.0,
+        max_queue=args.max_queue,
+        default_timeout=args.timeout,
+    )
+    start = time.time()
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        print("Stopped after {:.0f}s: {}".format(time.time() - start, json.dumps(server.metrics())))
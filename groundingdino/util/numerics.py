@@ -0,0 +1,94 @@
+"""
+NaN/Inf monitoring of intermediate tensors without a device to host sync per check.
+
+Modules call ``check(name, tensor)`` on their outputs, the training loop brackets every step with
+``begin_step()`` and ``report()``:
+
+    numerics.begin_step()
+    outputs = model(samples, captions=captions)
+    ...
+    if numerics.active:
+        metric_logger.update(**numerics.report())
+
+Modes:
+    - "off": check() is a no-op.
+    - "sampled": only the steps multiple of ``interval`` are checked.
+    - "deferred": every step is checked.
+Checked steps only count on device, the counts are copied to the host once, by report().
+In distributed runs report() sums the counts over the ranks, every rank must call it at the same
+steps and check the same names.
+"""
+from collections import OrderedDict
+
+import torch
+import torch.distributed as dist
+
+from groundingdino.util.misc import is_dist_avail_and_initialized
+
+NUMERICS_MODES = ("off", "sampled", "deferred")
+
+
+class NumericsMonitor:
+    """
+    Args:
+        mode (str): one of NUMERICS_MODES.
+        interval (int): steps between two checked steps in "sampled" mode.
+    """
+
+    def __init__(self, mode="off", interval=100):
+        assert mode in NUMERICS_MODES, "unknown numerics monitor mode {}, use one of {}".format(
+            mode, NUMERICS_MODES
+        )
+        assert interval > 0, "interval should be positive but {}".format(interval)
+        self.mode = mode
+        self.interval = interval
+        self.step = 0
+        self.active = False
+        self._counts = OrderedDict()  # name -> [num_nan, num_inf] on device
+
+    def begin_step(self):
+        """Start a step, checks are recorded until report() if the mode selects this step."""
+        self.step += 1
+        self._counts.clear()
+        self.active = self.mode == "deferred" or (
+            self.mode == "sampled" and self.step % self.interval == 0
+        )
+
+    def check(self, name, tensor):
+        if not self.active or tensor is None:
+            return
+        tensor = tensor.detach()
+        counts = torch.stack((tensor.isnan().sum(), tensor.isinf().sum()))
+        if name in self._counts:
+            self._counts[name] = self._counts[name] + counts
+        else:
+            self._counts[name] = counts
+
+    def report(self):
+        """Counts of the current step summed over the ranks, copied to the host at once, and end of
+        the step.
+
+        Returns a dict with the total numerics_nan / numerics_inf counts, plus nan_<name> / inf_<name>
+        for every checked tensor holding some. The counts being reduced, every rank returns the same
+        keys, which keeps the meters of the metric logger in sync.
+        """
+        self.active = False
+        if not self._counts:
+            return {}
+        names = list(self._counts.keys())
+        counts = torch.stack([self._counts[name] for name in names])
+        if is_dist_avail_and_initialized():
+            dist.all_reduce(counts)
+        counts = counts.tolist()
+        self._counts.clear()
+
+        stats = {
+            "numerics_nan": sum(num_nan for num_nan, _ in counts),
+            "numerics_inf": sum(num_inf for _, num_inf in counts),
+        }
+        for name, (num_nan, num_inf) in zip(names, counts):
+            if num_nan > 0:
+                stats["nan_" + name] = num_nan
+            if num_inf > 0:
+                stats["inf_" + name] = num_inf
+        return stats
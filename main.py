@@ -19,6 +19,7 @@ import util.misc as utils
 
 import datasets
 from datasets import build_dataset, get_coco_api_from_dataset
+from datasets.samplers import GroupedBatchSampler, get_image_sizes
 from engine import evaluate, train_one_epoch
 
 from groundingdino.util.utils import clean_state_dict
@@ -196,8 +197,17 @@ def main(args):
             sampler_train = torch.utils.data.RandomSampler(dataset_train)
 
     if not args.eval:
-        batch_sampler_train = torch.utils.data.BatchSampler(
-            sampler_train, args.batch_size, drop_last=True)
+        if getattr(args, "aspect_ratio_grouping", False):
+            # replaces sampler_train, shuffles and splits the batches between the ranks itself
+            batch_sampler_train = GroupedBatchSampler(
+                get_image_sizes(dataset_train), args.batch_size,
+                max_pixels=getattr(args, "batch_max_pixels", 0),
+                resize=(max(getattr(args, "data_aug_scales", [800])), getattr(args, "data_aug_max_size", 1333)),
+                seed=args.seed, drop_last=True)
+            sampler_train = batch_sampler_train
+        else:
+            batch_sampler_train = torch.utils.data.BatchSampler(
+                sampler_train, args.batch_size, drop_last=True)
         data_loader_train = DataLoader(dataset_train, batch_sampler=batch_sampler_train,
                                     collate_fn=utils.collate_fn, num_workers=args.num_workers)
 
@@ -279,8 +289,10 @@ def main(args):
 
     for epoch in range(args.start_epoch, args.epochs):
         epoch_start_time = time.time()
-        if args.distributed:
+        if args.distributed or isinstance(sampler_train, GroupedBatchSampler):
             sampler_train.set_epoch(epoch)
+        if isinstance(sampler_train, GroupedBatchSampler):
+            logger.info("epoch {} batches: {}".format(epoch, json.dumps(sampler_train.stats())))
 
         train_stats = train_one_epoch(
             model, criterion, data_loader_train, optimizer, device, epoch,
@@ -26,6 +26,7 @@ from torchvision.models._utils import IntermediateLayerGetter
 
 from groundingdino.util.misc import NestedTensor, clean_state_dict, is_main_process
 
+from .feature_cache import BackboneFeatureCache
 from .position_encoding import build_position_encoding
 from .swin_transformer import build_swin_transformer
 
@@ -144,20 +145,30 @@ class Backbone(BackboneBase):
 
 
 class Joiner(nn.Sequential):
-    def __init__(self, backbone, position_embedding):
+    def __init__(self, backbone, position_embedding, feature_cache=None):
         super().__init__(backbone, position_embedding)
+        # only used while no backbone parameter requires grad
+        self.feature_cache = feature_cache
 
-    def forward(self, tensor_list: NestedTensor):
-        xs = self[0](tensor_list)
+    def forward(self, tensor_list: NestedTensor, image_keys=None):
+        if self.feature_cache is not None and not any(p.requires_grad for p in self[0].parameters()):
+            xs = self.feature_cache(self[0], tensor_list, len(self.num_channels), image_keys)
+        else:
+            xs = list(self[0](tensor_list).values())
         out: List[NestedTensor] = []
         pos = []
-        for name, x in xs.items():
+        for x in xs:
             out.append(x)
             # position encoding
             pos.append(self[1](x).to(x.tensors.dtype))
 
         return out, pos
 
+    def _load_from_state_dict(self, *args, **kwargs):
+        if self.feature_cache is not None:
+            self.feature_cache.invalidate()
+        super()._load_from_state_dict(*args, **kwargs)
+
 
 def build_backbone(args):
     """
@@ -168,6 +179,9 @@ def build_backbone(args):
         - return_interm_indices: available: [0,1,2,3], [1,2,3], [3]
         - backbone_freeze_keywords:
         - use_checkpoint: for swin only for now
+        - backbone_skip_padding: for swin only, compute the windows of batch padding only once per image
+        - backbone_feature_cache: directory caching the features of the backbone while it is frozen
+          and deterministic, keyed on the image_keys passed to forward
 
     """
     position_embedding = build_position_encoding(args)
@@ -202,6 +216,7 @@ def build_backbone(args):
             out_indices=tuple(return_interm_indices),
             dilation=False,
             use_checkpoint=use_checkpoint,
+            skip_padding=getattr(args, "backbone_skip_padding", False),
         )
 
         bb_num_channels = backbone.num_features[4 - len(return_interm_indices) :]
@@ -212,7 +227,13 @@ def build_backbone(args):
         return_interm_indices
     ), f"len(bb_num_channels) {len(bb_num_channels)} != len(return_interm_indices) {len(return_interm_indices)}"
 
-    model = Joiner(backbone, position_embedding)
+    feature_cache = None
+    if getattr(args, "backbone_feature_cache", None):
+        feature_cache = BackboneFeatureCache(
+            args.backbone_feature_cache, max_bytes=getattr(args, "backbone_feature_cache_max_bytes", 0)
+        )
+
+    model = Joiner(backbone, position_embedding, feature_cache=feature_cache)
     model.num_channels = bb_num_channels
     assert isinstance(
         bb_num_channels, List
@@ -0,0 +1,195 @@
+# ------------------------------------------------------------------------
+# Grounding DINO
+# url: https://github.com/IDEA-Research/GroundingDINO
+# Copyright (c) 2023 IDEA. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+On-disk cache of the features of a frozen backbone.
+"""
+
+import hashlib
+import os
+import time
+import warnings
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from groundingdino.util.misc import NestedTensor
+
+
+class BackboneFeatureCache:
+    """Multi-level features of a frozen backbone per image, memory-mapped from a directory.
+
+    Images are identified by the keys the caller passes, the dataset image_id and the recorded
+    parameters of its geometric transforms (see datasets.transforms.image_key), together with the
+    padded batch size, the input dtype and autocast. Features are only cached and served while the
+    backbone is deterministic, in eval mode or without active dropout, drop path or batch
+    statistics, so a served entry equals what the backbone computes for the same padded input.
+    Missing images go through the backbone together, with the batch padding, in the current mode.
+    Their features are saved in their dtype as .npy files, one per level, and loaded memory-mapped.
+    Files are written atomically, so several processes (distributed ranks, successive runs) can
+    share a directory. Entries live in a subdirectory named after a signature of the backbone
+    weights, ``invalidate`` recomputes it.
+
+    Args:
+        root (str): cache directory.
+        max_bytes (int): no entry is added once the directory holds this many bytes on disk,
+            rescanned every ``rescan_seconds`` and counting this process' writes in between.
+            0 disables the limit.
+    """
+
+    rescan_seconds = 30
+
+    def __init__(self, root, max_bytes=0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.nbytes = 0
+        self._directory = None
+        self._scanned = 0.0
+        self._warned_bypass = False
+
+    def invalidate(self):
+        self._directory = None
+
+    @staticmethod
+    def weights_signature(backbone):
+        tensors = list(backbone.state_dict().items())
+        sums = torch.stack([v.detach().double().sum() for _, v in tensors]).tolist()
+        h = hashlib.sha1()
+        for (name, v), s in zip(tensors, sums):
+            h.update("{}{}{}".format(name, tuple(v.shape), float(s).hex()).encode())
+        return h.hexdigest()[:16]
+
+    def directory(self, backbone):
+        if self._directory is None:
+            self._directory = os.path.join(self.root, self.weights_signature(backbone))
+            os.makedirs(self._directory, exist_ok=True)
+            self._scan()
+        return self._directory
+
+    def _scan(self):
+        self.nbytes = sum(e.stat().st_size for e in os.scandir(self._directory) if e.is_file())
+        self._scanned = time.monotonic()
+
+    @staticmethod
+    def is_deterministic(backbone):
+        """False if the backbone samples dropout or drop path, or uses batch statistics."""
+        if not backbone.training:
+            return True
+        for m in backbone.modules():
+            if not m.training:
+                continue
+            if isinstance(m, nn.modules.batchnorm._BatchNorm):
+                return False
+            if isinstance(m, nn.modules.dropout._DropoutNd) and m.p > 0:
+                return False
+            if getattr(m, "drop_prob", 0) > 0:
+                return False
+        return True
+
+    @staticmethod
+    def entry_name(key, samples):
+        """sha1 of an image key and of what else the features depend on."""
+        inputs = (tuple(samples.shape[-2:]), str(samples.dtype), torch.is_autocast_enabled())
+        return hashlib.sha1(repr((key,) + inputs).encode()).hexdigest()
+
+    @staticmethod
+    def _path(directory, name, level):
+        return os.path.join(directory, "{}_{}.npy".format(name, level))
+
+    def _load(self, directory, name, num_levels, device):
+        # level 0 is written last, its file marks a complete entry
+        if not os.path.exists(self._path(directory, name, 0)):
+            return None
+        # copy-on-write mapping, torch does not wrap read-only arrays; nothing is read before the
+        # copy to the device, or the first use on cpu
+        return [
+            torch.from_numpy(np.load(self._path(directory, name, l), mmap_mode="c")).to(device)
+            for l in range(num_levels)
+        ]
+
+    def _save(self, directory, name, levels):
+        if levels[0].dtype == torch.bfloat16:
+            # no numpy dtype
+            return
+        arrays = [f.detach().cpu().numpy() for f in levels]
+        nbytes = sum(a.nbytes for a in arrays)
+        if self.max_bytes > 0:
+            if self.nbytes + nbytes > self.max_bytes:
+                return
+            if time.monotonic() - self._scanned > self.rescan_seconds:
+                # other processes may write to the same directory
+                self._scan()
+                if self.nbytes + nbytes > self.max_bytes:
+                    return
+        for l in reversed(range(len(arrays))):
+            path = self._path(directory, name, l)
+            tmp = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp, "wb") as f:
+                np.save(f, arrays[l])
+            os.replace(tmp, path)
+        self.nbytes += nbytes
+
+    @torch.no_grad()
+    def __call__(self, backbone, tensor_list: NestedTensor, num_levels, image_keys=None):
+        """Features of backbone(tensor_list) as a list of NestedTensor.
+
+        image_keys holds a hashable per image, or None for an image not to cache. Without keys, or
+        while the backbone is not deterministic, the backbone runs on the whole batch.
+        """
+        samples, mask = tensor_list.decompose()
+        if image_keys is None or not self.is_deterministic(backbone):
+            if image_keys is not None:
+                self.bypassed += len(samples)
+                if not self._warned_bypass:
+                    self._warned_bypass = True
+                    warnings.warn(
+                        "backbone_feature_cache is bypassed while the frozen backbone is in train "
+                        "mode with dropout, drop path or batch statistics"
+                    )
+            return list(backbone(tensor_list).values())
+
+        directory = self.directory(backbone)
+        names = [None if k is None else self.entry_name(k, samples) for k in image_keys]
+        features = [
+            None if name is None else self._load(directory, name, num_levels, samples.device)
+            for name in names
+        ]
+        missing = [i for i, f in enumerate(features) if f is None]
+        self.misses += len(missing)
+        self.hits += len(features) - len(missing)
+        if len(missing) == len(features):
+            out = list(backbone(tensor_list).values())
+        elif missing:
+            out = list(backbone(NestedTensor(samples[missing], mask[missing])).values())
+        for j, i in enumerate(missing):
+            features[i] = [o.tensors[j] for o in out]
+            if names[i] is not None:
+                self._save(directory, names[i], features[i])
+        if len(missing) == len(features):
+            return out
+
+        outs = []
+        for l in range(num_levels):
+            x = torch.stack([f[l] for f in features])
+            m = F.interpolate(mask[None].float(), size=x.shape[-2:]).to(torch.bool)[0]
+            outs.append(NestedTensor(x, m))
+        return outs
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
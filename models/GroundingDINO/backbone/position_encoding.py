@@ -26,6 +26,8 @@ from torch import nn
 
 from groundingdino.util.misc import NestedTensor
 
+from ..utils import ShapeCache
+
 
 class PositionEmbeddingSine(nn.Module):
     """
@@ -82,8 +84,18 @@ class PositionEmbeddingSineHW(nn.Module):
     """
 
     def __init__(
-        self, num_pos_feats=64, temperatureH=10000, temperatureW=10000, normalize=False, scale=None
+        self,
+        num_pos_feats=64,
+        temperatureH=10000,
+        temperatureW=10000,
+        normalize=False,
+        scale=None,
+        cache_size=0,
     ):
+        """
+        Args:
+            cache_size: number of (h, w, device) embeddings of unpadded inputs kept, 0 disables the cache.
+        """
         super().__init__()
         self.num_pos_feats = num_pos_feats
         self.temperatureH = temperatureH
@@ -94,11 +106,66 @@ class PositionEmbeddingSineHW(nn.Module):
         if scale is None:
             scale = 2 * math.pi
         self.scale = scale
+        self.cache = ShapeCache(cache_size)
+
+    def _dim_t(self, temperature, device):
+        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=device)
+        return temperature ** (2 * (torch.div(dim_t, 2, rounding_mode='floor')) / self.num_pos_feats)
+
+    @staticmethod
+    def _sine(embed, dim_t):
+        """[..., n] -> [..., n, num_pos_feats], interleaved sin / cos."""
+        pos = embed[..., None] / dim_t
+        return torch.stack((pos[..., 0::2].sin(), pos[..., 1::2].cos()), dim=-1).flatten(-2)
+
+    def _forward_rectangles(self, valid_h, valid_w, h, w):
+        """Same result as forward for masks whose valid part is the top-left valid_h x valid_w rectangle.
+
+        The cumsums of such masks are separable, so the sines and cosines are only evaluated on h and w
+        1-D positions and broadcast, padded rows and columns get the embedding of position 0.
+        """
+        device = valid_h.device
+        valid_h = valid_h.float()[:, None]
+        valid_w = valid_w.float()[:, None]
+        y_embed = torch.minimum(torch.arange(1, h + 1, dtype=torch.float32, device=device)[None], valid_h)
+        x_embed = torch.minimum(torch.arange(1, w + 1, dtype=torch.float32, device=device)[None], valid_w)
+        if self.normalize:
+            eps = 1e-6
+            y_embed = y_embed / (valid_h + eps) * self.scale
+            x_embed = x_embed / (valid_w + eps) * self.scale
+
+        dim_tx = self._dim_t(self.temperatureW, device)
+        dim_ty = self._dim_t(self.temperatureH, device)
+        zero = torch.zeros(1, dtype=torch.float32, device=device)
+        rows_valid = torch.arange(h, device=device)[None] < valid_h  # bs, h
+        cols_valid = torch.arange(w, device=device)[None] < valid_w  # bs, w
+        pos_y = torch.where(
+            cols_valid[:, None, :, None], self._sine(y_embed, dim_ty)[:, :, None], self._sine(zero, dim_ty)
+        )
+        pos_x = torch.where(
+            rows_valid[:, :, None, None], self._sine(x_embed, dim_tx)[:, None], self._sine(zero, dim_tx)
+        )
+        return torch.cat((pos_y, pos_x), dim=3).permute(0, 3, 1, 2)
 
     def forward(self, tensor_list: NestedTensor):
         x = tensor_list.tensors
         mask = tensor_list.mask
         assert mask is not None
+        bs, h, w = mask.shape
+        if not mask.any():
+            ones = torch.ones(1, dtype=torch.long, device=mask.device)
+            pos = self.cache.get(
+                (h, w, str(mask.device)), lambda: self._forward_rectangles(ones * h, ones * w, h, w)
+            )
+            return pos.expand(bs, -1, -1, -1)
+        valid_h = (~mask[:, :, 0]).sum(1)
+        valid_w = (~mask[:, 0, :]).sum(1)
+        rectangles = (torch.arange(h, device=mask.device)[None, :, None] >= valid_h[:, None, None]) | (
+            torch.arange(w, device=mask.device)[None, None, :] >= valid_w[:, None, None]
+        )
+        if torch.equal(rectangles, mask):
+            return self._forward_rectangles(valid_h, valid_w, h, w)
+
         not_mask = ~mask
         y_embed = not_mask.cumsum(1, dtype=torch.float32)
         x_embed = not_mask.cumsum(2, dtype=torch.float32)
@@ -177,6 +244,7 @@ def build_position_encoding(args):
             temperatureH=args.pe_temperatureH,
             temperatureW=args.pe_temperatureW,
             normalize=True,
+            cache_size=getattr(args, "shape_cache_size", 32),
         )
     elif args.position_embedding in ("v3", "learned"):
         position_embedding = PositionEmbeddingLearned(N_steps)
@@ -11,6 +11,8 @@
 # modified from https://github.com/SwinTransformer/Swin-Transformer-Object-Detection/blob/master/mmdet/models/backbones/swin_transformer.py
 # --------------------------------------------------------
 
+from collections import OrderedDict
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -58,6 +60,47 @@ def window_partition(x, window_size):
     return windows
 
 
+def downsample_padding_mask(padding_mask, stride=2, pad_value=True):
+    """
+    Args:
+        padding_mask: (B, H, W), True on padding
+        stride (int | tuple[int]): downsampling factor, the input is padded to a multiple of it with pad_value
+        pad_value (bool): whether the padding to a multiple of stride counts as padding
+    Returns:
+        padding_mask: (B, ceil(H / stride), ceil(W / stride)), a token is padding if all its source tokens are
+    """
+    stride = to_2tuple(stride)
+    H, W = padding_mask.shape[-2:]
+    valid = F.pad((~padding_mask).float(), (0, -W % stride[1], 0, -H % stride[0]), value=float(not pad_value))
+    return F.max_pool2d(valid[:, None], stride)[:, 0] == 0
+
+
+def padding_source(padding_mask):
+    """
+    Args:
+        padding_mask: (B, L), True on the padding tokens, which hold the same value within an image
+    Returns:
+        source: (B*L,) index of the token each token is computed as, the first padding token of its image
+            for the padding tokens, itself for the others
+    """
+    B, L = padding_mask.shape
+    index = torch.arange(B * L, device=padding_mask.device).view(B, L)
+    first = padding_mask.long().argmax(1) + index[:, 0]
+    return torch.where(padding_mask, first[:, None], index).view(-1)
+
+
+def source_index(source):
+    """Indices i with source[i] == i, the only rows to compute."""
+    return (source == torch.arange(source.shape[0], device=source.device)).nonzero().squeeze(1)
+
+
+def apply_to_sources(fn, x, source):
+    """fn(x) row-wise, only computed on the rows of x that are their own source and copied to the others."""
+    index = source_index(source)
+    y = fn(x[index])
+    return y.new_empty((x.shape[0],) + y.shape[1:]).index_copy(0, index, y)[source]
+
+
 def window_reverse(windows, window_size, H, W):
     """
     Args:
@@ -131,6 +174,40 @@ class WindowAttention(nn.Module):
         trunc_normal_(self.relative_position_bias_table, std=0.02)
         self.softmax = nn.Softmax(dim=-1)
 
+        # relative position bias materialized once while the table cannot change, see get_relative_position_bias
+        self._frozen_bias = None
+
+    def get_relative_position_bias(self):
+        """(nH, Wh*Ww, Wh*Ww) relative position bias.
+
+        Gathered from relative_position_bias_table on every call in training or when the table needs
+        gradient, otherwise gathered once and reused. The frozen bias is dropped by train() and by
+        load_state_dict, in-place updates of the table outside of them are not seen.
+        """
+        table = self.relative_position_bias_table
+        frozen = not self.training and not (torch.is_grad_enabled() and table.requires_grad)
+        cached = self._frozen_bias
+        if frozen and cached is not None and cached.device == table.device and cached.dtype == table.dtype:
+            return cached
+
+        relative_position_bias = table[self.relative_position_index.view(-1)].view(
+            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1
+        )  # Wh*Ww,Wh*Ww,nH
+        relative_position_bias = relative_position_bias.permute(
+            2, 0, 1
+        ).contiguous()  # nH, Wh*Ww, Wh*Ww
+        if frozen:
+            self._frozen_bias = relative_position_bias.detach()
+        return relative_position_bias
+
+    def train(self, mode=True):
+        self._frozen_bias = None
+        return super(WindowAttention, self).train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._frozen_bias = None
+        super(WindowAttention, self)._load_from_state_dict(*args, **kwargs)
+
     def forward(self, x, mask=None):
         """Forward function.
         Args:
@@ -148,14 +225,7 @@ class WindowAttention(nn.Module):
         q = q * self.scale
         attn = q @ k.transpose(-2, -1)
 
-        relative_position_bias = self.relative_position_bias_table[
-            self.relative_position_index.view(-1)
-        ].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1
-        )  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(
-            2, 0, 1
-        ).contiguous()  # nH, Wh*Ww, Wh*Ww
+        relative_position_bias = self.get_relative_position_bias()  # nH, Wh*Ww, Wh*Ww
         attn = attn + relative_position_bias.unsqueeze(0)
 
         if mask is not None:
@@ -235,12 +305,14 @@ class SwinTransformerBlock(nn.Module):
         self.H = None
         self.W = None
 
-    def forward(self, x, mask_matrix):
+    def forward(self, x, mask_matrix, padding_windows=None):
         """Forward function.
         Args:
             x: Input feature, tensor size (B, H*W, C).
             H, W: Spatial resolution of the input feature.
             mask_matrix: Attention mask for cyclic shift.
+            padding_windows: None or the output of self.padding_windows. The windows of padding tokens only
+                are then computed once per image, see SwinTransformer skip_padding.
         """
         B, L, C = x.shape
         H, W = self.H, self.W
@@ -274,7 +346,11 @@ class SwinTransformerBlock(nn.Module):
         )  # nW*B, window_size*window_size, C
 
         # W-MSA/SW-MSA
-        attn_windows = self.attn(x_windows, mask=attn_mask)  # nW*B, window_size*window_size, C
+        if padding_windows is None:
+            attn_windows = self.attn(x_windows, mask=attn_mask)  # nW*B, window_size*window_size, C
+        else:
+            token_index, source, _ = padding_windows
+            attn_windows = self.attn_source_windows(x_windows, attn_mask, source)
 
         # merge windows
         attn_windows = attn_windows.view(-1, self.window_size, self.window_size, C)
@@ -293,10 +369,64 @@ class SwinTransformerBlock(nn.Module):
 
         # FFN
         x = shortcut + self.drop_path(x)
-        x = x + self.drop_path(self.mlp(self.norm2(x)))
+        if padding_windows is None:
+            x = x + self.drop_path(self.mlp(self.norm2(x)))
+        else:
+            # the tokens of a window of padding tokens take the outputs at the same position of its source
+            in_image = token_index >= 0
+            token_source = torch.arange(B * L, device=x.device)
+            token_source[token_index[in_image]] = token_index[source][in_image]
+            y = apply_to_sources(lambda t: self.mlp(self.norm2(t)), x.view(-1, C), token_source)
+            x = x + self.drop_path(y.view(B, L, C))
 
         return x
 
+    def padding_windows(self, padding_mask, Hp, Wp):
+        """Windows made of padding tokens only, whose tokens hold the same value within an image.
+
+        All such windows of an image have the same outputs, up to float rounding, and they are only computed
+        for the first of them. The padding to multiples of window size holds zeros after norm1, it is not a
+        padding token.
+
+        Args:
+            padding_mask: (B, H, W), True on the padding tokens
+            Hp, Wp: resolution padded to multiples of window size
+        Returns:
+            token_index: (nW*B, window_size*window_size), index among the B*H*W tokens of the token at each
+                position of the (shifted) windows, -1 on the padding to multiples of window size
+            source: (nW*B,) index of the window each window is computed as
+            padding_mask: (B, H, W), the padding tokens after the block, the tokens of windows of padding only
+        """
+        B, H, W = padding_mask.shape
+        N = self.window_size * self.window_size
+        token_index = torch.arange(B * H * W, device=padding_mask.device).view(B, H, W)
+        token_index = F.pad(token_index, (0, Wp - W, 0, Hp - H), value=-1)
+        if self.shift_size > 0:
+            token_index = torch.roll(token_index, shifts=(-self.shift_size, -self.shift_size), dims=(1, 2))
+        token_index = window_partition(token_index[..., None], self.window_size).view(-1, N)
+
+        in_image = token_index >= 0
+        padding_window = (padding_mask.view(-1)[token_index.clamp(min=0)] & in_image).all(1)
+        source = padding_source(padding_window.view(B, -1))
+        next_padding_mask = torch.zeros_like(padding_mask).view(-1)
+        next_padding_mask[token_index[in_image]] = padding_window[:, None].expand(-1, N)[in_image]
+        return token_index, source, next_padding_mask.view(B, H, W)
+
+    def attn_source_windows(self, x_windows, attn_mask, source):
+        """self.attn(x_windows, attn_mask) only computed on the windows that are their own source.
+
+        Args:
+            x_windows: (nW*B, window_size*window_size, C)
+            attn_mask: None or (nW, window_size*window_size, window_size*window_size) shift mask
+            source: (nW*B,) see padding_windows
+        """
+        index = source_index(source)
+        mask = None if attn_mask is None else attn_mask[index % attn_mask.shape[0]]
+        attn_windows = self.attn(x_windows[index], mask=mask)
+        return attn_windows.new_empty((x_windows.shape[0],) + attn_windows.shape[1:]).index_copy(
+            0, index, attn_windows
+        )[source]
+
 
 class PatchMerging(nn.Module):
     """Patch Merging Layer
@@ -311,11 +441,13 @@ class PatchMerging(nn.Module):
         self.reduction = nn.Linear(4 * dim, 2 * dim, bias=False)
         self.norm = norm_layer(4 * dim)
 
-    def forward(self, x, H, W):
+    def forward(self, x, H, W, padding_mask=None):
         """Forward function.
         Args:
             x: Input feature, tensor size (B, H*W, C).
             H, W: Spatial resolution of the input feature.
+            padding_mask: None or (B, H, W), True on the padding tokens, the merged tokens of padding tokens
+                only are then computed once per image, see SwinTransformer skip_padding.
         """
         B, L, C = x.shape
         assert L == H * W, "input feature has wrong size"
@@ -334,6 +466,12 @@ class PatchMerging(nn.Module):
         x = torch.cat([x0, x1, x2, x3], -1)  # B H/2 W/2 4*C
         x = x.view(B, -1, 4 * C)  # B H/2*W/2 4*C
 
+        if padding_mask is not None:
+            # the padding to even sizes holds zeros, not padding tokens
+            source = padding_source(downsample_padding_mask(padding_mask, pad_value=False).view(B, -1))
+            y = apply_to_sources(lambda t: self.reduction(self.norm(t)), x.view(-1, 4 * C), source)
+            return y.view(B, -1, y.shape[-1])
+
         x = self.norm(x)
         x = self.reduction(x)
 
@@ -358,6 +496,8 @@ class BasicLayer(nn.Module):
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False.
     """
 
+    attn_mask_cache_size = 16
+
     def __init__(
         self,
         dim,
@@ -406,17 +546,20 @@ class BasicLayer(nn.Module):
         else:
             self.downsample = None
 
-    def forward(self, x, H, W):
-        """Forward function.
-        Args:
-            x: Input feature, tensor size (B, H*W, C).
-            H, W: Spatial resolution of the input feature.
+        # (Hp, Wp, device, dtype) -> SW-MSA attention mask, see get_attn_mask
+        self._attn_mask_cache = OrderedDict()
+
+    def get_attn_mask(self, Hp, Wp, device, dtype=torch.float32):
+        """(nW, window_size*window_size, window_size*window_size) attention mask of SW-MSA.
+
+        The mask only depends on the padded resolution, the last attn_mask_cache_size of them are cached.
         """
+        key = (Hp, Wp, device, dtype)
+        if key in self._attn_mask_cache:
+            self._attn_mask_cache.move_to_end(key)
+            return self._attn_mask_cache[key]
 
-        # calculate attention mask for SW-MSA
-        Hp = int(np.ceil(H / self.window_size)) * self.window_size
-        Wp = int(np.ceil(W / self.window_size)) * self.window_size
-        img_mask = torch.zeros((1, Hp, Wp, 1), device=x.device)  # 1 Hp Wp 1
+        img_mask = torch.zeros((1, Hp, Wp, 1), device=device, dtype=dtype)  # 1 Hp Wp 1
         h_slices = (
             slice(0, -self.window_size),
             slice(-self.window_size, -self.shift_size),
@@ -442,18 +585,50 @@ class BasicLayer(nn.Module):
             attn_mask == 0, float(0.0)
         )
 
+        self._attn_mask_cache[key] = attn_mask
+        while len(self._attn_mask_cache) > self.attn_mask_cache_size:
+            self._attn_mask_cache.popitem(last=False)
+        return attn_mask
+
+    def train(self, mode=True):
+        self._attn_mask_cache.clear()
+        return super(BasicLayer, self).train(mode)
+
+    def forward(self, x, H, W, padding_mask=None):
+        """Forward function.
+        Args:
+            x: Input feature, tensor size (B, H*W, C).
+            H, W: Spatial resolution of the input feature.
+            padding_mask: None or (B, H, W), True on the padding tokens, see SwinTransformer skip_padding.
+        Returns:
+            x, H, W: output of the blocks, x_down, Wh, Ww: output of downsample, and the padding mask of x_down
+        """
+
+        # calculate attention mask for SW-MSA
+        Hp = int(np.ceil(H / self.window_size)) * self.window_size
+        Wp = int(np.ceil(W / self.window_size)) * self.window_size
+        attn_mask = self.get_attn_mask(Hp, Wp, x.device)
+
         for blk in self.blocks:
             blk.H, blk.W = H, W
+            padding_windows = None
+            if padding_mask is not None:
+                padding_windows = blk.padding_windows(padding_mask, Hp, Wp)
+                padding_mask = padding_windows[2]
             if self.use_checkpoint:
-                x = checkpoint.checkpoint(blk, x, attn_mask)
+                x = checkpoint.checkpoint(blk, x, attn_mask, padding_windows)
             else:
-                x = blk(x, attn_mask)
+                x = blk(x, attn_mask, padding_windows)
         if self.downsample is not None:
-            x_down = self.downsample(x, H, W)
+            if padding_mask is not None:
+                x_down = self.downsample(x, H, W, padding_mask)
+                padding_mask = downsample_padding_mask(padding_mask, pad_value=False)
+            else:
+                x_down = self.downsample(x, H, W)
             Wh, Ww = (H + 1) // 2, (W + 1) // 2
-            return x, H, W, x_down, Wh, Ww
+            return x, H, W, x_down, Wh, Ww, padding_mask
         else:
-            return x, H, W, x, H, W
+            return x, H, W, x, H, W, padding_mask
 
 
 class PatchEmbed(nn.Module):
@@ -525,6 +700,9 @@ class SwinTransformer(nn.Module):
             -1 means not freezing any parameters.
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False.
         dilation (bool): if True, the output size if 16x downsample, ow 32x downsample.
+        skip_padding (bool): If True, forward computes the windows and the merged tokens made of batch padding
+            only once per image: their tokens hold the same value, so they have the same outputs. The outputs
+            are those of the default forward up to float rounding. Off in training with dropout. Default: False.
     """
 
     def __init__(
@@ -549,6 +727,7 @@ class SwinTransformer(nn.Module):
         frozen_stages=-1,
         dilation=False,
         use_checkpoint=False,
+        skip_padding=False,
     ):
         super().__init__()
 
@@ -560,6 +739,8 @@ class SwinTransformer(nn.Module):
         self.out_indices = out_indices
         self.frozen_stages = frozen_stages
         self.dilation = dilation
+        self.skip_padding = skip_padding
+        self.has_dropout = drop_rate > 0 or attn_drop_rate > 0
 
         # if use_checkpoint:
         #     print("use_checkpoint!!!!!!!!!!!!!!!!!!!!!!!!")
@@ -693,7 +874,7 @@ class SwinTransformer(nn.Module):
         outs = []
         for i in range(self.num_layers):
             layer = self.layers[i]
-            x_out, H, W, x, Wh, Ww = layer(x, Wh, Ww)
+            x_out, H, W, x, Wh, Ww, _ = layer(x, Wh, Ww)
             # import ipdb; ipdb.set_trace()
 
             if i in self.out_indices:
@@ -709,6 +890,21 @@ class SwinTransformer(nn.Module):
         #       torch.Size([2, 768, 64, 64]), torch.Size([2, 1536, 32, 32])]
         return tuple(outs)
 
+    def padding_tokens(self, x, mask, H, W):
+        """(B, H, W) mask of the patch tokens of batch padding that all hold the same value within an image.
+
+        Patches of batch padding only, also counting the zero padding of patch_embed, are padding tokens if
+        their embedding equals the first of them, which fails e.g. with the absolute position embedding.
+        Returns None if there are none.
+        """
+        if mask is None or not mask.any():
+            return None
+        B, L, C = x.shape
+        candidate = downsample_padding_mask(mask, self.patch_embed.patch_size).view(B, L)
+        first = x[torch.arange(B, device=x.device), candidate.long().argmax(1)]
+        padding_mask = candidate & (x == first[:, None]).all(-1)
+        return padding_mask.view(B, H, W) if padding_mask.any() else None
+
     def forward(self, tensor_list: NestedTensor):
         x = tensor_list.tensors
 
@@ -726,10 +922,15 @@ class SwinTransformer(nn.Module):
             x = x.flatten(2).transpose(1, 2)
         x = self.pos_drop(x)
 
+        padding_mask = None
+        # dropout would make the padding tokens differ
+        if self.skip_padding and not (self.training and self.has_dropout):
+            padding_mask = self.padding_tokens(x, tensor_list.mask, Wh, Ww)
+
         outs = []
         for i in range(self.num_layers):
             layer = self.layers[i]
-            x_out, H, W, x, Wh, Ww = layer(x, Wh, Ww)
+            x_out, H, W, x, Wh, Ww, padding_mask = layer(x, Wh, Ww, padding_mask)
 
             if i in self.out_indices:
                 norm_layer = getattr(self, f"norm{i}")
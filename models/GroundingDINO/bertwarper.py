@@ -177,6 +177,38 @@ class TextEncoderShell(nn.Module):
         return self.text_encoder(**kw)
 
 
+def _special_token_segments(input_ids, special_tokens_list):
+    """Split each row of input_ids into the sub-sentences delimited by special tokens.
+
+    A sub-sentence spans the tokens after a special token up to and including the next special
+    token. Special tokens in the first or last column close no sub-sentence, so neither do the
+    tokens before a special token in the last column nor the trailing padding tokens.
+
+    Returns:
+        special_tokens_mask (torch.Tensor): bs, num_token. True for special tokens.
+        segment_ids (torch.Tensor): bs, num_token. Index of the sub-sentence of each token.
+        in_segment (torch.Tensor): bs, num_token. True for tokens of a closed sub-sentence.
+        previous_special (torch.Tensor): bs, num_token. Column of the last special token before
+            each token, 0 if there is none.
+    """
+    bs, num_token = input_ids.shape
+    special_tokens_mask = torch.zeros((bs, num_token), device=input_ids.device).bool()
+    for special_token in special_tokens_list:
+        special_tokens_mask |= input_ids == special_token
+
+    cols = torch.arange(num_token, device=input_ids.device).unsqueeze(0).expand(bs, -1)
+    # column of the special token closing the sub-sentence of each token, num_token if none
+    next_special = torch.where(special_tokens_mask, cols, torch.full_like(cols, num_token))
+    next_special = next_special.flip(-1).cummin(-1)[0].flip(-1)
+    # column of the last special token strictly before each token
+    last_special = torch.where(special_tokens_mask, cols, torch.zeros_like(cols)).cummax(-1)[0]
+    previous_special = F.pad(last_special[:, :-1], (1, 0), value=0)
+
+    segment_ids = special_tokens_mask.long().cumsum(-1) - special_tokens_mask.long()
+    in_segment = (next_special < num_token - 1) & (cols > 0)
+    return special_tokens_mask, segment_ids, in_segment, previous_special
+
+
 def generate_masks_with_special_tokens(tokenized, special_tokens_list, tokenizer):
     """Generate attention mask between each pair of special tokens
     Args:
@@ -187,32 +219,23 @@ def generate_masks_with_special_tokens(tokenized, special_tokens_list, tokenizer
     """
     input_ids = tokenized["input_ids"]
     bs, num_token = input_ids.shape
-    # special_tokens_mask: bs, num_token. 1 for special tokens. 0 for normal tokens
-    special_tokens_mask = torch.zeros((bs, num_token), device=input_ids.device).bool()
-    for special_token in special_tokens_list:
-        special_tokens_mask |= input_ids == special_token
-
-    # idxs: each row is a list of indices of special tokens
-    idxs = torch.nonzero(special_tokens_mask)
+    _, segment_ids, in_segment, previous_special = _special_token_segments(
+        input_ids, special_tokens_list
+    )
 
-    # generate attention mask and positional ids
+    # tokens attend to the tokens of their own sub-sentence, the others only to themselves
     attention_mask = (
-        torch.eye(num_token, device=input_ids.device).bool().unsqueeze(0).repeat(bs, 1, 1)
+        in_segment.unsqueeze(2)
+        & in_segment.unsqueeze(1)
+        & (segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1))
     )
-    position_ids = torch.zeros((bs, num_token), device=input_ids.device)
-    previous_col = 0
-    for i in range(idxs.shape[0]):
-        row, col = idxs[i]
-        if (col == 0) or (col == num_token - 1):
-            attention_mask[row, col, col] = True
-            position_ids[row, col] = 0
-        else:
-            attention_mask[row, previous_col + 1 : col + 1, previous_col + 1 : col + 1] = True
-            position_ids[row, previous_col + 1 : col + 1] = torch.arange(
-                0, col - previous_col, device=input_ids.device
-            )
+    attention_mask |= torch.eye(num_token, device=input_ids.device).bool().unsqueeze(0)
 
-        previous_col = col
+    # positional ids restart at 0 after each special token
+    cols = torch.arange(num_token, device=input_ids.device).unsqueeze(0)
+    position_ids = torch.where(
+        in_segment, cols - previous_special - 1, torch.zeros_like(previous_special)
+    )
 
     # # padding mask
     # padding_mask = tokenized['attention_mask']
@@ -231,40 +254,31 @@ def generate_masks_with_special_tokens_and_transfer_map(tokenized, special_token
     """
     input_ids = tokenized["input_ids"]
     bs, num_token = input_ids.shape
-    # special_tokens_mask: bs, num_token. 1 for special tokens. 0 for normal tokens
-    special_tokens_mask = torch.zeros((bs, num_token), device=input_ids.device).bool()
-    for special_token in special_tokens_list:
-        special_tokens_mask |= input_ids == special_token
-
-    # idxs: each row is a list of indices of special tokens
-    idxs = torch.nonzero(special_tokens_mask)
+    special_tokens_mask, segment_ids, in_segment, previous_special = _special_token_segments(
+        input_ids, special_tokens_list
+    )
 
-    # generate attention mask and positional ids
     attention_mask = (
-        torch.eye(num_token, device=input_ids.device).bool().unsqueeze(0).repeat(bs, 1, 1)
+        in_segment.unsqueeze(2)
+        & in_segment.unsqueeze(1)
+        & (segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1))
     )
-    position_ids = torch.zeros((bs, num_token), device=input_ids.device)
-    cate_to_token_mask_list = [[] for _ in range(bs)]
-    previous_col = 0
-    for i in range(idxs.shape[0]):
-        row, col = idxs[i]
-        if (col == 0) or (col == num_token - 1):
-            attention_mask[row, col, col] = True
-            position_ids[row, col] = 0
-        else:
-            attention_mask[row, previous_col + 1 : col + 1, previous_col + 1 : col + 1] = True
-            position_ids[row, previous_col + 1 : col + 1] = torch.arange(
-                0, col - previous_col, device=input_ids.device
-            )
-            c2t_maski = torch.zeros((num_token), device=input_ids.device).bool()
-            c2t_maski[previous_col + 1 : col] = True
-            cate_to_token_mask_list[row].append(c2t_maski)
-        previous_col = col
-
-    cate_to_token_mask_list = [
-        torch.stack(cate_to_token_mask_listi, dim=0)
-        for cate_to_token_mask_listi in cate_to_token_mask_list
-    ]
+    attention_mask |= torch.eye(num_token, device=input_ids.device).bool().unsqueeze(0)
+
+    cols = torch.arange(num_token, device=input_ids.device)
+    position_ids = torch.where(
+        in_segment, cols.unsqueeze(0) - previous_special - 1, torch.zeros_like(previous_special)
+    )
+
+    # one category per special token closing a sub-sentence, covering the tokens before it
+    closing = special_tokens_mask.clone()
+    closing[:, 0] = False
+    closing[:, -1] = False
+    rows, ends = torch.nonzero(closing, as_tuple=True)
+    starts = previous_special[rows, ends] + 1
+    c2t_masks = (cols.unsqueeze(0) >= starts.unsqueeze(1)) & (cols.unsqueeze(0) < ends.unsqueeze(1))
+    num_cates = closing.sum(-1).tolist()
+    cate_to_token_mask_list = list(torch.split(c2t_masks, num_cates, dim=0))
 
     # # padding mask
     # padding_mask = tokenized['attention_mask']
@@ -10,6 +10,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from timm.models.layers import DropPath
 
+from .utils import scaled_dot_product_attention, use_sdpa
+
 
 class FeatureResizer(nn.Module):
     """
@@ -97,7 +99,17 @@ def func_attention(query, context, smooth=1, raw_feature_norm="softmax", eps=1e-
 
 
 class BiMultiHeadAttention(nn.Module):
-    def __init__(self, v_dim, l_dim, embed_dim, num_heads, dropout=0.1, cfg=None):
+    def __init__(
+        self, v_dim, l_dim, embed_dim, num_heads, dropout=0.1, cfg=None, chunk_size=0, attn_backend="native"
+    ):
+        """
+        Args:
+            chunk_size: if > 0, process the image tokens chunk_size at a time instead of materializing
+                        the full [bs*nhead, n_img, n_text] attention weights, see _chunked_attention.
+            attn_backend: "native" or "sdpa", the latter computes both directions with
+                          F.scaled_dot_product_attention when available, see _sdpa_attention.
+                          It takes precedence over chunk_size.
+        """
         super(BiMultiHeadAttention, self).__init__()
 
         self.embed_dim = embed_dim
@@ -123,6 +135,8 @@ class BiMultiHeadAttention(nn.Module):
         self.stable_softmax_2d = True
         self.clamp_min_for_underflow = True
         self.clamp_max_for_overflow = True
+        self.chunk_size = chunk_size
+        self.attn_backend = attn_backend
 
         self._reset_parameters()
 
@@ -159,7 +173,11 @@ class BiMultiHeadAttention(nn.Module):
         #     import ipdb; ipdb.set_trace()
         bsz, tgt_len, _ = v.size()
 
-        query_states = self.v_proj(v) * self.scale
+        sdpa = use_sdpa(self.attn_backend)
+        query_states = self.v_proj(v)
+        if not sdpa:
+            # scaled_dot_product_attention applies the same 1/sqrt(head_dim) scale itself
+            query_states = query_states * self.scale
         key_states = self._shape(self.l_proj(l), -1, bsz)
         value_v_states = self._shape(self.values_v_proj(v), -1, bsz)
         value_l_states = self._shape(self.values_l_proj(l), -1, bsz)
@@ -171,6 +189,17 @@ class BiMultiHeadAttention(nn.Module):
         value_l_states = value_l_states.view(*proj_shape)
 
         src_len = key_states.size(1)
+        if sdpa:
+            attn_output_v, attn_output_l = self._sdpa_attention(
+                query_states, key_states, value_v_states, value_l_states, attention_mask_v, attention_mask_l
+            )
+            return self._output_proj(attn_output_v, attn_output_l, bsz, tgt_len, src_len)
+        if self.chunk_size > 0 and tgt_len > self.chunk_size:
+            attn_output_v, attn_output_l = self._chunked_attention(
+                query_states, key_states, value_v_states, value_l_states, attention_mask_v, attention_mask_l
+            )
+            return self._output_proj(attn_output_v, attn_output_l, bsz, tgt_len, src_len)
+
         attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))  # bs*nhead, nimg, ntxt
 
         if attn_weights.size() != (bsz * self.num_heads, tgt_len, src_len):
@@ -224,6 +253,112 @@ class BiMultiHeadAttention(nn.Module):
         attn_output_v = torch.bmm(attn_probs_v, value_l_states)
         attn_output_l = torch.bmm(attn_probs_l, value_v_states)
 
+        return self._output_proj(attn_output_v, attn_output_l, bsz, tgt_len, src_len)
+
+    def _clamp(self, attn_weights):
+        if self.clamp_min_for_underflow:
+            attn_weights = torch.clamp(attn_weights, min=-50000)
+        if self.clamp_max_for_overflow:
+            attn_weights = torch.clamp(attn_weights, max=50000)
+        return attn_weights
+
+    def _chunked_attention(
+        self, query_states, key_states, value_v_states, value_l_states, attention_mask_v=None, attention_mask_l=None
+    ):
+        """Same result as the dense path of forward, computed chunk_size image tokens at a time.
+
+        A first pass only gathers the maxima the dense path subtracts before its two softmaxes: the global
+        max, and per text token the max over all and over unmasked image tokens. As the clamps are monotonic
+        these maxima give the exact shifts of the dense path. The second pass recomputes the weights of each
+        chunk, finishes the vision direction and accumulates the exponentials and weighted values of the
+        language direction, normalized once all chunks are seen.
+        """
+        bh, tgt_len, _ = query_states.shape
+        src_len = key_states.size(1)
+        chunks = [(s, min(s + self.chunk_size, tgt_len)) for s in range(0, tgt_len, self.chunk_size)]
+        if attention_mask_v is not None:
+            attention_mask_v = (
+                attention_mask_v[:, None, :, None].repeat(1, self.num_heads, 1, 1).flatten(0, 1)
+            )  # bs*nhead, nimg, 1
+        if attention_mask_l is not None:
+            attention_mask_l = (
+                attention_mask_l[:, None, None, :].repeat(1, self.num_heads, 1, 1).flatten(0, 1)
+            )  # bs*nhead, 1, ntxt
+
+        # pass 1: softmax shifts, softmax is invariant to them so they need no gradient
+        with torch.no_grad():
+            col_max = col_max_valid = None
+            for s, e in chunks:
+                attn_weights = torch.bmm(query_states[:, s:e], key_states.transpose(1, 2))
+                chunk_max = attn_weights.max(1)[0]
+                col_max = chunk_max if col_max is None else torch.maximum(col_max, chunk_max)
+                if attention_mask_v is not None:
+                    attn_weights.masked_fill_(attention_mask_v[:, s:e], float("-inf"))
+                    chunk_max = attn_weights.max(1)[0]
+                    col_max_valid = chunk_max if col_max_valid is None else torch.maximum(col_max_valid, chunk_max)
+            global_max = col_max.max() if self.stable_softmax_2d else col_max.new_zeros(())
+            shift_l = self._clamp(col_max - global_max)  # bs*nhead, ntxt
+            if col_max_valid is not None:
+                shift_l_valid = self._clamp(self._clamp(col_max_valid - global_max) - shift_l)
+            else:
+                shift_l_valid = torch.zeros_like(shift_l)
+
+        # pass 2
+        attn_output_v = []
+        sum_exp_l = query_states.new_zeros((bh, src_len), dtype=torch.float32)
+        attn_output_l = query_states.new_zeros((bh, src_len, self.head_dim), dtype=torch.float32)
+        for s, e in chunks:
+            attn_weights = self._clamp(torch.bmm(query_states[:, s:e], key_states.transpose(1, 2)) - global_max)
+
+            # language for vision
+            attn_weights_l = self._clamp(attn_weights - shift_l[:, None, :])
+            if attention_mask_v is not None:
+                attn_weights_l = attn_weights_l.masked_fill(attention_mask_v[:, s:e], float("-inf"))
+            exp_l = torch.exp((attn_weights_l - shift_l_valid[:, None, :]).float())
+            sum_exp_l = sum_exp_l + exp_l.sum(1)
+            exp_l = F.dropout(exp_l, p=self.dropout, training=self.training)
+            attn_output_l = attn_output_l + torch.bmm(exp_l.transpose(1, 2), value_v_states[:, s:e].float())
+
+            # vision for language
+            if attention_mask_l is not None:
+                attn_weights = attn_weights.masked_fill(attention_mask_l, float("-inf"))
+            attn_probs_v = F.dropout(attn_weights.softmax(dim=-1), p=self.dropout, training=self.training)
+            attn_output_v.append(torch.bmm(attn_probs_v, value_l_states))
+
+        attn_output_v = torch.cat(attn_output_v, dim=1)
+        attn_output_l = (attn_output_l / sum_exp_l[..., None]).to(value_v_states.dtype)
+        return attn_output_v, attn_output_l
+
+    def _sdpa_attention(
+        self, query_states, key_states, value_v_states, value_l_states, attention_mask_v=None, attention_mask_l=None
+    ):
+        """The dense path of forward through F.scaled_dot_product_attention, query_states are not pre-scaled.
+
+        The image->text and text->image weights are the same products read along either axis, so each
+        direction is a plain masked attention. The max shifts of the dense path leave the softmaxes unchanged
+        and are dropped; its +-50000 clamps, meant for half precision, are dropped too since the fused kernels
+        accumulate in float32. Outputs only differ from the dense path when logits lie more than 50000 apart,
+        tests/test_sdpa.py checks half precision outputs against a float32 reference.
+        """
+        bh = query_states.shape[0]
+        bsz = bh // self.num_heads
+        heads = lambda x: x.view(bsz, self.num_heads, -1, self.head_dim)
+        query_states, key_states = heads(query_states), heads(key_states)
+        value_v_states, value_l_states = heads(value_v_states), heads(value_l_states)
+        dropout_p = self.dropout if self.training else 0.0
+
+        # scaled_dot_product_attention takes boolean masks as True = attend
+        mask_l = ~attention_mask_l[:, None, None, :] if attention_mask_l is not None else None
+        mask_v = ~attention_mask_v[:, None, None, :] if attention_mask_v is not None else None
+        attn_output_v = scaled_dot_product_attention(
+            query_states, key_states, value_l_states, attn_mask=mask_l, dropout_p=dropout_p
+        )
+        attn_output_l = scaled_dot_product_attention(
+            key_states, query_states, value_v_states, attn_mask=mask_v, dropout_p=dropout_p
+        )
+        return attn_output_v.reshape(bh, -1, self.head_dim), attn_output_l.reshape(bh, -1, self.head_dim)
+
+    def _output_proj(self, attn_output_v, attn_output_l, bsz, tgt_len, src_len):
         if attn_output_v.size() != (bsz * self.num_heads, tgt_len, self.head_dim):
             raise ValueError(
                 f"`attn_output_v` should be of size {(bsz, self.num_heads, tgt_len, self.head_dim)}, but is {attn_output_v.size()}"
@@ -260,6 +395,8 @@ class BiAttentionBlock(nn.Module):
         drop_path=0.0,
         init_values=1e-4,
         cfg=None,
+        chunk_size=0,
+        attn_backend="native",
     ):
         """
         Inputs:
@@ -268,6 +405,8 @@ class BiAttentionBlock(nn.Module):
                          (usually 2-4x larger than embed_dim)
             num_heads - Number of heads to use in the Multi-Head Attention block
             dropout - Amount of dropout to apply in the feed-forward network
+            chunk_size - Number of image tokens attended at a time, 0 for all at once
+            attn_backend - "native" or "sdpa" (F.scaled_dot_product_attention)
         """
         super(BiAttentionBlock, self).__init__()
 
@@ -275,7 +414,8 @@ class BiAttentionBlock(nn.Module):
         self.layer_norm_v = nn.LayerNorm(v_dim)
         self.layer_norm_l = nn.LayerNorm(l_dim)
         self.attn = BiMultiHeadAttention(
-            v_dim=v_dim, l_dim=l_dim, embed_dim=embed_dim, num_heads=num_heads, dropout=dropout
+            v_dim=v_dim, l_dim=l_dim, embed_dim=embed_dim, num_heads=num_heads, dropout=dropout,
+            chunk_size=chunk_size, attn_backend=attn_backend,
         )
 
         # add layer scale for training stability
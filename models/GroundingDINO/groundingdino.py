@@ -15,13 +15,14 @@
 # Copyright (c) 2020 SenseTime. All Rights Reserved.
 # ------------------------------------------------------------------------
 import copy
+from collections import OrderedDict
 from typing import List
 
 import torch
 import torch.nn.functional as F
 from torch import nn
-from torchvision.ops.boxes import nms
-from transformers import AutoTokenizer, BertModel, BertTokenizer, RobertaModel, RobertaTokenizerFast
+from torchvision.ops.boxes import batched_nms
+from transformers import AutoTokenizer, BatchEncoding, BertModel, BertTokenizer, RobertaModel, RobertaTokenizerFast
 
 from groundingdino.util import box_ops, get_tokenlizer
 from groundingdino.util.misc import (
@@ -44,8 +45,9 @@ from .bertwarper import (
     generate_masks_with_special_tokens,
     generate_masks_with_special_tokens_and_transfer_map,
 )
+from .text_cache import TextFeatureCache, collate_text_features
 from .transformer import build_transformer
-from .utils import MLP, ContrastiveEmbed, sigmoid_focal_loss
+from .utils import MLP, ContrastiveEmbed, pad_text_token_mask, sigmoid_focal_loss
 
 from .matcher import build_matcher
 
@@ -78,6 +80,12 @@ class GroundingDINO(nn.Module):
         text_encoder_type="bert-base-uncased",
         sub_sentence_present=True,
         max_text_len=256,
+        text_cache_size=0,
+        text_cache_max_bytes=0,
+        frozen_text_cache_size=0,
+        frozen_text_cache_max_bytes=0,
+        slim_eval_outputs=False,
+        pad_contrastive_logits=True,
     ):
         """Initializes the model.
         Parameters:
@@ -86,15 +94,26 @@ class GroundingDINO(nn.Module):
             num_queries: number of object queries, ie detection slot. This is the maximal number of objects
                          Conditional DETR can detect in a single image. For COCO, we recommend 100 queries.
             aux_loss: True if auxiliary decoding losses (loss at each decoder layer) are to be used.
+            text_cache_size: if > 0, cache the text features of up to this many captions in eval mode.
+            text_cache_max_bytes: optional byte budget of the text feature cache, 0 for no limit.
+            frozen_text_cache_size: if > 0 and the text encoder is frozen, cache its outputs for up to this
+                                    many sub-sentences, see encode_text_frozen.
+            frozen_text_cache_max_bytes: optional byte budget of the frozen text encoder cache, 0 for no limit.
+            slim_eval_outputs: in eval mode, only run the heads of the last decoder layer and return
+                               pred_logits and pred_boxes only. Can be overridden per call with slim_outputs=.
+            pad_contrastive_logits: pad the text logits of every head to max_text_len columns. If False,
+                                    the logits have one column per token of the batch captions.
         """
         super().__init__()
         self.num_queries = num_queries
         self.transformer = transformer
+        self.numerics = transformer.numerics  # see groundingdino.util.numerics
         self.hidden_dim = hidden_dim = transformer.d_model
         self.num_feature_levels = num_feature_levels
         self.nheads = nheads
         self.max_text_len = 256
         self.sub_sentence_present = sub_sentence_present
+        self.slim_eval_outputs = slim_eval_outputs
 
         # setting query dim
         self.query_dim = query_dim
@@ -122,6 +141,22 @@ class GroundingDINO(nn.Module):
         # special tokens
         self.specical_tokens = self.tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]", ".", "?"])
 
+        # per-caption text feature cache, used in eval mode only
+        if text_cache_size > 0 or text_cache_max_bytes > 0:
+            self.text_cache = TextFeatureCache(
+                max_entries=text_cache_size, max_bytes=text_cache_max_bytes
+            )
+        else:
+            self.text_cache = None
+
+        # per-sub-sentence BERT outputs, used whenever no BERT parameter requires grad
+        if frozen_text_cache_size > 0 or frozen_text_cache_max_bytes > 0:
+            self.frozen_text_cache = TextFeatureCache(
+                max_entries=frozen_text_cache_size, max_bytes=frozen_text_cache_max_bytes
+            )
+        else:
+            self.frozen_text_cache = None
+
         # prepare input projection layers
         if num_feature_levels > 1:
             num_backbone_outs = len(backbone.num_channels)
@@ -164,7 +199,7 @@ class GroundingDINO(nn.Module):
         # prepare pred layers
         self.dec_pred_bbox_embed_share = dec_pred_bbox_embed_share
         # prepare class & box embed
-        _class_embed = ContrastiveEmbed()
+        _class_embed = ContrastiveEmbed(max_text_len=self.max_text_len, pad_to_max_text_len=pad_contrastive_logits)
 
         _bbox_embed = MLP(hidden_dim, hidden_dim, 4, 3)
         nn.init.constant_(_bbox_embed.layers[-1].weight.data, 0)
@@ -213,31 +248,14 @@ class GroundingDINO(nn.Module):
     def init_ref_points(self, use_num_queries):
         self.refpoint_embed = nn.Embedding(use_num_queries, self.query_dim)
 
-    def forward(self, samples: NestedTensor, targets: List = None, **kw):
-        """The forward expects a NestedTensor, which consists of:
-           - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
-           - samples.mask: a binary mask of shape [batch_size x H x W], containing 1 on padded pixels
+    def encode_text(self, captions, device):
+        """Run the text branch (tokenizer, BERT and feat_map) on a list of captions.
 
-        It returns a dict with the following elements:
-           - "pred_logits": the classification logits (including no-object) for all queries.
-                            Shape= [batch_size x num_queries x num_classes]
-           - "pred_boxes": The normalized boxes coordinates for all queries, represented as
-                           (center_x, center_y, width, height). These values are normalized in [0, 1],
-                           relative to the size of each individual image (disregarding possible padding).
-                           See PostProcess for information on how to retrieve the unnormalized bounding box.
-           - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
-                            dictionnaries containing the two above keys for each decoder layer.
+        Returns the text_dict consumed by the transformer and the tokenized captions.
         """
-        if targets is None:
-            captions = kw["captions"]
-        else:
-            captions = [t["caption"] for t in targets]
-        # encoder texts
-
         tokenized = self.tokenizer(captions, padding="longest", return_tensors="pt").to(
-            samples.device
+            device
         )
-        one_hot_token = tokenized
 
         (
             text_self_attention_masks,
@@ -264,9 +282,15 @@ class GroundingDINO(nn.Module):
         else:
             tokenized_for_encoder = tokenized
 
-        bert_output = self.bert(**tokenized_for_encoder)  # bs, 195, 768
+        if self.frozen_text_cache is not None and self.text_encoder_frozen():
+            last_hidden_state = self.encode_text_frozen(
+                tokenized["input_ids"], position_ids, tokenized["attention_mask"]
+            )
+        else:
+            bert_output = self.bert(**tokenized_for_encoder)  # bs, 195, 768
+            last_hidden_state = bert_output["last_hidden_state"]
 
-        encoded_text = self.feat_map(bert_output["last_hidden_state"])  # bs, 195, d_model
+        encoded_text = self.feat_map(last_hidden_state)  # bs, 195, d_model
         text_token_mask = tokenized.attention_mask.bool()  # bs, 195
         # text_token_mask: True for nomask, False for mask
         # text_self_attention_masks: True for nomask, False for mask
@@ -286,10 +310,178 @@ class GroundingDINO(nn.Module):
             "text_self_attention_masks": text_self_attention_masks,  # bs, 195,195
         }
 
+        return text_dict, tokenized
+
+    @torch.no_grad()
+    def encode_text_cached(self, captions, device):
+        """Same as encode_text, but serves per-caption features from self.text_cache.
+
+        Only the captions missing from the cache go through BERT. The tokenizer still runs on
+        the whole batch as the tokenized captions are part of the model outputs.
+        """
+        tokenized = self.tokenizer(captions, padding="longest", return_tensors="pt").to(device)
+        if tokenized["input_ids"].shape[1] > self.max_text_len:
+            for k in ("input_ids", "attention_mask", "token_type_ids"):
+                tokenized[k] = tokenized[k][:, : self.max_text_len]
+
+        entries = {}
+        missing = []
+        for caption in captions:
+            if caption in entries or caption in missing:
+                continue
+            entry = self.text_cache.get(caption, device)
+            if entry is None:
+                missing.append(caption)
+            else:
+                entries[caption] = entry
+
+        if missing:
+            text_dict, _ = self.encode_text(missing, device)
+            for i, caption in enumerate(missing):
+                n = int(text_dict["text_token_mask"][i].sum())
+                entry = {
+                    "encoded_text": text_dict["encoded_text"][i, :n],
+                    "text_token_mask": text_dict["text_token_mask"][i, :n],
+                    "position_ids": text_dict["position_ids"][i, :n],
+                    "text_self_attention_masks": text_dict["text_self_attention_masks"][i, :n, :n],
+                }
+                self.text_cache.put(caption, device, entry)
+                entries[caption] = entry
+
+        text_dict = collate_text_features([entries[caption] for caption in captions])
+        return text_dict, tokenized
+
+    def text_encoder_frozen(self):
+        return not any(p.requires_grad for p in self.bert.parameters())
+
+    @torch.no_grad()
+    def encode_text_frozen(self, input_ids, position_ids, attention_mask):
+        """BERT last hidden states of tokenized captions, served from self.frozen_text_cache.
+
+        With sub_sentence_present, a token only attends to the tokens of its sub-sentence and the
+        position ids restart at 0 with every sub-sentence, so the outputs of a sub-sentence only
+        depend on its own token ids. Sub-sentences are the cache entries, which keeps hitting when
+        the dataset shuffles the phrases of the captions. Otherwise every caption is one entry and
+        its padding tokens get zero features, they are masked out downstream.
+
+        The missing entries go through BERT as one batch, in eval mode, so no dropout is applied.
+        Returns a bs, num_token, hidden_size tensor.
+        """
+        bs, num_token = input_ids.shape
+        device = input_ids.device
+        ids = input_ids.tolist()
+        if self.sub_sentence_present:
+            # a span starts at every position id 0 and covers the following tokens of its sub-sentence
+            starts = (position_ids == 0).tolist()
+        else:
+            lengths = attention_mask.sum(-1).tolist()
+
+        # contiguous spans tiling each caption, keyed by their token ids, None for padding
+        spans = []
+        for i in range(bs):
+            if self.sub_sentence_present:
+                bounds = [j for j in range(num_token) if starts[i][j]] + [num_token]
+                for start, end in zip(bounds[:-1], bounds[1:]):
+                    spans.append((end - start, tuple(ids[i][start:end])))
+            else:
+                n = lengths[i]
+                spans.append((n, tuple(ids[i][:n])))
+                if n < num_token:
+                    spans.append((num_token - n, None))
+
+        entries = {}
+        missing = {}
+        for _, key in spans:
+            if key is None or key in entries or key in missing:
+                continue
+            entry = self.frozen_text_cache.get(key, device)
+            if entry is None:
+                missing[key] = None
+            else:
+                entries[key] = entry["last_hidden_state"]
+
+        if missing:
+            missing = list(missing)
+            lengths = torch.tensor([len(key) for key in missing])
+            max_len = int(lengths.max())
+            missing_ids = torch.full(
+                (len(missing), max_len), self.tokenizer.pad_token_id, dtype=torch.long
+            )
+            for i, key in enumerate(missing):
+                missing_ids[i, : len(key)] = torch.tensor(key)
+            positions = torch.arange(max_len)
+            bert_training = self.bert.training
+            self.bert.eval()
+            try:
+                last_hidden_state = self.bert(
+                    input_ids=missing_ids.to(device),
+                    attention_mask=(positions[None] < lengths[:, None]).long().to(device),
+                    token_type_ids=torch.zeros_like(missing_ids).to(device),
+                    position_ids=positions.expand(len(missing), -1).to(device),
+                )["last_hidden_state"]
+            finally:
+                self.bert.train(bert_training)
+            for i, key in enumerate(missing):
+                entries[key] = last_hidden_state[i, : len(key)]
+                self.frozen_text_cache.put(key, device, {"last_hidden_state": entries[key]})
+
+        ref = next(iter(entries.values()))
+        pieces = [
+            entries[key] if key is not None else ref.new_zeros((n, ref.shape[-1]))
+            for n, key in spans
+        ]
+        return torch.cat(pieces).view(bs, num_token, -1)
+
+    def train(self, mode=True):
+        # cached text features are only valid for the weights they were computed with
+        if mode and self.text_cache is not None:
+            self.text_cache.invalidate()
+        return super().train(mode)
+
+    def load_state_dict(self, state_dict, strict=True):
+        if self.text_cache is not None:
+            self.text_cache.invalidate()
+        if self.frozen_text_cache is not None:
+            self.frozen_text_cache.invalidate()
+        return super().load_state_dict(state_dict, strict=strict)
+
+    def forward(self, samples: NestedTensor, targets: List = None, **kw):
+        """The forward expects a NestedTensor, which consists of:
+           - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
+           - samples.mask: a binary mask of shape [batch_size x H x W], containing 1 on padded pixels
+
+        It returns a dict with the following elements:
+           - "pred_logits": the classification logits (including no-object) for all queries.
+                            Shape= [batch_size x num_queries x num_classes]
+           - "pred_boxes": The normalized boxes coordinates for all queries, represented as
+                           (center_x, center_y, width, height). These values are normalized in [0, 1],
+                           relative to the size of each individual image (disregarding possible padding).
+                           See PostProcess for information on how to retrieve the unnormalized bounding box.
+           - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
+                            dictionnaries containing the two above keys for each decoder layer.
+
+        kw image_keys, one hashable per image or None (see datasets.transforms.image_key), lets the
+        backbone feature cache serve the features of images it has seen.
+
+        With slim outputs (kw slim_outputs=True, or slim_eval_outputs in eval mode) only the heads of the
+        last decoder layer run and only "pred_logits" and "pred_boxes" are returned.
+        """
+        slim_outputs = kw.get("slim_outputs", None)
+        if slim_outputs is None:
+            slim_outputs = self.slim_eval_outputs and not self.training
+        if targets is None:
+            captions = kw["captions"]
+        else:
+            captions = [t["caption"] for t in targets]
+        # encoder texts
+        if self.text_cache is not None and not self.training:
+            text_dict, one_hot_token = self.encode_text_cached(captions, samples.device)
+        else:
+            text_dict, one_hot_token = self.encode_text(captions, samples.device)
 
         if isinstance(samples, (list, torch.Tensor)):
             samples = nested_tensor_from_tensor_list(samples)
-        features, poss = self.backbone(samples)
+        features, poss = self.backbone(samples, image_keys=kw.get("image_keys"))
         srcs = []
         masks = []
         for l, feat in enumerate(features):
@@ -316,7 +508,13 @@ class GroundingDINO(nn.Module):
             srcs, masks, input_query_bbox, poss, input_query_label, attn_mask, text_dict
         )
 
-        
+        if slim_outputs:
+            # final layer heads only, nothing for the losses
+            last_lid = len(hs) - 1
+            outputs_coord = self.bbox_embed[last_lid](hs[last_lid]) + inverse_sigmoid(reference[last_lid])
+            outputs_class = self.class_embed[last_lid](hs[last_lid], text_dict)
+            return {"pred_logits": outputs_class, "pred_boxes": outputs_coord.sigmoid()}
+
         # deformable-detr-like anchor update
         outputs_coord_list = []
         for dec_lid, (layer_ref_sig, layer_bbox_embed, layer_hs) in enumerate(
@@ -339,14 +537,7 @@ class GroundingDINO(nn.Module):
         out = {"pred_logits": outputs_class[-1], "pred_boxes": outputs_coord_list[-1]}
 
         # Used to calculate losses
-        bs, len_td = text_dict['text_token_mask'].shape
-        out['text_mask']=torch.zeros(bs, self.max_text_len, dtype=torch.bool).to(
-            samples.device
-        )
-        for b in range(bs):
-            for j in range(len_td):
-                if text_dict['text_token_mask'][b][j] == True:
-                    out['text_mask'][b][j] = True
+        out['text_mask'] = pad_text_token_mask(text_dict['text_token_mask'], self.max_text_len)
 
         # for intermediate outputs
         if self.aux_loss:
@@ -405,13 +596,14 @@ class GroundingDINO(nn.Module):
 
 
 class SetCriterion(nn.Module):
-    def __init__(self, matcher, weight_dict, focal_alpha,focal_gamma, losses):
+    def __init__(self, matcher, weight_dict, focal_alpha,focal_gamma, losses, positive_map_cache_size=1024):
         """ Create the criterion.
         Parameters:
             matcher: module able to compute a matching between targets and proposals
             weight_dict: dict containing as key the names of the losses and as values their relative weight.
             losses: list of all the losses to be applied. See get_loss for list of available losses.
             focal_alpha: alpha in Focal Loss
+            positive_map_cache_size: number of (caption, cat_list) label maps kept across steps. 0 disables the cache.
         """
         super().__init__()
         self.matcher = matcher
@@ -419,6 +611,18 @@ class SetCriterion(nn.Module):
         self.losses = losses
         self.focal_alpha = focal_alpha
         self.focal_gamma= focal_gamma
+        self.positive_map_cache = PositiveMapCache(positive_map_cache_size) if positive_map_cache_size > 0 else None
+
+    def get_label_map(self, tokenized, cat_list, caption):
+        """[len(cat_list), 256] positive map of every label of a caption, shared across steps."""
+        if self.positive_map_cache is None:
+            return create_positive_map_batched(tokenized, cat_list, caption)
+        key = (caption, tuple(cat_list))
+        label_map = self.positive_map_cache.get(key)
+        if label_map is None:
+            label_map = create_positive_map_batched(tokenized, cat_list, caption)
+            self.positive_map_cache.put(key, label_map)
+        return label_map
 
     @torch.no_grad()
     def loss_cardinality(self, outputs, targets, indices, num_boxes):
@@ -450,9 +654,9 @@ class SetCriterion(nn.Module):
         losses = {}
         losses['loss_bbox'] = loss_bbox.sum() / num_boxes
 
-        loss_giou = 1 - torch.diag(box_ops.generalized_box_iou(
+        loss_giou = 1 - box_ops.generalized_box_iou_pairwise(
             box_ops.box_cxcywh_to_xyxy(src_boxes),
-            box_ops.box_cxcywh_to_xyxy(target_boxes)))
+            box_ops.box_cxcywh_to_xyxy(target_boxes))
         losses['loss_giou'] = loss_giou.sum() / num_boxes
 
         # calculate the x,y and h,w loss
@@ -466,30 +670,17 @@ class SetCriterion(nn.Module):
 
     def token_sigmoid_binary_focal_loss(self, outputs, targets, indices, num_boxes):
         pred_logits=outputs['pred_logits']
-        new_targets=outputs['one_hot'].to(pred_logits.device)
+        new_targets=outputs['one_hot']
         text_mask=outputs['text_mask']
 
         assert (new_targets.dim() == 3)
         assert (pred_logits.dim() == 3)  # batch x from x to
-        
-        bs, n, _ = pred_logits.shape
-        alpha=self.focal_alpha
-        gamma=self.focal_gamma
-        if text_mask is not None:
-            # ODVG: each sample has different mask 
-            text_mask = text_mask.repeat(1, pred_logits.size(1)).view(outputs['text_mask'].shape[0],-1,outputs['text_mask'].shape[1])
-            pred_logits = torch.masked_select(pred_logits, text_mask)
-            new_targets = torch.masked_select(new_targets, text_mask)
-
-        new_targets=new_targets.float()
-        p = torch.sigmoid(pred_logits)
-        ce_loss = F.binary_cross_entropy_with_logits(pred_logits, new_targets, reduction="none")
-        p_t = p * new_targets + (1 - p) * (1 - new_targets)
-        loss = ce_loss * ((1 - p_t) ** gamma)
 
-        if alpha >= 0:
-            alpha_t = alpha * new_targets + (1 - alpha) * (1 - new_targets)
-            loss = alpha_t * loss
+        new_targets = new_targets[..., :pred_logits.size(2)]
+        if text_mask is not None:
+            # ODVG: each sample has different mask
+            text_mask = text_mask[:, None, :pred_logits.size(2)]
+        loss = self.focal_loss(pred_logits, new_targets, text_mask)
 
         total_num_pos=0
         for batch_indices in indices:
@@ -500,6 +691,24 @@ class SetCriterion(nn.Module):
         losses = {'loss_ce': loss}
         return losses
 
+    def focal_loss(self, pred_logits, new_targets, text_mask=None):
+        """Element-wise sigmoid focal loss of the token logits, 0 where text_mask (broadcast to
+        pred_logits) is False."""
+        if text_mask is not None:
+            # padded tokens hold -inf logits
+            pred_logits = pred_logits.masked_fill(~text_mask, 0.0)
+        new_targets = new_targets.float()
+        p = torch.sigmoid(pred_logits)
+        ce_loss = F.binary_cross_entropy_with_logits(pred_logits, new_targets, reduction="none")
+        p_t = p * new_targets + (1 - p) * (1 - new_targets)
+        loss = ce_loss * ((1 - p_t) ** self.focal_gamma)
+        if self.focal_alpha >= 0:
+            alpha_t = self.focal_alpha * new_targets + (1 - self.focal_alpha) * (1 - new_targets)
+            loss = alpha_t * loss
+        if text_mask is not None:
+            loss = loss.masked_fill(~text_mask, 0.0)
+        return loss
+
 
     def _get_src_permutation_idx(self, indices):
         # permute predictions following indices
@@ -513,6 +722,86 @@ class SetCriterion(nn.Module):
         tgt_idx = torch.cat([tgt for (_, tgt) in indices])
         return batch_idx, tgt_idx
 
+    def fused_losses(self, layer_outputs, suffixes, targets, layer_indices, label_map_list, text_mask, num_text_tokens, num_boxes):
+        """ Focal token loss and box losses of several sets of predictions in one pass.
+        Same values as token_sigmoid_binary_focal_loss and loss_boxes called on each layer, keyed
+        by the loss name followed by the suffix of the layer, e.g. loss_ce_0 or loss_bbox_interm.
+        Parameters:
+             layer_outputs: list of dicts with "pred_logits" and "pred_boxes" of dim [bs, num_queries, *]
+             layer_indices: matching indices of each entry of layer_outputs
+             text_mask: [bs, 256] valid text tokens, or None
+             num_text_tokens: length of the tokenized captions, text tokens past it are never valid
+        The logits may be padded to 256 columns or not, only their first num_text_tokens columns are used.
+        """
+        pred_logits = torch.stack([o['pred_logits'] for o in layer_outputs])[..., :num_text_tokens]
+        num_text_tokens = pred_logits.shape[-1]
+        pred_boxes = torch.stack([o['pred_boxes'] for o in layer_outputs])
+        device = pred_logits.device
+        labels = [t["labels"].cpu() for t in targets]
+
+        # matched (layer, image, query) triplets and their targets
+        layer_idx = torch.cat([torch.full_like(src, l) for l, indices in enumerate(layer_indices) for (src, _) in indices]).to(device)
+        batch_idx = torch.cat([torch.full_like(src, i) for indices in layer_indices for i, (src, _) in enumerate(indices)]).to(device)
+        src_idx = torch.cat([src for indices in layer_indices for (src, _) in indices]).to(device)
+        tgt_label_maps = torch.cat([
+            label_map_list[i][labels[i][tgt]] for indices in layer_indices for i, (_, tgt) in enumerate(indices)
+        ])
+        target_boxes = torch.cat([
+            targets[i]['boxes'][tgt.to(targets[i]['boxes'].device)] for indices in layer_indices for i, (_, tgt) in enumerate(indices)
+        ])
+
+        # token focal loss
+        one_hot = torch.zeros(pred_logits.shape, dtype=torch.bool, device=device)
+        one_hot[layer_idx, batch_idx, src_idx] = tgt_label_maps[:, :num_text_tokens].to(device).bool()
+        if text_mask is not None:
+            text_mask = text_mask[:, :num_text_tokens][None, :, None, :]
+        loss = self.focal_loss(pred_logits, one_hot, text_mask)
+        num_pos = torch.as_tensor(
+            [max(sum(len(src) for src, _ in indices), 1.0) for indices in layer_indices], dtype=loss.dtype, device=device
+        )
+        loss_ce = loss.flatten(1).sum(1) / num_pos
+
+        # box losses, summed per layer
+        num_layers = len(layer_outputs)
+        src_boxes = pred_boxes[layer_idx, batch_idx, src_idx]
+        loss_bbox = F.l1_loss(src_boxes, target_boxes, reduction='none')
+        loss_giou = 1 - box_ops.generalized_box_iou_pairwise(
+            box_ops.box_cxcywh_to_xyxy(src_boxes),
+            box_ops.box_cxcywh_to_xyxy(target_boxes))
+        zeros = loss_bbox.new_zeros(num_layers)
+        loss_bbox_sum = zeros.index_add(0, layer_idx, loss_bbox.sum(-1)) / num_boxes
+        loss_giou_sum = zeros.index_add(0, layer_idx, loss_giou) / num_boxes
+        with torch.no_grad():
+            loss_xy = zeros.index_add(0, layer_idx, loss_bbox[..., :2].sum(-1)) / num_boxes
+            loss_hw = zeros.index_add(0, layer_idx, loss_bbox[..., 2:].sum(-1)) / num_boxes
+
+        losses = {}
+        for l, suffix in enumerate(suffixes):
+            if 'labels' in self.losses:
+                losses['loss_ce' + suffix] = loss_ce[l]
+            if 'boxes' in self.losses:
+                losses['loss_bbox' + suffix] = loss_bbox_sum[l]
+                losses['loss_giou' + suffix] = loss_giou_sum[l]
+                losses['loss_xy' + suffix] = loss_xy[l]
+                losses['loss_hw' + suffix] = loss_hw[l]
+        return losses
+
+    def match_layers(self, layer_outputs, targets, label_map_list):
+        """Per image matching indices of each entry of layer_outputs."""
+        if hasattr(self.matcher, 'match_layers'):
+            return self.matcher.match_layers(layer_outputs, targets, label_map_list)
+        layer_indices = []
+        for layer_output in layer_outputs:
+            indices = []
+            for j in range(len(targets)): # bs
+                single = {
+                    'pred_logits': layer_output['pred_logits'][j].unsqueeze(0),
+                    'pred_boxes': layer_output['pred_boxes'][j].unsqueeze(0)
+                }
+                indices.extend(self.matcher(single, [targets[j]], label_map_list[j]))
+            layer_indices.append(indices)
+        return layer_indices
+
     def get_loss(self, loss, outputs, targets, indices, num_boxes, **kwargs):
         loss_map = {
             'labels': self.token_sigmoid_binary_focal_loss,
@@ -532,41 +821,23 @@ class SetCriterion(nn.Module):
              return_indices: used for vis. if True, the layer0-5 indices will be returned as well.
         """
         device=next(iter(outputs.values())).device
-        one_hot = torch.zeros(outputs['pred_logits'].size(),dtype=torch.int64) # torch.Size([bs, 900, 256])
         token = outputs['token'] 
         
-        label_map_list = []
-        indices = []
-        for j in range(len(cat_list)): # bs
-            label_map=[]
-            for i in range(len(cat_list[j])):
-                label_id=torch.tensor([i])
-                per_label=create_positive_map(token[j], label_id, cat_list[j], caption[j])
-                label_map.append(per_label)
-            label_map=torch.stack(label_map,dim=0).squeeze(1)
-            label_map_list.append(label_map)
-        for j in range(len(cat_list)): # bs
-            for_match = {
-                "pred_logits" : outputs['pred_logits'][j].unsqueeze(0),
-                "pred_boxes" : outputs['pred_boxes'][j].unsqueeze(0)
-            }
-            inds = self.matcher(for_match, [targets[j]], label_map_list[j])
-            indices.extend(inds)
-        # indices : A list of size batch_size, containing tuples of (index_i, index_j) where:
+        label_map_list = [
+            self.get_label_map(token[j], cat_list[j], caption[j]) for j in range(len(cat_list)) # bs
+        ]
+
+        # match the final, auxiliary and intermediate outputs at once
+        layer_outputs = [outputs]
+        if 'aux_outputs' in outputs:
+            layer_outputs.extend(outputs['aux_outputs'])
+        if 'interm_outputs' in outputs:
+            layer_outputs.append(outputs['interm_outputs'])
+        layer_indices = self.match_layers(layer_outputs, targets, label_map_list)
+        # layer_indices[l] : A list of size batch_size, containing tuples of (index_i, index_j) where:
         # - index_i is the indices of the selected predictions (in order)
         # - index_j is the indices of the corresponding selected targets (in order)
 
-        # import pdb; pdb.set_trace()
-        tgt_ids = [v["labels"].cpu() for v in targets]
-        # len(tgt_ids) == bs
-        for i in range(len(indices)):
-            tgt_ids[i]=tgt_ids[i][indices[i][1]]
-            one_hot[i,indices[i][0]] = label_map_list[i][tgt_ids[i]].to(torch.long)
-        outputs['one_hot'] = one_hot
-        if return_indices:
-            indices0_copy = indices
-            indices_list = []
-
         # Compute the average number of target boxes accross all nodes, for normalization purposes
         num_boxes_list = [len(t["labels"]) for t in targets]
         num_boxes = sum(num_boxes_list)
@@ -575,75 +846,33 @@ class SetCriterion(nn.Module):
             torch.distributed.all_reduce(num_boxes)
         num_boxes = torch.clamp(num_boxes / get_world_size(), min=1).item()
 
-        # Compute all the requested losses
-        losses = {}
-        for loss in self.losses:
-            losses.update(self.get_loss(loss, outputs, targets, indices, num_boxes))
-
-        # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
+        # Compute all the requested losses, for the auxiliary and intermediate outputs as well
+        suffixes = ['']
         if 'aux_outputs' in outputs:
-            for idx, aux_outputs in enumerate(outputs['aux_outputs']):
-                indices = []
-                for j in range(len(cat_list)): # bs
-                    aux_output_single = {
-                        'pred_logits' : aux_outputs['pred_logits'][j].unsqueeze(0),
-                        'pred_boxes': aux_outputs['pred_boxes'][j].unsqueeze(0)
-                    }
-                    inds = self.matcher(aux_output_single, [targets[j]], label_map_list[j])
-                    indices.extend(inds)
-                one_hot_aux = torch.zeros(outputs['pred_logits'].size(),dtype=torch.int64)
-                tgt_ids = [v["labels"].cpu() for v in targets]
-                for i in range(len(indices)):
-                    tgt_ids[i]=tgt_ids[i][indices[i][1]]
-                    one_hot_aux[i,indices[i][0]] = label_map_list[i][tgt_ids[i]].to(torch.long)
-                aux_outputs['one_hot'] = one_hot_aux
-                aux_outputs['text_mask'] = outputs['text_mask']
-                if return_indices:
-                    indices_list.append(indices)
-                for loss in self.losses:
-                    kwargs = {}
-                    l_dict = self.get_loss(loss, aux_outputs, targets, indices, num_boxes, **kwargs)                
-                    l_dict = {k + f'_{idx}': v for k, v in l_dict.items()}
-                    losses.update(l_dict)
-
-        # interm_outputs loss
+            suffixes += [f'_{idx}' for idx in range(len(outputs['aux_outputs']))]
         if 'interm_outputs' in outputs:
-            interm_outputs = outputs['interm_outputs']
-            indices = []
-            for j in range(len(cat_list)): # bs
-                interm_output_single = {
-                    'pred_logits' : interm_outputs['pred_logits'][j].unsqueeze(0),
-                    'pred_boxes': interm_outputs['pred_boxes'][j].unsqueeze(0)
-                }
-                inds = self.matcher(interm_output_single, [targets[j]], label_map_list[j])
-                indices.extend(inds)
-            one_hot_aux = torch.zeros(outputs['pred_logits'].size(),dtype=torch.int64)
-            tgt_ids = [v["labels"].cpu() for v in targets]
-            for i in range(len(indices)):
-                tgt_ids[i]=tgt_ids[i][indices[i][1]]
-                one_hot_aux[i,indices[i][0]] = label_map_list[i][tgt_ids[i]].to(torch.long)
-            interm_outputs['one_hot'] = one_hot_aux
-            interm_outputs['text_mask'] = outputs['text_mask']
-            if return_indices:
-                indices_list.append(indices)
-            for loss in self.losses:
-                kwargs = {}
-                l_dict = self.get_loss(loss, interm_outputs, targets, indices, num_boxes, **kwargs)
-                l_dict = {k + f'_interm': v for k, v in l_dict.items()}
-                losses.update(l_dict)
+            suffixes.append('_interm')
+        losses = self.fused_losses(layer_outputs, suffixes, targets, layer_indices, label_map_list,
+                                   outputs['text_mask'], token['input_ids'].shape[1], num_boxes)
+        for loss in self.losses:
+            if loss in ('labels', 'boxes'):
+                continue
+            for layer_output, indices, suffix in zip(layer_outputs, layer_indices, suffixes):
+                l_dict = self.get_loss(loss, layer_output, targets, indices, num_boxes)
+                losses.update({k + suffix: v for k, v in l_dict.items()})
 
         if return_indices:
-            indices_list.append(indices0_copy)
-            return losses, indices_list
+            return losses, layer_indices[1:] + layer_indices[:1]
 
         return losses
 
 
 class PostProcess(nn.Module):
     """ This module converts the model's output into the format expected by the coco api"""
-    def __init__(self, num_select=100,text_encoder_type='text_encoder_type', nms_iou_threshold=-1,use_coco_eval=False,args=None) -> None:
+    def __init__(self, num_select=100,text_encoder_type='text_encoder_type', nms_iou_threshold=-1,use_coco_eval=False,args=None,score_threshold=0.0) -> None:
         super().__init__()
         self.num_select = num_select
+        self.score_threshold = score_threshold
         self.tokenizer = get_tokenlizer.get_tokenlizer(text_encoder_type)
         if args.use_coco_eval:
             from pycocotools.coco import COCO
@@ -654,8 +883,7 @@ class PostProcess(nn.Module):
             cat_list=args.label_list
         caption = " . ".join(cat_list) + ' .'
         tokenized = self.tokenizer(caption, padding="longest", return_tensors="pt")
-        label_list = torch.arange(len(cat_list))
-        pos_map=create_positive_map(tokenized,label_list,cat_list,caption)
+        pos_map=create_positive_map_batched(tokenized,cat_list,caption)
         # build a mapping from label_id to pos_map
         if args.use_coco_eval:
             id_map = {0: 1, 1: 2, 2: 3, 3: 4, 4: 5, 5: 6, 6: 7, 7: 8, 8: 9, 9: 10, 10: 11, 11: 13, 12: 14, 13: 15, 14: 16, 15: 17, 16: 18, 17: 19, 18: 20, 19: 21, 20: 22, 21: 23, 22: 24, 23: 25, 24: 27, 25: 28, 26: 31, 27: 32, 28: 33, 29: 34, 30: 35, 31: 36, 32: 37, 33: 38, 34: 39, 35: 40, 36: 41, 37: 42, 38: 43, 39: 44, 40: 46,
@@ -668,36 +896,53 @@ class PostProcess(nn.Module):
 
         self.nms_iou_threshold=nms_iou_threshold
         self.positive_map = pos_map
+        # normalized label maps, one per device
+        self._normalized_positive_maps = {}
+
+    def get_positive_map(self, device):
+        """[num_labels, 256] positive map with rows summing to 1 (empty rows stay 0), kept on device."""
+        pos_map = self._normalized_positive_maps.get(device, None)
+        if pos_map is None:
+            sums = self.positive_map.sum(-1, keepdim=True)
+            pos_map = torch.where(sums > 0, self.positive_map / sums, self.positive_map).to(device)
+            self._normalized_positive_maps[device] = pos_map
+        return pos_map
+
+    @staticmethod
+    def split_results(results, batch_size):
+        """Split the compact results of forward(..., compact=True) into one dict per image."""
+        counts = torch.bincount(results['batch_idx'], minlength=batch_size).tolist()
+        scores, labels, boxes = (results[k].split(counts) for k in ('scores', 'labels', 'boxes'))
+        return [{'scores': s, 'labels': l, 'boxes': b} for s, l, b in zip(scores, labels, boxes)]
 
     @torch.no_grad()
-    def forward(self, outputs, target_sizes, not_to_xyxy=False, test=False):
+    def forward(self, outputs, target_sizes, not_to_xyxy=False, test=False, compact=False):
         """ Perform the computation
         Parameters:
             outputs: raw outputs of the model
             target_sizes: tensor of dimension [batch_size x 2] containing the size of each images of the batch
                           For evaluation, this must be the original image size (before any data augmentation)
                           For visualization, this should be the image size after data augment, but before padding
+            compact: if True, return the detections of the whole batch as a dict of flat tensors 'scores' [K],
+                     'labels' [K], 'boxes' [K, 4] and 'batch_idx' [K], sorted by image then decreasing score.
+                     Otherwise return one dict per image.
         """
         num_select = self.num_select
         out_logits, out_bbox = outputs['pred_logits'], outputs['pred_boxes']
 
-
-        prob_to_token = out_logits.sigmoid()
-        pos_maps = self.positive_map.to(prob_to_token.device)
-        for label_ind in range(len(pos_maps)):
-            if pos_maps[label_ind].sum() != 0:
-                pos_maps[label_ind]=pos_maps[label_ind]/pos_maps[label_ind].sum()
-
-        prob_to_label = prob_to_token @ pos_maps.T
-
         assert len(out_logits) == len(target_sizes)
         assert target_sizes.shape[1] == 2
 
-        prob = prob_to_label
-        topk_values, topk_indexes = torch.topk(prob.view(prob.shape[0], -1), num_select, dim=1)
+        prob_to_token = out_logits.sigmoid()
+        # the logits may be unpadded, padded columns have a zero probability and do not contribute
+        pos_maps = self.get_positive_map(prob_to_token.device)[:, :prob_to_token.shape[-1]].to(prob_to_token.dtype)
+        prob = prob_to_token @ pos_maps.T
+
+        bs, _, num_labels = prob.shape
+        topk_values, topk_indexes = torch.topk(prob.view(bs, -1), num_select, dim=1)
         scores = topk_values
-        topk_boxes = torch.div(topk_indexes, prob.shape[2], rounding_mode='trunc')
-        labels = topk_indexes % prob.shape[2]
+        topk_boxes = torch.div(topk_indexes, num_labels, rounding_mode='trunc')
+        labels = topk_indexes % num_labels
         if not_to_xyxy:
             boxes = out_bbox
         else:
@@ -713,14 +958,27 @@ class PostProcess(nn.Module):
         scale_fct = torch.stack([img_w, img_h, img_w, img_h], dim=1)
         boxes = boxes * scale_fct[:, None, :]
 
+        if self.score_threshold <= 0 and self.nms_iou_threshold <= 0:
+            # num_select detections per image, no need to compact
+            if compact:
+                batch_idx = torch.arange(bs, device=scores.device).repeat_interleave(num_select)
+                return {'scores': scores.flatten(), 'labels': labels.flatten(), 'boxes': boxes.flatten(0, 1), 'batch_idx': batch_idx}
+            return [{'scores': s, 'labels': l, 'boxes': b} for s, l, b in zip(scores, labels, boxes)]
+
+        # whole batch at once, image major and by decreasing score within each image
+        batch_idx = torch.arange(bs, device=scores.device).repeat_interleave(num_select)
+        scores, labels, boxes = scores.flatten(), labels.flatten(), boxes.flatten(0, 1)
+        keep = torch.arange(len(scores), device=scores.device)
+        if self.score_threshold > 0:
+            keep = keep[scores > self.score_threshold]
         if self.nms_iou_threshold > 0:
-            item_indices = [nms(b, s, iou_threshold=self.nms_iou_threshold) for b,s in zip(boxes, scores)]
-
-            results = [{'scores': s[i], 'labels': l[i], 'boxes': b[i]} for s, l, b, i in zip(scores, labels, boxes, item_indices)]
-        else:
-            results = [{'scores': s, 'labels': l, 'boxes': b} for s, l, b in zip(scores, labels, boxes)]
-        results = [{'scores': s, 'labels': l, 'boxes': b} for s, l, b in zip(scores, labels, boxes)]
-        return results
+            # class aware, per image
+            nms_keep = batched_nms(boxes[keep], scores[keep], batch_idx[keep] * num_labels + labels[keep], self.nms_iou_threshold)
+            keep = keep[nms_keep].sort()[0]
+        results = {'scores': scores[keep], 'labels': labels[keep], 'boxes': boxes[keep], 'batch_idx': batch_idx[keep]}
+        if compact:
+            return results
+        return self.split_results(results, bs)
 
 
 @MODULE_BUILD_FUNCS.registe_with_name(module_name="groundingdino")
@@ -754,6 +1012,12 @@ def build_groundingdino(args):
         text_encoder_type=args.text_encoder_type,
         sub_sentence_present=sub_sentence_present,
         max_text_len=args.max_text_len,
+        text_cache_size=getattr(args, "text_cache_size", 0),
+        text_cache_max_bytes=getattr(args, "text_cache_max_bytes", 0),
+        frozen_text_cache_size=getattr(args, "frozen_text_cache_size", 0),
+        frozen_text_cache_max_bytes=getattr(args, "frozen_text_cache_max_bytes", 0),
+        slim_eval_outputs=getattr(args, "slim_eval_outputs", False),
+        pad_contrastive_logits=getattr(args, "pad_contrastive_logits", True),
     )
 
 
@@ -798,10 +1062,12 @@ def build_groundingdino(args):
     losses = ['labels', 'boxes']
 
     criterion = SetCriterion(matcher=matcher, weight_dict=weight_dict,
-                             focal_alpha=args.focal_alpha, focal_gamma=args.focal_gamma,losses=losses
+                             focal_alpha=args.focal_alpha, focal_gamma=args.focal_gamma,losses=losses,
+                             positive_map_cache_size=getattr(args, "positive_map_cache_size", 1024)
                              )
     criterion.to(device)
-    postprocessors = {'bbox': PostProcess(num_select=args.num_select  , text_encoder_type=args.text_encoder_type,nms_iou_threshold=args.nms_iou_threshold,args=args)}
+    postprocessors = {'bbox': PostProcess(num_select=args.num_select  , text_encoder_type=args.text_encoder_type,nms_iou_threshold=args.nms_iou_threshold,args=args,
+                                          score_threshold=getattr(args, 'postprocess_score_threshold', 0.0))}
 
     return model, criterion, postprocessors
 
@@ -855,3 +1121,74 @@ def create_positive_map(tokenized, tokens_positive,cat_list,caption):
     return positive_map 
 
 
+def create_positive_map_batched(tokenized, cat_list, caption, max_text_len=256):
+    """construct the positive map of every label of cat_list in one pass.
+
+    Same result as create_positive_map(tokenized, range(len(cat_list)), cat_list, caption): the
+    token of each character is read from a table built once from the offset mapping of the
+    tokenizer instead of one char_to_token call per label boundary.
+    """
+    encoding = tokenized
+    if isinstance(tokenized, BatchEncoding):
+        encoding = tokenized.encodings[0] if tokenized.encodings else None
+    if encoding is None or not hasattr(encoding, "offsets"):
+        # slow tokenizers have no offset mapping
+        return create_positive_map(tokenized, torch.arange(len(cat_list)), cat_list, caption)
+
+    char_to_token = [None] * len(caption)
+    for token_idx, (start, end) in enumerate(encoding.offsets):
+        for c in range(start, min(end, len(caption))):
+            if char_to_token[c] is None:
+                char_to_token[c] = token_idx
+
+    def lookup(c):
+        return char_to_token[c] if 0 <= c < len(char_to_token) else None
+
+    begs, ends = [], []
+    for label in cat_list:
+        start_ind = caption.find(label)
+        end_ind = start_ind + len(label) - 1
+        beg_pos = lookup(start_ind) if start_ind >= 0 else None
+        end_pos = None
+        for c in (end_ind, end_ind - 1, end_ind - 2):
+            end_pos = lookup(c)
+            if end_pos is not None:
+                break
+        if beg_pos is None or end_pos is None or beg_pos > end_pos:
+            # empty span
+            beg_pos, end_pos = 0, -1
+        begs.append(beg_pos)
+        ends.append(end_pos)
+
+    cols = torch.arange(max_text_len)
+    begs = torch.as_tensor(begs, dtype=torch.long).view(-1, 1)
+    ends = torch.as_tensor(ends, dtype=torch.long).view(-1, 1)
+    return ((cols >= begs) & (cols <= ends)).float()
+
+
+class PositiveMapCache:
+    """LRU cache of the positive maps built by create_positive_map_batched, keyed by (caption, cat_list)."""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        positive_map = self._entries.get(key, None)
+        if positive_map is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return positive_map
+
+    def put(self, key, positive_map):
+        self._entries[key] = positive_map
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -15,12 +15,38 @@
 # ------------------------------------------------------------------------
 
 
+import logging
 import torch, os
+from concurrent.futures import ThreadPoolExecutor
 from torch import nn
 from scipy.optimize import linear_sum_assignment
 
 from util.box_ops import box_cxcywh_to_xyxy, generalized_box_iou
 
+logger = logging.getLogger(__name__)
+
+
+def focal_token_cost(out_prob, alpha=0.25, gamma=2.0):
+    """Difference between the positive and negative focal costs of each token probability."""
+    neg_cost_class = (1 - alpha) * (out_prob ** gamma) * (-(1 - out_prob + 1e-8).log())
+    pos_cost_class = alpha * ((1 - out_prob) ** gamma) * (-(out_prob + 1e-8).log())
+    return pos_cost_class - neg_cost_class
+
+
+def focal_class_cost(out_prob, label_map, alpha=0.25, gamma=2.0):
+    """Focal classification cost of every prediction for every target.
+    Params:
+        out_prob: Tensor of dim [num_predictions, num_tokens] with the token probabilities
+        label_map: Tensor of dim [num_targets, max_text_len] with the positive map of each target. Only its
+                   first num_tokens columns are used, so out_prob may hold unpadded logits.
+    Returns:
+        Tensor of dim [num_predictions, num_targets], the focal cost averaged over the tokens of each target.
+        Targets without any positive token get NaN costs, that are zeroed together with the final cost matrix.
+    """
+    norm_label_map = label_map.to(out_prob) / label_map.sum(-1, keepdim=True).to(out_prob)
+    norm_label_map = norm_label_map[:, :out_prob.shape[-1]]
+    return focal_token_cost(out_prob, alpha, gamma) @ norm_label_map.T
+
 
 class HungarianMatcher(nn.Module):
     """This class computes an assignment between the targets and the predictions of the network
@@ -29,12 +55,13 @@ class HungarianMatcher(nn.Module):
     while the others are un-matched (and thus treated as non-objects).
     """
 
-    def __init__(self, cost_class: float = 1, cost_bbox: float = 1, cost_giou: float = 1, focal_alpha = 0.25):
+    def __init__(self, cost_class: float = 1, cost_bbox: float = 1, cost_giou: float = 1, focal_alpha = 0.25, num_workers: int = 0):
         """Creates the matcher
         Params:
             cost_class: This is the relative weight of the classification error in the matching cost
             cost_bbox: This is the relative weight of the L1 error of the bounding box coordinates in the matching cost
             cost_giou: This is the relative weight of the giou loss of the bounding box in the matching cost
+            num_workers: number of threads solving the assignment problems of match_layers, 0 solves them serially
         """
         super().__init__()
         self.cost_class = cost_class
@@ -43,6 +70,78 @@ class HungarianMatcher(nn.Module):
         assert cost_class != 0 or cost_bbox != 0 or cost_giou != 0, "all costs cant be 0"
 
         self.focal_alpha = focal_alpha
+        self.num_workers = num_workers
+        self._executor = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        return state
+
+    @property
+    def executor(self):
+        if self._executor is None and self.num_workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        return self._executor
+
+    _warned_fallback = False
+
+    @classmethod
+    def _solve(cls, c):
+        try:
+            return linear_sum_assignment(c)
+        except ValueError as e:
+            # infeasible cost matrix
+            if not cls._warned_fallback:
+                cls._warned_fallback = True
+                logger.warning("linear_sum_assignment failed (%s), falling back to SimpleMinsumMatcher", e)
+            c = torch.as_tensor(c)
+            return c.min(0)[1], torch.arange(c.shape[1])
+
+    @torch.no_grad()
+    def match_layers(self, layer_outputs, targets, label_maps):
+        """ Performs the matching of several sets of predictions, e.g. every decoder layer and the encoder output,
+        against the same targets. The cost matrices of all layers are computed in one batch per image, against the
+        targets of that image only, copied to the host at once and the assignment problems are solved by a thread
+        pool.
+        Params:
+            layer_outputs: list of dicts with "pred_logits" and "pred_boxes" of dim [batch_size, num_queries, *]
+            targets: list of batch_size target dicts, see forward
+            label_maps: list of batch_size positive maps of dim [num_labels, 256], one per image caption
+        Returns:
+            A list with, for each entry of layer_outputs, the list of batch_size (index_i, index_j) tuples
+            that forward returns when called on a single image of that layer.
+        """
+        num_layers = len(layer_outputs)
+        bs, num_queries = layer_outputs[0]["pred_logits"].shape[:2]
+
+        # [batch_size, num_layers * num_queries, *]
+        out_prob = torch.stack([o["pred_logits"] for o in layer_outputs], 1).flatten(1, 2).sigmoid()
+        out_bbox = torch.stack([o["pred_boxes"] for o in layer_outputs], 1).flatten(1, 2)
+
+        costs = []
+        for i, (v, label_map) in enumerate(zip(targets, label_maps)):
+            tgt_bbox = v["boxes"]
+            tgt_label_map = label_map[v["labels"].cpu()].to(out_prob.device)
+
+            cost_class = focal_class_cost(out_prob[i], tgt_label_map, alpha=self.focal_alpha)
+            cost_bbox = torch.cdist(out_bbox[i], tgt_bbox, p=1)
+            cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox[i]), box_cxcywh_to_xyxy(tgt_bbox))
+
+            C = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
+            costs.append(torch.nan_to_num(C, nan=0.0, posinf=0.0, neginf=0.0).flatten())
+
+        # [num_layers, num_queries, num_targets_i] per image
+        sizes = [len(v["boxes"]) for v in targets]
+        costs = torch.cat(costs).cpu().split([num_layers * num_queries * size for size in sizes])
+        costs = [c.view(num_layers, num_queries, size).numpy() for c, size in zip(costs, sizes)]
+        problems = [costs[i][l] for l in range(num_layers) for i in range(bs)]
+        if self.executor is not None:
+            solutions = list(self.executor.map(self._solve, problems))
+        else:
+            solutions = [self._solve(c) for c in problems]
+        indices = [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in solutions]
+        return [indices[l * bs:(l + 1) * bs] for l in range(num_layers)]
 
     @torch.no_grad()
     def forward(self, outputs, targets, label_map):
@@ -74,37 +173,19 @@ class HungarianMatcher(nn.Module):
         tgt_bbox = torch.cat([v["boxes"] for v in targets])
 
         # Compute the classification cost.
-        alpha = self.focal_alpha
-        gamma = 2.0
-
-        new_label_map=label_map[tgt_ids.cpu()]
+        new_label_map=label_map[tgt_ids.cpu()].to(out_prob.device)
+        cost_class = focal_class_cost(out_prob, new_label_map, alpha=self.focal_alpha)
 
-        neg_cost_class = (1 - alpha) * (out_prob ** gamma) * (-(1 - out_prob + 1e-8).log())
-        pos_cost_class = alpha * ((1 - out_prob) ** gamma) * (-(out_prob + 1e-8).log())
-        new_label_map=new_label_map.to(pos_cost_class.device)
-        
-        cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
-
-        # cost_class=(pos_cost_class @ new_label_map.T - neg_cost_class@ new_label_map.T)
-        cost_class=[]
-        for idx_map in new_label_map:       
-            idx_map = idx_map / idx_map.sum()
-            cost_class.append(pos_cost_class @ idx_map - neg_cost_class@ idx_map)
-        if cost_class:
-            cost_class=torch.stack(cost_class,dim=0).T
-        else:
-            cost_class=torch.zeros_like(cost_bbox)
         # Compute the L1 cost between boxes
-        
+        cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
 
         # Compute the giou cost betwen boxes
         cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox), box_cxcywh_to_xyxy(tgt_bbox))
         # import pdb;pdb.set_trace()
         # Final cost matrix
         C = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
+        C = torch.nan_to_num(C, nan=0.0, posinf=0.0, neginf=0.0)
         C = C.view(bs, num_queries, -1).cpu()
-        C[torch.isnan(C)] = 0.0
-        C[torch.isinf(C)] = 0.0
 
         sizes = [len(v["boxes"]) for v in targets]
         try:
@@ -144,7 +225,7 @@ class SimpleMinsumMatcher(nn.Module):
         self.focal_alpha = focal_alpha
 
     @torch.no_grad()
-    def forward(self, outputs, targets):
+    def forward(self, outputs, targets, label_map=None):
         """ Performs the matching
         Params:
             outputs: This is a dict that contains at least these entries:
@@ -154,6 +235,8 @@ class SimpleMinsumMatcher(nn.Module):
                  "labels": Tensor of dim [num_target_boxes] (where num_target_boxes is the number of ground-truth
                            objects in the target) containing the class labels
                  "boxes": Tensor of dim [num_target_boxes, 4] containing the target box coordinates
+            label_map: optional Tensor of dim [num_classes, num_tokens] mapping each class to its caption tokens.
+                 If None, the labels directly index the columns of pred_logits.
         Returns:
             A list of size batch_size, containing tuples of (index_i, index_j) where:
                 - index_i is the indices of the selected predictions (in order)
@@ -173,11 +256,11 @@ class SimpleMinsumMatcher(nn.Module):
         tgt_bbox = torch.cat([v["boxes"] for v in targets])
 
         # Compute the classification cost.
-        alpha = self.focal_alpha
-        gamma = 2.0
-        neg_cost_class = (1 - alpha) * (out_prob ** gamma) * (-(1 - out_prob + 1e-8).log())
-        pos_cost_class = alpha * ((1 - out_prob) ** gamma) * (-(out_prob + 1e-8).log())
-        cost_class = pos_cost_class[:, tgt_ids] - neg_cost_class[:, tgt_ids]
+        if label_map is not None:
+            new_label_map = label_map[tgt_ids.cpu()].to(out_prob.device)
+            cost_class = focal_class_cost(out_prob, new_label_map, alpha=self.focal_alpha)
+        else:
+            cost_class = focal_token_cost(out_prob, alpha=self.focal_alpha)[:, tgt_ids]
 
         # Compute the L1 cost between boxes
         cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
@@ -188,6 +271,7 @@ class SimpleMinsumMatcher(nn.Module):
         # Final cost matrix
         
         C = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
+        C = torch.nan_to_num(C, nan=0.0, posinf=0.0, neginf=0.0)
         C = C.view(bs, num_queries, -1)
 
         sizes = [len(v["boxes"]) for v in targets]
@@ -207,7 +291,7 @@ def build_matcher(args):
     if args.matcher_type == 'HungarianMatcher':
         return HungarianMatcher(
             cost_class=args.set_cost_class, cost_bbox=args.set_cost_bbox, cost_giou=args.set_cost_giou,
-            focal_alpha=args.focal_alpha
+            focal_alpha=args.focal_alpha, num_workers=getattr(args, 'matcher_num_workers', 0)
         )
     elif args.matcher_type == 'SimpleMinsumMatcher':
         return SimpleMinsumMatcher(
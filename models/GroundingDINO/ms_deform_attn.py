@@ -29,8 +29,9 @@ try:
     # from groundingdino import _C
     import MultiScaleDeformableAttention as _C
 except Exception:
+    if torch.cuda.is_available():
+        raise Exception('Wont work without MultiScaleDeformableAttention')
     warnings.warn("Failed to load custom C++ ops. Running on CPU mode Only!")
-    raise Exception('Wont work without MultiScaleDeformableAttention')
 
 
 # helpers
@@ -98,41 +99,61 @@ def multi_scale_deformable_attn_pytorch(
     sampling_locations: torch.Tensor,
     attention_weights: torch.Tensor,
 ) -> torch.Tensor:
+    """Pure PyTorch multi-scale deformable attention, used when the CUDA extension is not.
 
-    bs, _, num_heads, embed_dims = value.shape
+    Same result as sampling every level with F.grid_sample (bilinear, zeros padding, align_corners=False)
+    and summing the samples weighted by attention_weights, but computed by a single F.embedding_bag over
+    the flattened value: the bag of a (query, head) holds the 4 bilinear corners of its
+    num_levels * num_points samples, weighted by the bilinear weights times the attention weights.
+    Out-of-bounds corners point at a valid row with weight 0. value is read in place, without the
+    per-level transposes and the stack of the sampled values.
+
+    Args:
+        value: bs, num_value, num_heads, embed_dims
+        value_spatial_shapes: num_levels, 2 (h, w)
+        sampling_locations: bs, num_queries, num_heads, num_levels, num_points, 2 (x, y) in [0, 1]
+        attention_weights: bs, num_queries, num_heads, num_levels, num_points
+
+    Returns:
+        bs, num_queries, num_heads * embed_dims
+    """
+    bs, num_value, num_heads, embed_dims = value.shape
     _, num_queries, num_heads, num_levels, num_points, _ = sampling_locations.shape
-    value_list = value.split([H_ * W_ for H_, W_ in value_spatial_shapes], dim=1)
-    sampling_grids = 2 * sampling_locations - 1
-    sampling_value_list = []
-    for level, (H_, W_) in enumerate(value_spatial_shapes):
-        # bs, H_*W_, num_heads, embed_dims ->
-        # bs, H_*W_, num_heads*embed_dims ->
-        # bs, num_heads*embed_dims, H_*W_ ->
-        # bs*num_heads, embed_dims, H_, W_
-        value_l_ = (
-            value_list[level].flatten(2).transpose(1, 2).reshape(bs * num_heads, embed_dims, H_, W_)
-        )
-        # bs, num_queries, num_heads, num_points, 2 ->
-        # bs, num_heads, num_queries, num_points, 2 ->
-        # bs*num_heads, num_queries, num_points, 2
-        sampling_grid_l_ = sampling_grids[:, :, :, level].transpose(1, 2).flatten(0, 1)
-        # bs*num_heads, embed_dims, num_queries, num_points
-        sampling_value_l_ = F.grid_sample(
-            value_l_, sampling_grid_l_, mode="bilinear", padding_mode="zeros", align_corners=False
-        )
-        sampling_value_list.append(sampling_value_l_)
-    # (bs, num_queries, num_heads, num_levels, num_points) ->
-    # (bs, num_heads, num_queries, num_levels, num_points) ->
-    # (bs, num_heads, 1, num_queries, num_levels*num_points)
-    attention_weights = attention_weights.transpose(1, 2).reshape(
-        bs * num_heads, 1, num_queries, num_levels * num_points
-    )
-    output = (
-        (torch.stack(sampling_value_list, dim=-2).flatten(-2) * attention_weights)
-        .sum(-1)
-        .view(bs, num_heads * embed_dims, num_queries)
+
+    # per-level sizes and offsets into the flattened value, broadcast against [..., num_levels, num_points, 4]
+    level_start = F.pad(value_spatial_shapes.prod(1).cumsum(0)[:-1], (1, 0))[:, None, None]
+    H_ = value_spatial_shapes[:, 0, None, None]
+    W_ = value_spatial_shapes[:, 1, None, None]
+
+    # pixel coordinates, align_corners=False maps [0, 1] to [-0.5, size - 0.5]. They are computed in at
+    # least float32: half precision cannot tell apart the pixels of large levels.
+    locations = sampling_locations.to(torch.promote_types(sampling_locations.dtype, torch.float32))
+    x = locations[..., 0, None] * W_ - 0.5
+    y = locations[..., 1, None] * H_ - 0.5
+    x0, y0 = x.floor(), y.floor()
+    dx, dy = x - x0, y - y0
+    corner_x = torch.tensor([0, 1, 0, 1], device=x.device)
+    corner_y = torch.tensor([0, 0, 1, 1], device=x.device)
+    # int64 corners, bs, num_queries, num_heads, num_levels, num_points, 4
+    cx = x0.long() + corner_x
+    cy = y0.long() + corner_y
+    weights = (corner_x * dx + (1 - corner_x) * (1 - dx)) * (corner_y * dy + (1 - corner_y) * (1 - dy))
+    valid = (cx >= 0) & (cx < W_) & (cy >= 0) & (cy < H_)
+    weights = weights * valid * attention_weights[..., None]
+
+    # row of value.reshape(-1, embed_dims) holding (b, level_start + cy * W_ + cx, h)
+    pos = torch.where(valid, cy * W_ + cx, torch.zeros_like(cx)) + level_start
+    batch_offset = torch.arange(bs, device=value.device)[:, None, None, None, None, None] * num_value
+    head_offset = torch.arange(num_heads, device=value.device)[None, None, :, None, None, None]
+    index = (batch_offset + pos) * num_heads + head_offset
+
+    output = F.embedding_bag(
+        index.view(-1, num_levels * num_points * 4),
+        value.reshape(-1, embed_dims),
+        per_sample_weights=weights.view(-1, num_levels * num_points * 4).to(value.dtype),
+        mode="sum",
     )
-    return output.transpose(1, 2).contiguous()
+    return output.view(bs, num_queries, num_heads * embed_dims)
 
 
 class MultiScaleDeformableAttention(nn.Module):
@@ -0,0 +1,121 @@
+# ------------------------------------------------------------------------
+# Grounding DINO
+# url: https://github.com/IDEA-Research/GroundingDINO
+# Copyright (c) 2023 IDEA. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+from collections import OrderedDict
+
+import torch
+
+
+class TextFeatureCache:
+    """LRU cache of per-caption text features.
+
+    Each entry holds the unpadded outputs of the text branch for one caption:
+        - encoded_text: [n_token, d_model]
+        - text_token_mask: [n_token]
+        - position_ids: [n_token]
+        - text_self_attention_masks: [n_token, n_token]
+
+    Entries are keyed by (caption, version, device), any hashable can stand for the caption, e.g.
+    the token ids of a sub-sentence for the frozen text encoder outputs. ``invalidate`` bumps the version and drops
+    every entry, it must be called whenever the text encoder weights change.
+
+    Args:
+        max_entries (int): maximal number of cached captions. 0 disables the limit.
+        max_bytes (int): maximal total size of the cached tensors in bytes. 0 disables the limit.
+    """
+
+    def __init__(self, max_entries=64, max_bytes=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, caption, device):
+        return (caption, self.version, str(device))
+
+    @staticmethod
+    def _entry_nbytes(entry):
+        return sum(v.numel() * v.element_size() for v in entry.values())
+
+    def get(self, caption, device):
+        key = self._key(caption, device)
+        entry = self._entries.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, caption, device, entry):
+        entry = {k: v.detach().clone() for k, v in entry.items()}
+        nbytes = self._entry_nbytes(entry)
+        if self.max_bytes > 0 and nbytes > self.max_bytes:
+            return
+        key = self._key(caption, device)
+        if key in self._entries:
+            self.nbytes -= self._entry_nbytes(self._entries.pop(key))
+        self._entries[key] = entry
+        self.nbytes += nbytes
+        while (self.max_entries > 0 and len(self._entries) > self.max_entries) or (
+            self.max_bytes > 0 and self.nbytes > self.max_bytes
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= self._entry_nbytes(evicted)
+
+    def invalidate(self):
+        self.version += 1
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
+
+
+def collate_text_features(entries):
+    """Pad a list of cached per-caption entries into a batched text_dict.
+
+    Padding follows the layout produced by the tokenizer with padding="longest":
+    padded tokens are masked out, have position id 0 and only attend to themselves.
+    """
+    bs = len(entries)
+    max_len = max(e["text_token_mask"].shape[0] for e in entries)
+    ref = entries[0]["encoded_text"]
+    device = ref.device
+
+    encoded_text = ref.new_zeros((bs, max_len, ref.shape[-1]))
+    text_token_mask = torch.zeros((bs, max_len), dtype=torch.bool, device=device)
+    position_ids = torch.zeros((bs, max_len), dtype=torch.long, device=device)
+    text_self_attention_masks = (
+        torch.eye(max_len, device=device).bool().unsqueeze(0).repeat(bs, 1, 1)
+    )
+    for i, e in enumerate(entries):
+        n = e["text_token_mask"].shape[0]
+        encoded_text[i, :n] = e["encoded_text"]
+        text_token_mask[i, :n] = e["text_token_mask"]
+        position_ids[i, :n] = e["position_ids"]
+        text_self_attention_masks[i, :n, :n] = e["text_self_attention_masks"]
+
+    return {
+        "encoded_text": encoded_text,
+        "text_token_mask": text_token_mask,
+        "position_ids": position_ids,
+        "text_self_attention_masks": text_self_attention_masks,
+    }
@@ -16,6 +16,8 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 # ------------------------------------------------------------------------
 
+import math
+import warnings
 from typing import Optional
 
 import torch
@@ -23,17 +25,22 @@ import torch.utils.checkpoint as checkpoint
 from torch import Tensor, nn
 
 from groundingdino.util.misc import inverse_sigmoid
+from groundingdino.util.numerics import NumericsMonitor
 
 from .fuse_modules import BiAttentionBlock
 from .ms_deform_attn import MultiScaleDeformableAttention as MSDeformAttn
 from .transformer_vanilla import TransformerEncoderLayer
 from .utils import (
     MLP,
+    ShapeCache,
     _get_activation_fn,
     _get_clones,
+    gather_tokens,
     gen_encoder_output_proposals,
     gen_sineembed_for_position,
     get_sine_pos_embed,
+    scatter_tokens,
+    use_sdpa,
 )
 
 
@@ -71,6 +78,15 @@ class Transformer(nn.Module):
         text_dropout=0.1,
         fusion_dropout=0.1,
         fusion_droppath=0.0,
+        fusion_attn_chunk_size=0,
+        attn_backend="native",
+        # encoder token pruning
+        enc_token_keep_ratio=1.0,
+        enc_token_keep_ratio_eval=None,
+        shape_cache_size=32,
+        # nan / inf monitoring
+        numerics_monitor="off",
+        numerics_monitor_interval=100,
     ):
         super().__init__()
         self.num_feature_levels = num_feature_levels
@@ -79,6 +95,8 @@ class Transformer(nn.Module):
         self.num_decoder_layers = num_decoder_layers
         self.num_queries = num_queries
         assert query_dim == 4
+        if attn_backend == "sdpa" and not use_sdpa(attn_backend):
+            warnings.warn("attn_backend 'sdpa' needs torch >= 2.0, using the native attention")
 
         # choose encoder layer type
         encoder_layer = DeformableTransformerEncoderLayer(
@@ -91,6 +109,7 @@ class Transformer(nn.Module):
                 nhead=nhead // 2,
                 dim_feedforward=dim_feedforward // 2,
                 dropout=text_dropout,
+                attn_backend=attn_backend,
             )
         else:
             text_enhance_layer = None
@@ -103,6 +122,8 @@ class Transformer(nn.Module):
                 num_heads=nhead // 2,
                 dropout=fusion_dropout,
                 drop_path=fusion_droppath,
+                chunk_size=fusion_attn_chunk_size,
+                attn_backend=attn_backend,
             )
         else:
             feature_fusion_layer = None
@@ -181,9 +202,26 @@ class Transformer(nn.Module):
         if two_stage_type == "no":
             self.init_ref_points(num_queries)  # init self.refpoint_embed
 
+        # sparse encoder: only the best scoring tokens are updated, see select_encoder_tokens
+        if enc_token_keep_ratio_eval is None:
+            enc_token_keep_ratio_eval = enc_token_keep_ratio
+        for ratio in (enc_token_keep_ratio, enc_token_keep_ratio_eval):
+            assert 0.0 < ratio <= 1.0, "encoder token keep ratio should be in (0, 1] but {}".format(ratio)
+            assert ratio == 1.0 or two_stage_type == "standard", "encoder token pruning needs two_stage_type standard"
+        self.enc_token_keep_ratio = enc_token_keep_ratio
+        self.enc_token_keep_ratio_eval = enc_token_keep_ratio_eval
+
         self.enc_out_class_embed = None
         self.enc_out_bbox_embed = None
 
+        # encoder proposals and their grids per spatial shapes, see gen_encoder_output_proposals
+        self.proposal_cache = ShapeCache(shape_cache_size)
+
+        # shared with the encoder and decoder, steps are driven by the training loop
+        self.numerics = NumericsMonitor(numerics_monitor, numerics_monitor_interval)
+        self.encoder.numerics = self.numerics
+        self.decoder.numerics = self.numerics
+
         self._reset_parameters()
 
     def _reset_parameters(self):
@@ -208,6 +246,23 @@ class Transformer(nn.Module):
     def init_ref_points(self, use_num_queries):
         self.refpoint_embed = nn.Embedding(use_num_queries, 4)
 
+    def select_encoder_tokens(self, src_flatten, mask_flatten, text_dict):
+        """Indices [bs, k] of the image tokens updated by the encoder, None to update all of them.
+
+        Tokens are ranked by their best text similarity under the two-stage head (enc_output and
+        enc_out_class_embed) applied to the encoder input, padding tokens come last. k is the keep
+        ratio of the current mode (enc_token_keep_ratio / enc_token_keep_ratio_eval) times sum(hi*wi).
+        """
+        ratio = self.enc_token_keep_ratio if self.training else self.enc_token_keep_ratio_eval
+        if ratio >= 1.0 or self.num_encoder_layers == 0:
+            return None
+        num_keep = max(int(math.ceil(ratio * src_flatten.shape[1])), 1)
+        with torch.no_grad():
+            output_memory = self.enc_output_norm(self.enc_output(src_flatten))
+            scores = self.enc_out_class_embed(output_memory, text_dict).max(-1)[0]
+            scores = scores.masked_fill(mask_flatten, float("-inf"))
+        return torch.topk(scores, num_keep, dim=1)[1]
+
     def forward(self, srcs, masks, refpoint_embed, pos_embeds, tgt, attn_mask=None, text_dict=None):
         """
         Input:
@@ -252,6 +307,8 @@ class Transformer(nn.Module):
         # two stage
         enc_topk_proposals = enc_refpoint_embed = None
 
+        token_index = self.select_encoder_tokens(src_flatten, mask_flatten, text_dict)
+
         #########################################################
         # Begin Encoder
         #########################################################
@@ -267,6 +324,7 @@ class Transformer(nn.Module):
             # we ~ the mask . False means use the token; True means pad the token
             position_ids=text_dict["position_ids"],
             text_self_attention_masks=text_dict["text_self_attention_masks"],
+            token_index=token_index,
         )
         #########################################################
         # End Encoder
@@ -283,7 +341,7 @@ class Transformer(nn.Module):
 
         if self.two_stage_type == "standard":  #把encoder的输出作为proposal
             output_memory, output_proposals = gen_encoder_output_proposals(
-                memory, mask_flatten, spatial_shapes
+                memory, mask_flatten, spatial_shapes, cache=self.proposal_cache
             )
             output_memory = self.enc_output_norm(self.enc_output(output_memory))
 
@@ -465,6 +523,7 @@ class TransformerEncoder(nn.Module):
 
         self.use_checkpoint = use_checkpoint
         self.use_transformer_ckpt = use_transformer_ckpt
+        self.numerics = None
 
     @staticmethod
     def get_reference_points(spatial_shapes, valid_ratios, device):
@@ -498,6 +557,7 @@ class TransformerEncoder(nn.Module):
         pos_text: Tensor = None,
         text_self_attention_masks: Tensor = None,
         position_ids: Tensor = None,
+        token_index: Tensor = None,
     ):
         """
         Input:
@@ -514,6 +574,8 @@ class TransformerEncoder(nn.Module):
             - pos_text: bs, n_text, 256
 
             - position_ids: bs, n_text
+            - token_index: None or [bs, k], only these image tokens are updated by the fusion and
+                deformable layers, the others are carried through unchanged
         Intermedia:
             - reference_points: [bs, sum(hi*wi), num_level, 2]
         Outpus:
@@ -551,21 +613,30 @@ class TransformerEncoder(nn.Module):
             #     if os.environ.get('IPDB_SHILONG_DEBUG', None) == 'INFO':
             #         import ipdb; ipdb.set_trace()
             if self.fusion_layers:
+                if token_index is not None:
+                    fusion_v = gather_tokens(output, token_index)
+                    fusion_mask_v = gather_tokens(key_padding_mask, token_index)
+                else:
+                    fusion_v, fusion_mask_v = output, key_padding_mask
                 if self.use_checkpoint:
-                    output, memory_text = checkpoint.checkpoint(
+                    fusion_v, memory_text = checkpoint.checkpoint(
                         self.fusion_layers[layer_id],
-                        output,
+                        fusion_v,
                         memory_text,
-                        key_padding_mask,
+                        fusion_mask_v,
                         text_attention_mask,
                     )
                 else:
-                    output, memory_text = self.fusion_layers[layer_id](
-                        v=output,
+                    fusion_v, memory_text = self.fusion_layers[layer_id](
+                        v=fusion_v,
                         l=memory_text,
-                        attention_mask_v=key_padding_mask,
+                        attention_mask_v=fusion_mask_v,
                         attention_mask_l=text_attention_mask,
                     )
+                output = scatter_tokens(output, token_index, fusion_v) if token_index is not None else fusion_v
+                if self.numerics is not None:
+                    self.numerics.check(f"encoder.fusion{layer_id}.image", output)
+                    self.numerics.check(f"encoder.fusion{layer_id}.text", memory_text)
 
             if self.text_layers:
                 memory_text = self.text_layers[layer_id](
@@ -574,6 +645,8 @@ class TransformerEncoder(nn.Module):
                     src_key_padding_mask=text_attention_mask,
                     pos=(pos_text.transpose(0, 1) if pos_text is not None else None),
                 ).transpose(0, 1)
+                if self.numerics is not None:
+                    self.numerics.check(f"encoder.text{layer_id}", memory_text)
 
             # main process
             if self.use_transformer_ckpt:
@@ -585,6 +658,7 @@ class TransformerEncoder(nn.Module):
                     spatial_shapes,
                     level_start_index,
                     key_padding_mask,
+                    token_index,
                 )
             else:
                 output = layer(
@@ -594,7 +668,10 @@ class TransformerEncoder(nn.Module):
                     spatial_shapes=spatial_shapes,
                     level_start_index=level_start_index,
                     key_padding_mask=key_padding_mask,
+                    token_index=token_index,
                 )
+            if self.numerics is not None:
+                self.numerics.check(f"encoder.layer{layer_id}", output)
 
         return output, memory_text
 
@@ -633,6 +710,7 @@ class TransformerDecoder(nn.Module):
         self.d_model = d_model
 
         self.ref_anchor_head = None
+        self.numerics = None
 
     def forward(
         self,
@@ -707,16 +785,8 @@ class TransformerDecoder(nn.Module):
                 self_attn_mask=tgt_mask,
                 cross_attn_mask=memory_mask,
             )
-            if output.isnan().any() | output.isinf().any():
-                print(f"output layer_id {layer_id} is nan")
-                try:
-                    num_nan = output.isnan().sum().item()
-                    num_inf = output.isinf().sum().item()
-                    print(f"num_nan {num_nan}, num_inf {num_inf}")
-                except Exception as e:
-                    print(e)
-                    # if os.environ.get("SHILONG_AMP_INFNAN_DEBUG") == '1':
-                    #     import ipdb; ipdb.set_trace()
+            if self.numerics is not None:
+                self.numerics.check(f"decoder.layer{layer_id}", output)
 
             # iter update
             if self.bbox_embed is not None:
@@ -786,25 +856,40 @@ class DeformableTransformerEncoderLayer(nn.Module):
         return src
 
     def forward(
-        self, src, pos, reference_points, spatial_shapes, level_start_index, key_padding_mask=None
+        self,
+        src,
+        pos,
+        reference_points,
+        spatial_shapes,
+        level_start_index,
+        key_padding_mask=None,
+        token_index=None,
     ):
+        """token_index: None or [bs, k], the tokens used as queries and updated, all tokens remain values."""
+        query, query_pos, query_ref = src, pos, reference_points
+        if token_index is not None:
+            query, query_pos = gather_tokens(src, token_index), gather_tokens(pos, token_index)
+            query_ref = gather_tokens(reference_points, token_index)
+
         # self attention
         # import ipdb; ipdb.set_trace()
         src2 = self.self_attn(
-            query=self.with_pos_embed(src, pos),
-            reference_points=reference_points,
+            query=self.with_pos_embed(query, query_pos),
+            reference_points=query_ref,
             value=src,
             spatial_shapes=spatial_shapes,
             level_start_index=level_start_index,
             key_padding_mask=key_padding_mask,
         )
-        src = src + self.dropout1(src2)
-        src = self.norm1(src)
+        query = query + self.dropout1(src2)
+        query = self.norm1(query)
 
         # ffn
-        src = self.forward_ffn(src)
+        query = self.forward_ffn(query)
 
-        return src
+        if token_index is not None:
+            return scatter_tokens(src, token_index, query)
+        return query
 
 
 class DeformableTransformerDecoderLayer(nn.Module):
@@ -964,4 +1049,11 @@ def build_transformer(args):
         text_dropout=args.text_dropout,
         fusion_dropout=args.fusion_dropout,
         fusion_droppath=args.fusion_droppath,
+        fusion_attn_chunk_size=getattr(args, "fusion_attn_chunk_size", 0),
+        attn_backend=getattr(args, "attn_backend", "native"),
+        enc_token_keep_ratio=getattr(args, "enc_token_keep_ratio", 1.0),
+        enc_token_keep_ratio_eval=getattr(args, "enc_token_keep_ratio_eval", None),
+        shape_cache_size=getattr(args, "shape_cache_size", 32),
+        numerics_monitor=getattr(args, "numerics_monitor", "off"),
+        numerics_monitor_interval=getattr(args, "numerics_monitor_interval", 100),
     )
@@ -26,12 +26,16 @@ from .utils import (
     _get_clones,
     gen_encoder_output_proposals,
     gen_sineembed_for_position,
+    scaled_dot_product_attention,
     sigmoid_focal_loss,
+    use_sdpa,
 )
 
 
 class TextTransformer(nn.Module):
-    def __init__(self, num_layers, d_model=256, nheads=8, dim_feedforward=2048, dropout=0.1):
+    def __init__(
+        self, num_layers, d_model=256, nheads=8, dim_feedforward=2048, dropout=0.1, attn_backend="native"
+    ):
         super().__init__()
         self.num_layers = num_layers
         self.d_model = d_model
@@ -40,7 +44,11 @@ class TextTransformer(nn.Module):
         self.norm = None
 
         single_encoder_layer = TransformerEncoderLayer(
-            d_model=d_model, nhead=nheads, dim_feedforward=dim_feedforward, dropout=dropout
+            d_model=d_model,
+            nhead=nheads,
+            dim_feedforward=dim_feedforward,
+            dropout=dropout,
+            attn_backend=attn_backend,
         )
         self.layers = _get_clones(single_encoder_layer, num_layers)
 
@@ -78,6 +86,7 @@ class TransformerEncoderLayer(nn.Module):
         dropout=0.1,
         activation="relu",
         normalize_before=False,
+        attn_backend="native",
     ):
         super().__init__()
         self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
@@ -94,6 +103,7 @@ class TransformerEncoderLayer(nn.Module):
         self.activation = _get_activation_fn(activation)
         self.normalize_before = normalize_before
         self.nhead = nhead
+        self.attn_backend = attn_backend
 
     def with_pos_embed(self, tensor, pos: Optional[Tensor]):
         return tensor if pos is None else tensor + pos
@@ -112,7 +122,10 @@ class TransformerEncoderLayer(nn.Module):
 
         q = k = self.with_pos_embed(src, pos)
 
-        src2 = self.self_attn(q, k, value=src, attn_mask=src_mask)[0]
+        if use_sdpa(self.attn_backend):
+            src2 = self._sdpa_self_attn(q, k, src, src_mask)
+        else:
+            src2 = self.self_attn(q, k, value=src, attn_mask=src_mask)[0]
 
         # src2 = self.self_attn(q, k, value=src, attn_mask=src_mask, key_padding_mask=src_key_padding_mask)[0]
         src = src + self.dropout1(src2)
@@ -121,3 +134,28 @@ class TransformerEncoderLayer(nn.Module):
         src = src + self.dropout2(src2)
         src = self.norm2(src)
         return src
+
+    def _sdpa_self_attn(self, q, k, v, attn_mask=None):
+        """self.self_attn(q, k, value=v, attn_mask=attn_mask)[0] through F.scaled_dot_product_attention.
+
+        Reuses the projection weights of self.self_attn, so checkpoints load unchanged. attn_mask follows
+        nn.MultiheadAttention: [L, S] or [bs*nhead, L, S], boolean True = not allowed to attend, or additive.
+        """
+        tgt_len, bsz, d_model = q.shape
+        head_dim = d_model // self.nhead
+        w_q, w_k, w_v = self.self_attn.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = self.self_attn.in_proj_bias.chunk(3)
+        heads = lambda x: x.view(x.shape[0], bsz, self.nhead, head_dim).permute(1, 2, 0, 3)
+        q, k, v = heads(F.linear(q, w_q, b_q)), heads(F.linear(k, w_k, b_k)), heads(F.linear(v, w_v, b_v))
+
+        if attn_mask is not None:
+            if attn_mask.dim() == 3:
+                # nn.MultiheadAttention reads the first dim as batch-major (b * nhead + h)
+                attn_mask = attn_mask.view(bsz, self.nhead, *attn_mask.shape[-2:])
+            if attn_mask.dtype == torch.bool:
+                attn_mask = ~attn_mask
+        out = scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_mask, dropout_p=self.self_attn.dropout if self.training else 0.0
+        )
+        out = out.permute(2, 0, 1, 3).reshape(tgt_len, bsz, d_model)
+        return self.self_attn.out_proj(out)
@@ -7,6 +7,7 @@
 
 import copy
 import math
+from collections import OrderedDict
 
 import torch
 import torch.nn.functional as F
@@ -53,8 +54,76 @@ def get_sine_pos_embed(
     return pos_res
 
 
+def gather_tokens(x, index):
+    """x[b, index[b]] for x of shape [bs, n, ...] and index of shape [bs, k]."""
+    index = index.view(*index.shape, *(1,) * (x.dim() - 2)).expand(-1, -1, *x.shape[2:])
+    return torch.gather(x, 1, index)
+
+
+def scatter_tokens(x, index, src):
+    """Out-of-place x[b, index[b]] = src[b], the inverse of gather_tokens."""
+    index = index.view(*index.shape, *(1,) * (x.dim() - 2)).expand(-1, -1, *x.shape[2:])
+    return x.scatter(1, index, src)
+
+
+class ShapeCache:
+    """Bounded LRU cache of tensors that only depend on shapes (and device), with hit counters.
+
+    Cached tensors are shared between calls, callers must not modify them in place.
+
+    Args:
+        max_entries (int): maximal number of cached entries, 0 disables the cache.
+    """
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, create_fn):
+        """Return the entry of key, calling create_fn() to build it on a miss."""
+        if self.max_entries <= 0:
+            return create_fn()
+        entry = self._entries.get(key, None)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = create_fn()
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
+
+
+def _proposal_grid(H_, W_, device):
+    """H_, W_, 2 grid of the (x, y) cell centers of a level, in cells."""
+    grid_y, grid_x = torch.meshgrid(
+        torch.linspace(0, H_ - 1, H_, dtype=torch.float32, device=device),
+        torch.linspace(0, W_ - 1, W_, dtype=torch.float32, device=device),
+    )
+    return torch.cat([grid_x.unsqueeze(-1), grid_y.unsqueeze(-1)], -1) + 0.5  # H_, W_, 2
+
+
 def gen_encoder_output_proposals(
-    memory: Tensor, memory_padding_mask: Tensor, spatial_shapes: Tensor, learnedwh=None
+    memory: Tensor, memory_padding_mask: Tensor, spatial_shapes: Tensor, learnedwh=None, cache=None
 ):
     """
     Input:
@@ -62,10 +131,42 @@ def gen_encoder_output_proposals(
         - memory_padding_mask: bs, \sum{hw}
         - spatial_shapes: nlevel, 2
         - learnedwh: 2
+        - cache: optional ShapeCache. Without padding and learnedwh the proposals only depend on
+            spatial_shapes and are cached whole, otherwise only the per-level grids are.
     Output:
         - output_memory: bs, \sum{hw}, d_model
         - output_proposals: bs, \sum{hw}, 4
     """
+    if cache is not None and learnedwh is None and not memory_padding_mask.any():
+        shapes = tuple(tuple(shape) for shape in spatial_shapes.tolist())
+        key = ("proposals", shapes, str(memory.device))
+        output_proposals, output_proposals_valid = cache.get(
+            key,
+            lambda: _gen_output_proposals(
+                memory.new_zeros((1, memory.shape[1], 1)), memory_padding_mask[:1], spatial_shapes
+            ),
+        )
+        output_memory = memory.masked_fill(~output_proposals_valid, float(0))
+        return output_memory, output_proposals.expand(memory.shape[0], -1, -1)
+
+    output_proposals, output_proposals_valid = _gen_output_proposals(
+        memory, memory_padding_mask, spatial_shapes, learnedwh, cache
+    )
+    output_memory = memory
+    output_memory = output_memory.masked_fill(memory_padding_mask.unsqueeze(-1), float(0))
+    output_memory = output_memory.masked_fill(~output_proposals_valid, float(0))
+
+    # output_memory = output_memory.masked_fill(memory_padding_mask.unsqueeze(-1), float('inf'))
+    # output_memory = output_memory.masked_fill(~output_proposals_valid, float('inf'))
+
+    return output_memory, output_proposals
+
+
+def _gen_output_proposals(memory, memory_padding_mask, spatial_shapes, learnedwh=None, cache=None):
+    """Unsigmoided proposals [bs, \sum{hw}, 4] and their validity [bs, \sum{hw}, 1].
+
+    memory is only read for its shape and device.
+    """
     N_, S_, C_ = memory.shape
     proposals = []
     _cur = 0
@@ -76,14 +177,16 @@ def gen_encoder_output_proposals(
 
         # import ipdb; ipdb.set_trace()
 
-        grid_y, grid_x = torch.meshgrid(
-            torch.linspace(0, H_ - 1, H_, dtype=torch.float32, device=memory.device),
-            torch.linspace(0, W_ - 1, W_, dtype=torch.float32, device=memory.device),
-        )
-        grid = torch.cat([grid_x.unsqueeze(-1), grid_y.unsqueeze(-1)], -1)  # H_, W_, 2
+        if cache is not None:
+            H_, W_ = int(H_), int(W_)
+            grid = cache.get(
+                ("grid", H_, W_, str(memory.device)), lambda: _proposal_grid(H_, W_, memory.device)
+            )
+        else:
+            grid = _proposal_grid(H_, W_, memory.device)
 
         scale = torch.cat([valid_W.unsqueeze(-1), valid_H.unsqueeze(-1)], 1).view(N_, 1, 1, 2)
-        grid = (grid.unsqueeze(0).expand(N_, -1, -1, -1) + 0.5) / scale
+        grid = grid.unsqueeze(0).expand(N_, -1, -1, -1) / scale
 
         if learnedwh is not None:
             # import ipdb; ipdb.set_trace()
@@ -105,15 +208,7 @@ def gen_encoder_output_proposals(
     output_proposals = torch.log(output_proposals / (1 - output_proposals))  # unsigmoid
     output_proposals = output_proposals.masked_fill(memory_padding_mask.unsqueeze(-1), float("inf"))
     output_proposals = output_proposals.masked_fill(~output_proposals_valid, float("inf"))
-
-    output_memory = memory
-    output_memory = output_memory.masked_fill(memory_padding_mask.unsqueeze(-1), float(0))
-    output_memory = output_memory.masked_fill(~output_proposals_valid, float(0))
-
-    # output_memory = output_memory.masked_fill(memory_padding_mask.unsqueeze(-1), float('inf'))
-    # output_memory = output_memory.masked_fill(~output_proposals_valid, float('inf'))
-
-    return output_memory, output_proposals
+    return output_proposals, output_proposals_valid
 
 
 class RandomBoxPerturber:
@@ -231,13 +326,16 @@ def gen_sineembed_for_position(pos_tensor):
 
 
 class ContrastiveEmbed(nn.Module):
-    def __init__(self, max_text_len=256):
+    def __init__(self, max_text_len=256, pad_to_max_text_len=True):
         """
         Args:
             max_text_len: max length of text.
+            pad_to_max_text_len: pad the logits with -inf up to max_text_len. If False, the logits keep
+                one column per text token and consumers that need max_text_len columns use pad_text_logits.
         """
         super().__init__()
         self.max_text_len = max_text_len
+        self.pad_to_max_text_len = pad_to_max_text_len
 
     def forward(self, x, text_dict):
         """_summary_
@@ -266,8 +364,54 @@ class ContrastiveEmbed(nn.Module):
         # 接着，对res进行掩码操作，将未使用的文本token（即padding的token）对应的得分置为负无穷float("-inf")。这是为了在计算相似度时，排除padding部分的影响。
 
 
+        if not self.pad_to_max_text_len:
+            return res  #torch.Size([2, 16320, 195])
+
         # padding to max_text_len
-        new_res = torch.full((*res.shape[:-1], self.max_text_len), float("-inf"), device=res.device)
-        new_res[..., : res.shape[-1]] = res  #torch.Size([2, 16320, 195])
+        return pad_text_logits(res, self.max_text_len)
+
+
+def pad_text_logits(logits, max_text_len=256):
+    """Pad [..., n_token] text logits with -inf up to [..., max_text_len]."""
+    new_logits = torch.full((*logits.shape[:-1], max_text_len), float("-inf"), device=logits.device)
+    new_logits[..., : logits.shape[-1]] = logits
+    return new_logits
+
 
-        return new_res
+def pad_text_token_mask(text_token_mask, max_text_len=256):
+    """Pad a [bs, n_token] text token mask with False up to [bs, max_text_len].
+
+    The padded mask lines up with the logits padded by ContrastiveEmbed.
+    """
+    bs, len_td = text_token_mask.shape
+    text_mask = text_token_mask.new_zeros((bs, max_text_len), dtype=torch.bool)
+    text_mask[:, :len_td] = text_token_mask[:, :max_text_len]
+    return text_mask
+
+
+ATTN_BACKENDS = ("native", "sdpa")
+
+
+def use_sdpa(attn_backend):
+    """Whether attention should go through F.scaled_dot_product_attention.
+
+    "sdpa" falls back to the native implementation on torch versions without it (< 2.0).
+    """
+    assert attn_backend in ATTN_BACKENDS, f"unknown attention backend {attn_backend}, use one of {ATTN_BACKENDS}"
+    return attn_backend == "sdpa" and hasattr(F, "scaled_dot_product_attention")
+
+
+def scaled_dot_product_attention(query, key, value, attn_mask=None, dropout_p=0.0):
+    """F.scaled_dot_product_attention, attn_mask is boolean with True = attend, or additive.
+
+    Query rows allowed to attend to no key come out NaN, as the softmax of the native attention over
+    -inf logits, whatever the torch version (recent ones return zeros for them).
+    """
+    out = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask, dropout_p=dropout_p)
+    if attn_mask is not None:
+        if attn_mask.dtype == torch.bool:
+            blocked = ~attn_mask.any(-1)
+        else:
+            blocked = torch.isneginf(attn_mask).all(-1)
+        out = out.masked_fill(blocked[..., None], float("nan"))
+    return out
@@ -0,0 +1,93 @@
+"""
+Features served by BackboneFeatureCache against the ones the backbone computes.
+"""
+from collections import OrderedDict
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("numpy")
+pytest.importorskip("transformers")  # imported by the models package
+pytest.importorskip("timm")
+
+import torch.nn as nn  # noqa: E402
+import torch.nn.functional as F  # noqa: E402
+
+from groundingdino.util.misc import NestedTensor  # noqa: E402
+from models.GroundingDINO.backbone.feature_cache import BackboneFeatureCache  # noqa: E402
+
+
+class _Backbone(nn.Module):
+    def __init__(self, drop=0.0):
+        super().__init__()
+        self.convs = nn.ModuleList(
+            [nn.Conv2d(3, 4, 3, stride=2, padding=1), nn.Conv2d(4, 8, 3, stride=2, padding=1)]
+        )
+        self.drop = nn.Dropout(drop)
+        self.double()
+        for p in self.parameters():
+            p.requires_grad_(False)
+
+    def forward(self, tensor_list):
+        x, m = tensor_list.decompose()
+        out = OrderedDict()
+        for i, conv in enumerate(self.convs):
+            x = self.drop(conv(x))
+            mask = F.interpolate(m[None].float(), size=x.shape[-2:]).to(torch.bool)[0]
+            out[str(i)] = NestedTensor(x, mask)
+        return out
+
+
+def _batch(order=(0, 1, 2)):
+    g = torch.Generator().manual_seed(0)
+    images = torch.randn(3, 3, 32, 40, generator=g, dtype=torch.float64)
+    mask = torch.zeros(3, 32, 40, dtype=torch.bool)
+    mask[1, 20:] = True
+    mask[2, :, 24:] = True
+    images = images.masked_fill(mask[:, None], 0)
+    order = list(order)
+    return NestedTensor(images[order], mask[order]), [("image", i) for i in order]
+
+
+def _assert_equal(outs, refs):
+    # up to the rounding of convolutions over batches of another size
+    for out, ref in zip(outs, refs):
+        assert out.tensors.dtype == ref.tensors.dtype
+        assert torch.allclose(out.tensors, ref.tensors, rtol=0, atol=1e-12)
+        assert torch.equal(out.mask, ref.mask)
+
+
+def test_hits_equal_the_computed_features(tmp_path):
+    backbone = _Backbone().eval()
+    cache = BackboneFeatureCache(str(tmp_path))
+    samples, keys = _batch()
+    refs = list(backbone(samples).values())
+    _assert_equal(cache(backbone, samples, 2, keys), refs)
+    assert cache.stats()["misses"] == 3
+
+    # served in another batch order, next to an image without key
+    samples, keys = _batch((2, 0, 1))
+    keys[2] = None
+    refs = list(backbone(samples).values())
+    _assert_equal(cache(backbone, samples, 2, keys), refs)
+    assert (cache.hits, cache.misses) == (2, 4)
+
+
+def test_bypassed_while_not_deterministic(tmp_path):
+    backbone = _Backbone(drop=0.5).train()
+    cache = BackboneFeatureCache(str(tmp_path))
+    samples, keys = _batch()
+    with pytest.warns(UserWarning):
+        cache(backbone, samples, 2, keys)
+    assert (cache.hits, cache.misses, cache.bypassed) == (0, 0, 3)
+    assert not any(tmp_path.iterdir())
+
+
+def test_max_bytes_counts_the_directory(tmp_path):
+    backbone = _Backbone().eval()
+    samples, keys = _batch()
+    BackboneFeatureCache(str(tmp_path))(backbone, samples, 2, keys[:1] + [None, None])
+    # another process finds the directory full
+    cache = BackboneFeatureCache(str(tmp_path), max_bytes=1)
+    cache(backbone, samples, 2, keys)
+    assert len(list(tmp_path.glob("*/*.npy"))) == 2
@@ -0,0 +1,147 @@
+"""
+The vectorized special token masks against the former per-special-token loops.
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")  # imported by the models package
+
+from models.GroundingDINO.bertwarper import (  # noqa: E402
+    generate_masks_with_special_tokens,
+    generate_masks_with_special_tokens_and_transfer_map,
+)
+
+CLS, SEP, DOT = 101, 102, 1012
+SPECIAL_TOKENS = [CLS, SEP, DOT, 1029]  # "?" is the fourth separator
+
+
+def generate_masks_loop(tokenized, special_tokens_list):
+    """The former generate_masks_with_special_tokens."""
+    input_ids = tokenized["input_ids"]
+    bs, num_token = input_ids.shape
+    special_tokens_mask = torch.zeros((bs, num_token), device=input_ids.device).bool()
+    for special_token in special_tokens_list:
+        special_tokens_mask |= input_ids == special_token
+    idxs = torch.nonzero(special_tokens_mask)
+    attention_mask = (
+        torch.eye(num_token, device=input_ids.device).bool().unsqueeze(0).repeat(bs, 1, 1)
+    )
+    position_ids = torch.zeros((bs, num_token), device=input_ids.device)
+    previous_col = 0
+    for i in range(idxs.shape[0]):
+        row, col = idxs[i]
+        if (col == 0) or (col == num_token - 1):
+            attention_mask[row, col, col] = True
+            position_ids[row, col] = 0
+        else:
+            attention_mask[row, previous_col + 1 : col + 1, previous_col + 1 : col + 1] = True
+            position_ids[row, previous_col + 1 : col + 1] = torch.arange(
+                0, col - previous_col, device=input_ids.device
+            )
+        previous_col = col
+    return attention_mask, position_ids.to(torch.long)
+
+
+def special_token_masks_loop(tokenized, special_tokens_list):
+    """The former per-special-token generate_masks_with_special_tokens_and_transfer_map."""
+    input_ids = tokenized["input_ids"]
+    bs, num_token = input_ids.shape
+    special_tokens_mask = torch.zeros((bs, num_token), device=input_ids.device).bool()
+    for special_token in special_tokens_list:
+        special_tokens_mask |= input_ids == special_token
+    idxs = torch.nonzero(special_tokens_mask)
+    attention_mask = (
+        torch.eye(num_token, device=input_ids.device).bool().unsqueeze(0).repeat(bs, 1, 1)
+    )
+    position_ids = torch.zeros((bs, num_token), device=input_ids.device)
+    cate_to_token_mask_list = [[] for _ in range(bs)]
+    previous_col = 0
+    for i in range(idxs.shape[0]):
+        row, col = idxs[i]
+        if (col == 0) or (col == num_token - 1):
+            attention_mask[row, col, col] = True
+            position_ids[row, col] = 0
+        else:
+            attention_mask[row, previous_col + 1 : col + 1, previous_col + 1 : col + 1] = True
+            position_ids[row, previous_col + 1 : col + 1] = torch.arange(
+                0, col - previous_col, device=input_ids.device
+            )
+            c2t_maski = torch.zeros((num_token), device=input_ids.device).bool()
+            c2t_maski[previous_col + 1 : col] = True
+            cate_to_token_mask_list[row].append(c2t_maski)
+        previous_col = col
+    cate_to_token_mask_list = [torch.stack(c2t, dim=0) for c2t in cate_to_token_mask_list]
+    return attention_mask, position_ids.to(torch.long), cate_to_token_mask_list
+
+
+def _tokenized(rows):
+    """Pad the rows of token ids with 0 as the tokenizer does with padding="longest"."""
+    num_token = max(len(r) for r in rows)
+    input_ids = torch.zeros((len(rows), num_token), dtype=torch.long)
+    for i, r in enumerate(rows):
+        input_ids[i, : len(r)] = torch.as_tensor(r)
+    return {"input_ids": input_ids}
+
+
+def _assert_same_masks(tokenized, with_categories=True):
+    ref_attention, ref_position = generate_masks_loop(tokenized, SPECIAL_TOKENS)
+    attention, position = generate_masks_with_special_tokens(tokenized, SPECIAL_TOKENS, None)
+    assert torch.equal(attention, ref_attention)
+    assert torch.equal(position, ref_position)
+
+    attention, position, categories = generate_masks_with_special_tokens_and_transfer_map(
+        tokenized, SPECIAL_TOKENS, None
+    )
+    assert torch.equal(attention, ref_attention)
+    assert torch.equal(position, ref_position)
+    if with_categories:
+        _, _, ref_categories = special_token_masks_loop(tokenized, SPECIAL_TOKENS)
+        assert len(categories) == len(ref_categories)
+        for c, ref_c in zip(categories, ref_categories):
+            assert torch.equal(c, ref_c)
+    return categories
+
+
+@pytest.mark.parametrize(
+    "rows",
+    [
+        # a single caption
+        [[CLS, 2001, DOT, 2002, 2003, DOT, SEP]],
+        # consecutive separators
+        [[CLS, 2001, DOT, DOT, 2002, DOT, SEP]],
+        [[CLS, DOT, DOT, 2001, DOT, SEP]],
+        # trailing padding and batch > 1 with different label counts
+        [
+            [CLS, 2001, DOT, SEP],
+            [CLS, 2001, 2002, DOT, 2003, DOT, 2004, 2005, 2006, DOT, SEP],
+            [CLS, 2001, DOT, 2002, DOT, SEP],
+        ],
+        # "?" as separator
+        [[CLS, 2001, 1029, 2002, DOT, SEP], [CLS, 2001, DOT, SEP]],
+    ],
+)
+def test_masks_match_former_loop(rows):
+    _assert_same_masks(_tokenized(rows))
+
+
+def test_no_special_token_after_cls():
+    # the former transfer map loop cannot stack the empty category list of such a row
+    tokenized = _tokenized([[CLS, 2001, 2002], [CLS, 2001, DOT, 2002, DOT, SEP]])
+    categories = _assert_same_masks(tokenized, with_categories=False)
+    assert categories[0].shape == (0, tokenized["input_ids"].shape[1])
+
+    # the categories of the other row as computed alone by the former loop
+    alone = _tokenized([[CLS, 2001, DOT, 2002, DOT, SEP]])
+    _, _, ref_categories = special_token_masks_loop(alone, SPECIAL_TOKENS)
+    assert torch.equal(categories[1], ref_categories[0])
+
+
+def test_random_captions():
+    torch.manual_seed(0)
+    rows = []
+    for num_labels in (1, 3, 7, 20):
+        ids = [CLS]
+        for _ in range(num_labels):
+            ids += torch.randint(2000, 3000, (int(torch.randint(1, 4, (1,))),)).tolist() + [DOT]
+        rows.append(ids + [SEP])
+    _assert_same_masks(_tokenized(rows))
@@ -0,0 +1,79 @@
+"""
+The chunked attention of BiMultiHeadAttention against its dense path.
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")  # imported by the models package
+pytest.importorskip("timm")
+
+from models.GroundingDINO.fuse_modules import BiMultiHeadAttention  # noqa: E402
+
+
+def _attention(chunk_size):
+    torch.manual_seed(0)
+    # dropout disabled, the chunked and dense paths draw different dropout masks
+    return BiMultiHeadAttention(
+        v_dim=32, l_dim=24, embed_dim=64, num_heads=4, dropout=0.0, chunk_size=chunk_size
+    ).double()
+
+
+def _inputs(bs=3, n_img=50, n_txt=12):
+    g = torch.Generator().manual_seed(0)
+    v = torch.randn(bs, n_img, 32, generator=g, dtype=torch.float64)
+    l = torch.randn(bs, n_txt, 24, generator=g, dtype=torch.float64)
+    # padded image tokens past a different length per image, padded text tokens past a few labels
+    mask_v = torch.arange(n_img)[None] >= torch.tensor([n_img, n_img - 13, n_img // 3])[:, None]
+    mask_l = torch.arange(n_txt)[None] >= torch.tensor([n_txt, n_txt // 2, 1])[:, None]
+    return v, l, mask_v, mask_l
+
+
+def _forward_backward(attn, v, l, mask_v, mask_l):
+    v = v.clone().requires_grad_()
+    l = l.clone().requires_grad_()
+    out_v, out_l = attn(v, l, attention_mask_v=mask_v, attention_mask_l=mask_l)
+    grad_v = torch.linspace(-1, 1, out_v.numel(), dtype=out_v.dtype).view_as(out_v)
+    grad_l = torch.linspace(1, -1, out_l.numel(), dtype=out_l.dtype).view_as(out_l)
+    torch.autograd.backward((out_v, out_l), (grad_v, grad_l))
+    grads = {"v": v.grad, "l": l.grad}
+    grads.update({name: p.grad for name, p in attn.named_parameters()})
+    return (out_v.detach(), out_l.detach()), grads
+
+
+@pytest.mark.parametrize("chunk_size", [7, 16, 49])
+@pytest.mark.parametrize("masked", [False, True])
+def test_chunked_matches_dense(chunk_size, masked):
+    v, l, mask_v, mask_l = _inputs()
+    if not masked:
+        mask_v = mask_l = None
+    dense_out, dense_grads = _forward_backward(_attention(0), v, l, mask_v, mask_l)
+    chunked_out, chunked_grads = _forward_backward(_attention(chunk_size), v, l, mask_v, mask_l)
+    for out, ref in zip(chunked_out, dense_out):
+        assert torch.allclose(out, ref, rtol=1e-9, atol=1e-12)
+    for name, ref in dense_grads.items():
+        assert torch.allclose(chunked_grads[name], ref, rtol=1e-9, atol=1e-12), name
+
+
+def test_chunked_matches_dense_with_large_logits():
+    # logits spread over more than the +-50000 clamps, whose shifts the chunked path reproduces
+    v, l, mask_v, mask_l = _inputs()
+    dense, chunked = _attention(0), _attention(16)
+    with torch.no_grad():
+        for attn in (dense, chunked):
+            attn.v_proj.weight.mul_(300)
+            attn.l_proj.weight.mul_(300)
+        dense_out = dense(v, l, attention_mask_v=mask_v, attention_mask_l=mask_l)
+        chunked_out = chunked(v, l, attention_mask_v=mask_v, attention_mask_l=mask_l)
+    for out, ref in zip(chunked_out, dense_out):
+        assert torch.allclose(out, ref, rtol=1e-9, atol=1e-9)
+
+
+def test_chunk_size_at_least_n_img_is_dense():
+    v, l, mask_v, mask_l = _inputs()
+    attn = _attention(64)
+    with torch.no_grad():
+        out = attn(v, l, attention_mask_v=mask_v, attention_mask_l=mask_l)
+        attn.chunk_size = 0
+        ref = attn(v, l, attention_mask_v=mask_v, attention_mask_l=mask_l)
+    for o, r in zip(out, ref):
+        assert torch.equal(o, r)
@@ -0,0 +1,109 @@
+"""
+The gather implementation of multi_scale_deformable_attn_pytorch against the former grid_sample one.
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")  # imported by the models package
+pytest.importorskip("timm")
+
+import torch.nn.functional as F  # noqa: E402
+
+from models.GroundingDINO.ms_deform_attn import multi_scale_deformable_attn_pytorch  # noqa: E402
+
+LEVEL_SHAPES = [(12, 17), (6, 9), (3, 5), (1, 2)]
+
+
+def multi_scale_deformable_attn_grid_sample(
+    value, value_spatial_shapes, sampling_locations, attention_weights
+):
+    """The former per-level F.grid_sample implementation of multi_scale_deformable_attn_pytorch."""
+    bs, _, num_heads, embed_dims = value.shape
+    _, num_queries, num_heads, num_levels, num_points, _ = sampling_locations.shape
+    value_list = value.split([H_ * W_ for H_, W_ in value_spatial_shapes], dim=1)
+    sampling_grids = 2 * sampling_locations - 1
+    sampling_value_list = []
+    for level, (H_, W_) in enumerate(value_spatial_shapes):
+        value_l_ = (
+            value_list[level].flatten(2).transpose(1, 2).reshape(bs * num_heads, embed_dims, H_, W_)
+        )
+        sampling_grid_l_ = sampling_grids[:, :, :, level].transpose(1, 2).flatten(0, 1)
+        sampling_value_l_ = F.grid_sample(
+            value_l_, sampling_grid_l_, mode="bilinear", padding_mode="zeros", align_corners=False
+        )
+        sampling_value_list.append(sampling_value_l_)
+    attention_weights = attention_weights.transpose(1, 2).reshape(
+        bs * num_heads, 1, num_queries, num_levels * num_points
+    )
+    output = (
+        (torch.stack(sampling_value_list, dim=-2).flatten(-2) * attention_weights)
+        .sum(-1)
+        .view(bs, num_heads * embed_dims, num_queries)
+    )
+    return output.transpose(1, 2).contiguous()
+
+
+def _inputs(
+    bs=2, num_queries=40, num_heads=2, embed_dims=8, num_points=3, shapes=LEVEL_SHAPES,
+    dtype=torch.float64,
+):
+    g = torch.Generator().manual_seed(0)
+    spatial_shapes = torch.as_tensor(shapes, dtype=torch.long)
+    num_value = int(spatial_shapes.prod(1).sum())
+    num_levels = len(shapes)
+    value = torch.randn(bs, num_value, num_heads, embed_dims, generator=g, dtype=dtype)
+    # samples outside [0, 1] have some or all of their corners in the zero padding
+    sampling_locations = torch.rand(
+        bs, num_queries, num_heads, num_levels, num_points, 2, generator=g, dtype=dtype
+    ) * 1.4 - 0.2
+    attention_weights = (
+        torch.rand(bs, num_queries, num_heads, num_levels * num_points, generator=g, dtype=dtype)
+        .softmax(-1)
+        .view(bs, num_queries, num_heads, num_levels, num_points)
+    )
+    return value, spatial_shapes, sampling_locations, attention_weights
+
+
+def _forward_backward(fn, value, spatial_shapes, sampling_locations, attention_weights):
+    inputs = [t.clone().requires_grad_() for t in (value, sampling_locations, attention_weights)]
+    out = fn(inputs[0], spatial_shapes, inputs[1], inputs[2])
+    grad_output = torch.linspace(-1, 1, out.numel(), dtype=out.dtype).view_as(out)
+    grads = torch.autograd.grad(out, inputs, grad_output)
+    return out.detach(), grads
+
+
+def test_forward_and_gradients_match_grid_sample():
+    inputs = _inputs()
+    ref, ref_grads = _forward_backward(multi_scale_deformable_attn_grid_sample, *inputs)
+    out, grads = _forward_backward(multi_scale_deformable_attn_pytorch, *inputs)
+    assert torch.allclose(out, ref, rtol=1e-9, atol=1e-12)
+    names = ("value", "sampling_locations", "attention_weights")
+    for name, grad, ref_grad in zip(names, grads, ref_grads):
+        assert torch.allclose(grad, ref_grad, rtol=1e-9, atol=1e-12), name
+
+
+def test_locations_far_outside_contribute_nothing():
+    value, spatial_shapes, sampling_locations, attention_weights = _inputs()
+    far = (torch.rand_like(sampling_locations) < 0.5).to(sampling_locations.dtype) * 6 - 3
+    sampling_locations = sampling_locations + far
+    out = multi_scale_deformable_attn_pytorch(
+        value, spatial_shapes, sampling_locations, attention_weights
+    )
+    assert torch.equal(out, torch.zeros_like(out))
+
+
+def test_half_precision_locations_on_large_levels():
+    # at 1/8 of a 1600x2400 image, the float16 product of a location and the level width is off by up
+    # to 1/8 pixel and can fall on the wrong side of a pixel border; the reference computes in float32
+    value, spatial_shapes, sampling_locations, attention_weights = _inputs(
+        bs=1, num_heads=1, num_points=2, shapes=[(200, 300), (100, 150)], dtype=torch.float32
+    )
+    sampling_locations = sampling_locations.half()
+    attention_weights = attention_weights.half()
+    out = multi_scale_deformable_attn_pytorch(
+        value, spatial_shapes, sampling_locations, attention_weights
+    )
+    ref = multi_scale_deformable_attn_grid_sample(
+        value, spatial_shapes, sampling_locations.float(), attention_weights.float()
+    )
+    assert torch.allclose(out, ref, rtol=1e-5, atol=1e-5)
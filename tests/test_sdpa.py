@@ -0,0 +1,118 @@
+"""
+The "sdpa" attention backend against the native attention of the fusion and text enhancer layers.
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")  # imported by the models package
+pytest.importorskip("timm")
+
+import torch.nn.functional as F  # noqa: E402
+
+from models.GroundingDINO.bertwarper import generate_masks_with_special_tokens  # noqa: E402
+from models.GroundingDINO.fuse_modules import BiMultiHeadAttention  # noqa: E402
+from models.GroundingDINO.transformer_vanilla import TransformerEncoderLayer  # noqa: E402
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(F, "scaled_dot_product_attention"),
+    reason="F.scaled_dot_product_attention needs torch >= 2.0",
+)
+
+
+def _run_backends(module, *inputs, **kwargs):
+    outputs = {}
+    with torch.no_grad():
+        for backend in ("native", "sdpa"):
+            module.attn_backend = backend
+            outputs[backend] = module(*inputs, **kwargs)
+    return outputs["native"], outputs["sdpa"]
+
+
+def _fusion_inputs(bs=3, n_img=50, n_txt=12, device="cpu", dtype=torch.float32, scale=1.0):
+    v = torch.randn(bs, n_img, 32, device=device, dtype=dtype) * scale
+    l = torch.randn(bs, n_txt, 24, device=device, dtype=dtype) * scale
+    # padded image tokens, True = masked
+    mask_v = torch.zeros(bs, n_img, dtype=torch.bool, device=device)
+    mask_v[1:, n_img * 3 // 4 :] = True
+    # padded text tokens, one caption per length
+    lengths = torch.tensor([n_txt, n_txt // 2, 1], device=device)[:bs]
+    mask_l = torch.arange(n_txt, device=device)[None] >= lengths[:, None]
+    return v, l, mask_v, mask_l
+
+
+def test_fusion_matches_native():
+    torch.manual_seed(0)
+    attn = BiMultiHeadAttention(32, 24, 64, 4, dropout=0.0).eval()
+    v, l, mask_v, mask_l = _fusion_inputs()
+    ref, out = _run_backends(attn, v, l, attention_mask_v=mask_v, attention_mask_l=mask_l)
+    for a, b in zip(ref, out):
+        assert torch.allclose(a, b, rtol=1e-4, atol=1e-5)
+
+
+def test_fusion_fully_masked_rows():
+    torch.manual_seed(0)
+    attn = BiMultiHeadAttention(32, 24, 64, 4, dropout=0.0).eval()
+    v, l, mask_v, mask_l = _fusion_inputs()
+    # the image tokens of the last caption may attend to no text token
+    mask_l[-1] = True
+    (ref_v, ref_l), (out_v, out_l) = _run_backends(
+        attn, v, l, attention_mask_v=mask_v, attention_mask_l=mask_l
+    )
+    assert torch.isnan(ref_v[-1]).all() and torch.isnan(out_v[-1]).all()
+    assert torch.allclose(ref_v, out_v, rtol=1e-4, atol=1e-5, equal_nan=True)
+    assert torch.allclose(ref_l, out_l, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="half precision kernels need cuda")
+def test_fusion_half_precision_without_clamps():
+    """Without the +-50000 clamps, sdpa in half precision stays as close to float32 as native does."""
+    torch.manual_seed(0)
+    attn = BiMultiHeadAttention(32, 24, 64, 4, dropout=0.0).cuda().eval()
+    # large inputs give logits in the thousands, far beyond those of a trained model
+    v, l, mask_v, mask_l = _fusion_inputs(device="cuda", dtype=torch.float16, scale=8.0)
+    attn.attn_backend = "native"
+    with torch.no_grad():
+        ref = attn(v.float(), l.float(), attention_mask_v=mask_v, attention_mask_l=mask_l)
+    native, sdpa = _run_backends(attn.half(), v, l, attention_mask_v=mask_v, attention_mask_l=mask_l)
+    for r, a, b in zip(ref, native, sdpa):
+        assert torch.isfinite(b).all()
+        err_native = (a.float() - r).abs().max().item()
+        err_sdpa = (b.float() - r).abs().max().item()
+        assert err_sdpa <= 2 * err_native + 1e-3
+
+
+def _text_inputs(device="cpu"):
+    rows = [
+        [101, 2001, 1012, 2002, 2003, 1012, 102],
+        [101, 2001, 1012, 102],
+        [101, 2001, 1012, 2002, 1012, 102],
+    ]
+    num_token = max(len(r) for r in rows)
+    input_ids = torch.zeros((len(rows), num_token), dtype=torch.long, device=device)
+    for i, r in enumerate(rows):
+        input_ids[i, : len(r)] = torch.as_tensor(r)
+    self_attention_masks = generate_masks_with_special_tokens(
+        {"input_ids": input_ids}, [101, 102, 1012, 1029], None
+    )[0]
+    src = torch.randn(num_token, len(rows), 32, device=device)
+    pos = torch.randn_like(src)
+    return src, ~self_attention_masks, pos
+
+
+def test_text_self_attention_matches_native():
+    torch.manual_seed(0)
+    layer = TransformerEncoderLayer(32, 4, dim_feedforward=64, dropout=0.0).eval()
+    src, src_mask, pos = _text_inputs()
+    ref, out = _run_backends(layer, src, src_mask=src_mask, pos=pos)
+    assert torch.allclose(ref, out, rtol=1e-4, atol=1e-5)
+
+
+def test_text_self_attention_fully_masked_rows():
+    torch.manual_seed(0)
+    layer = TransformerEncoderLayer(32, 4, dim_feedforward=64, dropout=0.0).eval()
+    src, src_mask, pos = _text_inputs()
+    # the second token of the first caption may attend to no token
+    src_mask[0, 1] = True
+    ref, out = _run_backends(layer, src, src_mask=src_mask, pos=pos)
+    assert torch.isnan(ref[1, 0]).all() and torch.isnan(out[1, 0]).all()
+    assert torch.allclose(ref, out, rtol=1e-4, atol=1e-5, equal_nan=True)
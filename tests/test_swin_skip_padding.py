@@ -0,0 +1,87 @@
+"""
+SwinTransformer skip_padding against the default forward, on a batch with padding.
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")  # imported by the models package
+pytest.importorskip("timm")
+
+from groundingdino.util.misc import NestedTensor  # noqa: E402
+from models.GroundingDINO.backbone.swin_transformer import SwinTransformer  # noqa: E402
+
+# image sizes that are not multiples of the patch, window or merging sizes
+IMAGE_SIZES = [(96, 128), (42, 58), (70, 30)]
+CANVAS = (96, 128)
+
+
+def _swin(skip_padding, **kwargs):
+    torch.manual_seed(0)
+    swin = SwinTransformer(
+        embed_dim=16, depths=[2, 2, 2], num_heads=[2, 2, 4], window_size=4, out_indices=(0, 1, 2),
+        skip_padding=skip_padding, **kwargs
+    )
+    return swin.double()
+
+
+def _batch():
+    g = torch.Generator().manual_seed(0)
+    images = torch.zeros((len(IMAGE_SIZES), 3) + CANVAS, dtype=torch.float64)
+    mask = torch.ones((len(IMAGE_SIZES),) + CANVAS, dtype=torch.bool)
+    for i, (h, w) in enumerate(IMAGE_SIZES):
+        images[i, :, :h, :w] = torch.randn(3, h, w, generator=g, dtype=torch.float64)
+        mask[i, :h, :w] = False
+    return NestedTensor(images, mask)
+
+
+def _assert_same_outputs(out, ref):
+    for level in ref:
+        # every pixel, batch padding included
+        assert torch.allclose(out[level].tensors, ref[level].tensors, rtol=1e-10, atol=1e-10), level
+        assert torch.equal(out[level].mask, ref[level].mask)
+
+
+@torch.no_grad()
+def test_outputs_unchanged_in_eval():
+    batch = _batch()
+    _assert_same_outputs(_swin(True).eval()(batch), _swin(False).eval()(batch))
+
+
+def test_outputs_and_gradients_unchanged_in_training():
+    batch = _batch()
+    results = []
+    for skip_padding in (False, True):
+        swin = _swin(skip_padding, drop_path_rate=0.3).train()
+        torch.manual_seed(1)  # same drop path draws
+        out = swin(batch)
+        sum(o.tensors.sum() * (i + 1) for i, o in enumerate(out.values())).backward()
+        results.append((out, {name: p.grad for name, p in swin.named_parameters()}))
+    (ref, ref_grads), (out, grads) = results
+    _assert_same_outputs(out, ref)
+    for name, ref_grad in ref_grads.items():
+        assert torch.allclose(grads[name], ref_grad, rtol=1e-8, atol=1e-10), name
+
+
+@torch.no_grad()
+def test_padding_windows_are_skipped():
+    batch = _batch()
+    num_windows = {}
+    for skip_padding in (False, True):
+        swin = _swin(skip_padding).eval()
+        attn = swin.layers[0].blocks[0].attn
+        handle = attn.register_forward_hook(
+            lambda module, inputs, output, key=skip_padding: num_windows.__setitem__(key, inputs[0].shape[0])
+        )
+        swin(batch)
+        handle.remove()
+    assert num_windows[True] < num_windows[False]
+
+
+@torch.no_grad()
+def test_no_padding_is_unchanged():
+    batch = _batch()
+    batch = NestedTensor(batch.tensors[:1], batch.mask[:1])
+    out = _swin(True).eval()(batch)
+    ref = _swin(False).eval()(batch)
+    for level in ref:
+        assert torch.equal(out[level].tensors, ref[level].tensors)
@@ -0,0 +1,378 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2023 IDEA. All Rights Reserved.
+# ------------------------------------------------------------------------
+"""
+Micro-benchmarks of individual Grounding DINO building blocks.
+
+Each benchmark times a reference implementation against the one used by the model on synthetic
+inputs, so no dataset or checkpoint is needed. Example:
+
+    python tools/microbenchmark.py --bench text_mask --device cuda
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(sys.path[0]))
+
+import torch
+import torch.nn.functional as F
+
+from models.GroundingDINO.bertwarper import (
+    generate_masks_with_special_tokens,
+    generate_masks_with_special_tokens_and_transfer_map,
+)
+from models.GroundingDINO.fuse_modules import BiMultiHeadAttention
+from models.GroundingDINO.ms_deform_attn import multi_scale_deformable_attn_pytorch
+from models.GroundingDINO.transformer_vanilla import TransformerEncoderLayer
+from models.GroundingDINO.utils import pad_text_token_mask, use_sdpa
+
+BENCHMARKS = {}
+
+
+def register(name):
+    def wrapper(fn):
+        BENCHMARKS[name] = fn
+        return fn
+
+    return wrapper
+
+
+def _synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+def measure(fn, device, warmup=5, repeat=50):
+    """Return the mean wall time of fn() in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    _synchronize(device)
+    s = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    _synchronize(device)
+    return (time.perf_counter() - s) / repeat * 1000.0
+
+
+def _random_text_token_mask(bs, len_td, device):
+    lengths = torch.randint(1, len_td + 1, (bs,), device=device)
+    lengths[0] = len_td
+    return torch.arange(len_td, device=device)[None] < lengths[:, None]
+
+
+# ------------------------------------------------------------------
+# text_mask
+# ------------------------------------------------------------------
+def text_mask_loop(text_token_mask, max_text_len=256):
+    """The former per-element construction of out['text_mask'] in GroundingDINO.forward."""
+    bs, len_td = text_token_mask.shape
+    text_mask = torch.zeros(bs, max_text_len, dtype=torch.bool).to(text_token_mask.device)
+    for b in range(bs):
+        for j in range(len_td):
+            if text_token_mask[b][j] == True:
+                text_mask[b][j] = True
+    return text_mask
+
+
+@register("text_mask")
+def bench_text_mask(args):
+    results = []
+    for bs in args.batch_sizes:
+        for len_td in args.caption_lengths:
+            mask = _random_text_token_mask(bs, len_td, args.device)
+            assert torch.equal(text_mask_loop(mask), pad_text_token_mask(mask))
+            results.append(
+                {
+                    "bs": bs,
+                    "len": len_td,
+                    "loop_ms": measure(lambda: text_mask_loop(mask), args.device, repeat=args.repeat),
+                    "vectorized_ms": measure(
+                        lambda: pad_text_token_mask(mask), args.device, repeat=args.repeat
+                    ),
+                }
+            )
+    return results
+
+
+# ------------------------------------------------------------------
+# special token masks
+# ------------------------------------------------------------------
+SPECIAL_TOKENS = [101, 102, 1012, 1029]  # [CLS], [SEP], ".", "?"
+
+
+def special_token_masks_loop(tokenized, special_tokens_list):
+    """The former per-special-token generate_masks_with_special_tokens_and_transfer_map."""
+    input_ids = tokenized["input_ids"]
+    bs, num_token = input_ids.shape
+    special_tokens_mask = torch.zeros((bs, num_token), device=input_ids.device).bool()
+    for special_token in special_tokens_list:
+        special_tokens_mask |= input_ids == special_token
+    idxs = torch.nonzero(special_tokens_mask)
+    attention_mask = (
+        torch.eye(num_token, device=input_ids.device).bool().unsqueeze(0).repeat(bs, 1, 1)
+    )
+    position_ids = torch.zeros((bs, num_token), device=input_ids.device)
+    cate_to_token_mask_list = [[] for _ in range(bs)]
+    previous_col = 0
+    for i in range(idxs.shape[0]):
+        row, col = idxs[i]
+        if (col == 0) or (col == num_token - 1):
+            attention_mask[row, col, col] = True
+            position_ids[row, col] = 0
+        else:
+            attention_mask[row, previous_col + 1 : col + 1, previous_col + 1 : col + 1] = True
+            position_ids[row, previous_col + 1 : col + 1] = torch.arange(
+                0, col - previous_col, device=input_ids.device
+            )
+            c2t_maski = torch.zeros((num_token), device=input_ids.device).bool()
+            c2t_maski[previous_col + 1 : col] = True
+            cate_to_token_mask_list[row].append(c2t_maski)
+        previous_col = col
+    cate_to_token_mask_list = [torch.stack(c2t, dim=0) for c2t in cate_to_token_mask_list]
+    return attention_mask, position_ids.to(torch.long), cate_to_token_mask_list
+
+
+def _random_input_ids(bs, num_labels, device, max_text_len=256):
+    """Captions "[CLS] w w . w . ... [SEP]" with 1-3 word pieces per label, padded with 0."""
+    rows = []
+    for _ in range(bs):
+        ids = [101]
+        for _ in range(num_labels):
+            ids += torch.randint(2000, 3000, (int(torch.randint(1, 4, (1,))),)).tolist() + [1012]
+        rows.append((ids + [102])[:max_text_len])
+    num_token = max(len(r) for r in rows)
+    input_ids = torch.zeros((bs, num_token), dtype=torch.long)
+    for i, r in enumerate(rows):
+        input_ids[i, : len(r)] = torch.as_tensor(r)
+    return {"input_ids": input_ids.to(device)}
+
+
+@register("special_token_masks")
+def bench_special_token_masks(args):
+    results = []
+    for bs in args.batch_sizes:
+        for num_labels in args.num_labels:
+            tokenized = _random_input_ids(bs, num_labels, args.device)
+            ref = special_token_masks_loop(tokenized, SPECIAL_TOKENS)
+            out = generate_masks_with_special_tokens_and_transfer_map(tokenized, SPECIAL_TOKENS, None)
+            assert torch.equal(ref[0], out[0]) and torch.equal(ref[1], out[1])
+            assert all(torch.equal(a, b) for a, b in zip(ref[2], out[2]))
+            out = generate_masks_with_special_tokens(tokenized, SPECIAL_TOKENS, None)
+            assert torch.equal(ref[0], out[0]) and torch.equal(ref[1], out[1])
+            results.append(
+                {
+                    "bs": bs,
+                    "labels": num_labels,
+                    "len": tokenized["input_ids"].shape[1],
+                    "loop_ms": measure(
+                        lambda: special_token_masks_loop(tokenized, SPECIAL_TOKENS),
+                        args.device,
+                        repeat=args.repeat,
+                    ),
+                    "vectorized_ms": measure(
+                        lambda: generate_masks_with_special_tokens_and_transfer_map(
+                            tokenized, SPECIAL_TOKENS, None
+                        ),
+                        args.device,
+                        repeat=args.repeat,
+                    ),
+                }
+            )
+    return results
+
+
+# ------------------------------------------------------------------
+# fusion attention
+# ------------------------------------------------------------------
+def _peak_memory(fn, device):
+    if torch.device(device).type != "cuda":
+        fn()
+        return 0.0
+    torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated()
+    fn()
+    return (torch.cuda.max_memory_allocated() - base) / 2**20
+
+
+@register("fusion_attention")
+def bench_fusion_attention(args):
+    """Dense vs chunked BiMultiHeadAttention, d_model 256, 1024 embed dim, 4 heads as in the fusion layers."""
+    attn = BiMultiHeadAttention(256, 256, 1024, 4, dropout=0.0).to(args.device).eval()
+    results = []
+    for bs in args.batch_sizes:
+        for n_img in args.image_tokens:
+            v = torch.randn(bs, n_img, 256, device=args.device)
+            l = torch.randn(bs, 64, 256, device=args.device)
+            mask_v = torch.zeros(bs, n_img, dtype=torch.bool, device=args.device)
+            mask_v[1:, n_img * 3 // 4 :] = True
+            mask_l = torch.arange(64, device=args.device)[None].repeat(bs, 1) >= 40
+            row = {"bs": bs, "n_img": n_img}
+            with torch.no_grad():
+                attn.chunk_size = 0
+                dense = lambda: attn(v, l, attention_mask_v=mask_v, attention_mask_l=mask_l)
+                ref = dense()
+                row["dense_ms"] = measure(dense, args.device, repeat=args.repeat)
+                row["dense_mb"] = _peak_memory(dense, args.device)
+                attn.chunk_size = args.chunk_size
+                chunked = lambda: attn(v, l, attention_mask_v=mask_v, attention_mask_l=mask_l)
+                out = chunked()
+                row["chunked_ms"] = measure(chunked, args.device, repeat=args.repeat)
+                row["chunked_mb"] = _peak_memory(chunked, args.device)
+            row["max_abs_diff"] = max((a - b).abs().max().item() for a, b in zip(ref, out))
+            results.append(row)
+    return results
+
+
+# ------------------------------------------------------------------
+# sdpa attention backend
+# ------------------------------------------------------------------
+@register("sdpa")
+def bench_sdpa(args):
+    """Native vs scaled_dot_product_attention backends of the fusion and text enhancer attentions."""
+    if not use_sdpa("sdpa"):
+        print("sdpa: torch.nn.functional.scaled_dot_product_attention is not available, skipped")
+        return []
+    fusion = BiMultiHeadAttention(256, 256, 1024, 4, dropout=0.0).to(args.device).eval()
+    text_layer = TransformerEncoderLayer(256, 4, dim_feedforward=1024, dropout=0.0).to(args.device).eval()
+    results = []
+    for bs in args.batch_sizes:
+        for n_img in args.image_tokens:
+            v = torch.randn(bs, n_img, 256, device=args.device)
+            l = torch.randn(bs, 64, 256, device=args.device)
+            mask_v = torch.zeros(bs, n_img, dtype=torch.bool, device=args.device)
+            mask_v[1:, n_img * 3 // 4 :] = True
+            mask_l = torch.arange(64, device=args.device)[None].repeat(bs, 1) >= 40
+            row = {"module": "fusion", "bs": bs, "n_img": n_img}
+            outputs = {}
+            with torch.no_grad():
+                for backend in ("native", "sdpa"):
+                    fusion.attn_backend = backend
+                    run = lambda: fusion(v, l, attention_mask_v=mask_v, attention_mask_l=mask_l)
+                    outputs[backend] = run()
+                    row[backend + "_ms"] = measure(run, args.device, repeat=args.repeat)
+            row["max_abs_diff"] = max(
+                (a - b).abs().max().item() for a, b in zip(outputs["native"], outputs["sdpa"])
+            )
+            results.append(row)
+
+        for num_labels in args.num_labels:
+            tokenized = _random_input_ids(bs, num_labels, args.device)
+            self_attention_masks = generate_masks_with_special_tokens(tokenized, SPECIAL_TOKENS, None)[0]
+            src = torch.randn(tokenized["input_ids"].shape[1], bs, 256, device=args.device)
+            pos = torch.randn_like(src)
+            row = {"module": "text", "bs": bs, "len": src.shape[0]}
+            outputs = {}
+            with torch.no_grad():
+                for backend in ("native", "sdpa"):
+                    text_layer.attn_backend = backend
+                    run = lambda: text_layer(src, src_mask=~self_attention_masks, pos=pos)
+                    outputs[backend] = run()
+                    row[backend + "_ms"] = measure(run, args.device, repeat=args.repeat)
+            row["max_abs_diff"] = (outputs["native"] - outputs["sdpa"]).abs().max().item()
+            results.append(row)
+    return results
+
+
+# ------------------------------------------------------------------
+# multi-scale deformable attention, pytorch path
+# ------------------------------------------------------------------
+def multi_scale_deformable_attn_grid_sample(value, value_spatial_shapes, sampling_locations, attention_weights):
+    """The former per-level F.grid_sample implementation of multi_scale_deformable_attn_pytorch."""
+    bs, _, num_heads, embed_dims = value.shape
+    _, num_queries, num_heads, num_levels, num_points, _ = sampling_locations.shape
+    value_list = value.split([H_ * W_ for H_, W_ in value_spatial_shapes], dim=1)
+    sampling_grids = 2 * sampling_locations - 1
+    sampling_value_list = []
+    for level, (H_, W_) in enumerate(value_spatial_shapes):
+        value_l_ = (
+            value_list[level].flatten(2).transpose(1, 2).reshape(bs * num_heads, embed_dims, H_, W_)
+        )
+        sampling_grid_l_ = sampling_grids[:, :, :, level].transpose(1, 2).flatten(0, 1)
+        sampling_value_l_ = F.grid_sample(
+            value_l_, sampling_grid_l_, mode="bilinear", padding_mode="zeros", align_corners=False
+        )
+        sampling_value_list.append(sampling_value_l_)
+    attention_weights = attention_weights.transpose(1, 2).reshape(
+        bs * num_heads, 1, num_queries, num_levels * num_points
+    )
+    output = (
+        (torch.stack(sampling_value_list, dim=-2).flatten(-2) * attention_weights)
+        .sum(-1)
+        .view(bs, num_heads * embed_dims, num_queries)
+    )
+    return output.transpose(1, 2).contiguous()
+
+
+# feature map sizes of a 800x1200 image at strides 8, 16, 32, 64
+LEVEL_SHAPES = [(100, 150), (50, 75), (25, 38), (13, 19)]
+
+
+@register("ms_deform_attn")
+def bench_ms_deform_attn(args):
+    """grid_sample vs gather implementation of the pytorch deformable attention, 8 heads of 32 dims, 4 points."""
+    results = []
+    num_heads, embed_dims, num_points = 8, 32, 4
+    for bs in args.batch_sizes:
+        for num_levels in args.num_levels:
+            spatial_shapes = torch.as_tensor(LEVEL_SHAPES[:num_levels], dtype=torch.long, device=args.device)
+            num_value = int(spatial_shapes.prod(1).sum())
+            value = torch.randn(bs, num_value, num_heads, embed_dims, device=args.device)
+            for num_queries in args.num_queries:
+                # samples slightly outside [0, 1] exercise the zero padding
+                sampling_locations = torch.rand(
+                    bs, num_queries, num_heads, num_levels, num_points, 2, device=args.device
+                ) * 1.1 - 0.05
+                attention_weights = torch.rand(
+                    bs, num_queries, num_heads, num_levels * num_points, device=args.device
+                ).softmax(-1).view(bs, num_queries, num_heads, num_levels, num_points)
+                inputs = (value, spatial_shapes, sampling_locations, attention_weights)
+                with torch.no_grad():
+                    ref = multi_scale_deformable_attn_grid_sample(*inputs)
+                    out = multi_scale_deformable_attn_pytorch(*inputs)
+                    results.append(
+                        {
+                            "bs": bs,
+                            "levels": num_levels,
+                            "queries": num_queries,
+                            "grid_sample_ms": measure(
+                                lambda: multi_scale_deformable_attn_grid_sample(*inputs),
+                                args.device,
+                                repeat=args.repeat,
+                            ),
+                            "gather_ms": measure(
+                                lambda: multi_scale_deformable_attn_pytorch(*inputs),
+                                args.device,
+                                repeat=args.repeat,
+                            ),
+                            "max_abs_diff": (ref - out).abs().max().item(),
+                        }
+                    )
+    return results
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Grounding DINO micro-benchmarks", add_help=True)
+    parser.add_argument("--bench", nargs="+", default=None, choices=sorted(BENCHMARKS.keys()),
+                        help="benchmarks to run, all of them by default")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--caption_lengths", type=int, nargs="+", default=[16, 64, 195, 256])
+    parser.add_argument("--num_labels", type=int, nargs="+", default=[5, 20, 50])
+    parser.add_argument("--image_tokens", type=int, nargs="+", default=[5000, 10000, 20000])
+    parser.add_argument("--chunk_size", type=int, default=2048)
+    parser.add_argument("--num_levels", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--num_queries", type=int, nargs="+", default=[900, 5000, 20000])
+    parser.add_argument("--repeat", type=int, default=20)
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_args_parser().parse_args()
+    outputs = {}
+    for name in args.bench or sorted(BENCHMARKS.keys()):
+        outputs[name] = BENCHMARKS[name](args)
+        for row in outputs[name]:
+            print(name, json.dumps(row))